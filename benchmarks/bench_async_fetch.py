@@ -0,0 +1,99 @@
+"""bench_async_fetch.py
+
+    Spot price history fetch of all regions/systems from fake ec2 clients
+    with a latency per page: the threaded path (spot_price_history.get_spot_price_frame
+    in a ThreadPoolExecutor of the default workers, and of a thread per
+    region/system) against async_fetch.AsyncFetchEngine with several
+    numbers of fetch threads. Only the fetch is measured (pages into typed
+    chunks), the rate limiter is disabled to compare the paths alone.
+    Reports seconds, rows (a record may cross the days_back boundary
+    between modes) and the peak number of threads.
+
+    python -m benchmarks.bench_async_fetch [n_regions] [latency_ms] [page_size]
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from spot_market_scoring import metrics
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring.async_fetch import AsyncFetchEngine
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from benchmarks import synthetic
+from benchmarks.fakes import FakeEC2Client, unlimited_limiters
+
+DAYS_BACK = 30
+
+
+class ThreadSampler(threading.Thread):
+    def __init__(self, interval: float = 0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def fetch_threads(clients: dict, tasks: list, max_workers: int = None) -> list:
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(lambda t: sph.get_spot_price_frame(clients[t[0]], t[0], DAYS_BACK, t[1]), tasks))
+
+
+def fetch_async(clients: dict, tasks: list, concurrency: int, fetch_workers: int) -> list:
+    async def fetch_all(engine):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(region, system):
+            async with semaphore:
+                return await engine.get_spot_price_frame(clients[region], region, DAYS_BACK, system)
+        return await asyncio.gather(*[fetch(region, system) for region, system in tasks])
+
+    engine = AsyncFetchEngine(concurrency, fetch_workers, write_workers=1)
+    return engine.run(fetch_all(engine))
+
+
+def run(name: str, fetch, tasks: list) -> dict:
+    metrics.start_run()
+    sampler = ThreadSampler()
+    sampler.start()
+    start = time.perf_counter()
+    frames = fetch()
+    seconds = time.perf_counter() - start
+    sampler.stop()
+    return {'mode': name, 'tasks': len(tasks), 'rows': sum(len(df) for df in frames),
+            'seconds': round(seconds, 2), 'peak_threads': sampler.peak}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_regions = int(sys.argv[1]) if len(sys.argv) > 1 else len(REGION_CODE_MAP)
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    page_size = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    now = pd.Timestamp.now(tz='UTC')
+    regions = sorted(REGION_CODE_MAP)[:n_regions]
+    clients = {}
+    for i, region in enumerate(regions):
+        records = pd.concat([synthetic.get_spot_price_records(region, system, n_instances=10, n_azs=3,
+                                                              days=DAYS_BACK, end=now, seed=i * 10 + j)
+                             for j, system in enumerate(SYSTEM_LIST)], ignore_index=True)
+        clients[region] = FakeEC2Client(region, spot_prices=records, page_size=page_size, latency=latency)
+    tasks = [(region, system) for system in SYSTEM_LIST for region in regions]
+    unlimited_limiters(['ec2'])
+
+    print(json.dumps(run('threads', lambda: fetch_threads(clients, tasks), tasks)))
+    print(json.dumps(run('threads max_workers=84', lambda: fetch_threads(clients, tasks, len(tasks)), tasks)))
+    for concurrency, fetch_workers in [(len(tasks), 8), (len(tasks), 32), (len(tasks), 64)]:
+        print(json.dumps(run(f'async concurrency={concurrency} fetch_workers={fetch_workers}',
+                             lambda: fetch_async(clients, tasks, concurrency, fetch_workers), tasks)))
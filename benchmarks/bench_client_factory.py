@@ -0,0 +1,62 @@
+"""bench_client_factory.py
+
+    Startup cost of the aws clients: the former boto3.client per region,
+    created in series before any stage runs, against user.ClientFactory,
+    which creates the clients of one session on first use. Every mode runs
+    in its own process, loading the service models included. No request
+    is sent, dummy credentials are used.
+
+    python -m benchmarks.bench_client_factory [regions_used]
+"""
+import sys
+import json
+import time
+import logging
+import subprocess
+import boto3
+from spot_market_scoring import user
+from spot_market_scoring.mappings import REGION_CODE_MAP
+
+CREDENTIALS = {'aws_access_key_id': 'bench', 'aws_secret_access_key': 'bench'}
+
+
+def legacy_clients(regions_used: list) -> int:
+    clients = {region: boto3.client('ec2', region_name=region, **CREDENTIALS) for region in REGION_CODE_MAP}
+    clients['pricing'] = boto3.client('pricing', region_name='us-east-1', **CREDENTIALS)
+    clients['s3'] = boto3.client('s3', **CREDENTIALS)
+    for region in regions_used:
+        clients[region].meta.region_name
+    return len(clients)
+
+
+def factory_clients(regions_used: list) -> int:
+    factory = user.ClientFactory(**CREDENTIALS)
+    clients = user.get_client_list(factory)
+    factory.client('pricing', region_name='us-east-1')
+    factory.client('s3')
+    for region in regions_used:
+        clients[region].meta.region_name
+    return factory.created
+
+
+def run(name: str, func, regions_used: list) -> dict:
+    start = time.perf_counter()
+    created = func(regions_used)
+    return {'mode': name, 'regions_used': len(regions_used), 'clients_created': created,
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+MODES = {'legacy': legacy_clients, 'factory': factory_clients}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    if sys.argv[1:2] == ['--child']:
+        print(json.dumps(run(sys.argv[2], MODES[sys.argv[2]], sorted(REGION_CODE_MAP)[:int(sys.argv[3])])))
+        sys.exit(0)
+
+    n_regions = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    for mode, n in [('legacy', n_regions), ('factory', n_regions), ('factory', len(REGION_CODE_MAP))]:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_client_factory', '--child', mode, str(n)],
+                                check=True, capture_output=True, text=True).stdout
+        print(output.strip())
@@ -0,0 +1,56 @@
+"""bench_forecasting.py
+
+    Scaling of forecast_engine.ForecastEngine on synthetic history,
+    compared with random_forest.get_predicted_price in the calling thread.
+    Checks first that the single fit predicts like the last model of the
+    walk-forward validation (ModelConfig(validate=True)).
+
+    python -m benchmarks.bench_forecasting [n_instances] [workers ...]
+"""
+import os
+import sys
+import time
+import logging
+import numpy as np
+from spot_market_scoring import random_forest as rdf
+from spot_market_scoring.forecast_engine import ForecastEngine
+from benchmarks.synthetic import get_price_frames
+
+
+def check_single_fit(ins_dict: dict, config: rdf.ModelConfig, n_series: int = 20):
+    """
+    fit_spot_price_prediction_model and the last walk-forward model predict the same on every lag row
+    """
+    _, tasks = rdf.split_series(ins_dict)
+    for ins, az, values in tasks[:n_series]:
+        data = rdf.series_to_supervised(values, n_in=config.n_in)
+        single = rdf.fit_spot_price_prediction_model(values, config)
+        last = rdf.train_spot_price_prediction_model(values, config=config)[-1]
+        assert np.array_equal(single.predict(data[:, :-1]), last.predict(data[:, :-1])), \
+            f'{ins} {az}: single fit differs from the last walk-forward model'
+    print(f'single fit equals the last walk-forward model on {min(n_series, len(tasks))} series')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    workers_list = [int(w) for w in sys.argv[2:]] or [1, 2, 4, 8]
+
+    config = rdf.ModelConfig(random_state=0)
+    ins_dict = get_price_frames(n_instances=n_instances)
+    n_series = sum(len(df.columns) for df in ins_dict.values())
+    print(f'cpus={os.cpu_count()} instances={n_instances} series={n_series}')
+    check_single_fit(ins_dict, config)
+
+    start = time.perf_counter()
+    expected = rdf.get_predicted_price(ins_dict, 2021, config)
+    baseline = time.perf_counter() - start
+    print(f'in-thread: {baseline:.2f}s')
+
+    for workers in workers_list:
+        with ForecastEngine(workers=workers, config=config) as engine:
+            start = time.perf_counter()
+            actual = engine.predict(ins_dict)
+            elapsed = time.perf_counter() - start
+        assert actual == expected, 'predictions differ from the in-thread path'
+        print(f'workers={workers}: {elapsed:.2f}s speedup={baseline / elapsed:.2f}x')
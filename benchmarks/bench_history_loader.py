@@ -0,0 +1,53 @@
+"""bench_history_loader.py
+
+    Parse time and memory of a year of one region/system's history csv,
+    loaded the former way (object strings, Timestamp per row) and through
+    history_loader (categorical strings, vectorized utc timestamps).
+
+    python -m benchmarks.bench_history_loader [n_instances] [days]
+"""
+import io
+import sys
+import time
+import logging
+import pandas as pd
+from spot_market_scoring import history_loader as hl
+from benchmarks.synthetic import get_spot_price_records
+
+REGION, SYSTEM = 'us-east-1', 'Linux/UNIX (Amazon VPC)'
+
+
+def legacy_read_csv(body) -> pd.DataFrame:
+    df = pd.read_csv(body)
+    df['Timestamp'] = df['Timestamp'].apply(pd.Timestamp)
+    df['SpotPrice'] = df['SpotPrice'].astype('string').astype('float')
+    return df
+
+
+def measure(name: str, func, text: str, repeat: int = 3) -> pd.DataFrame:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = func(io.StringIO(text))
+        best = min(best, time.perf_counter() - start)
+    memory = df.memory_usage(index=True, deep=True).sum()
+    print(f'{name:>10}: {best:.3f}s {memory / 2 ** 20:.1f}MB')
+    return df
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+
+    records = get_spot_price_records(REGION, SYSTEM, n_instances=n_instances, n_azs=6, days=days,
+                                     changes_per_day=2, end=pd.Timestamp.now(tz='UTC'), seed=1)
+    buffer = io.StringIO()
+    records.astype({'SpotPrice': 'string'}).to_csv(buffer, index=False)
+    text = buffer.getvalue()
+    print(f'records={len(records)} csv={len(text) / 2 ** 20:.1f}MB')
+
+    expected = measure('legacy', legacy_read_csv, text)
+    actual = measure('loader', hl.read_csv, text)
+    expected['Timestamp'] = pd.to_datetime(expected['Timestamp'], utc=True)
+    pd.testing.assert_frame_equal(expected, actual, check_dtype=False, check_categorical=False)
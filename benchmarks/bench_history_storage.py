@@ -0,0 +1,50 @@
+"""bench_history_storage.py
+
+    Reading the last days of one region/system from the csv year object and
+    from the parquet partitions, on a filesystem-backed fake s3.
+
+    python -m benchmarks.bench_history_storage [n_instances] [days_back]
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+import pandas as pd
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring import history_storage as hs
+from benchmarks.synthetic import get_spot_price_records
+from benchmarks.fakes import FakeS3Client
+
+REGION, SYSTEM = 'us-east-1', 'Linux/UNIX (Amazon VPC)'
+
+
+def get_size(root: str, suffix: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, f))
+               for path, _, files in os.walk(root) for f in files if f.endswith(suffix))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 80
+    days_back = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+    with tempfile.TemporaryDirectory() as root:
+        s3client = FakeS3Client(root)
+        records = get_spot_price_records(REGION, SYSTEM, n_instances=n_instances, n_azs=4, days=330,
+                                         changes_per_day=4, end=pd.Timestamp.now(tz='UTC'), seed=1)
+        storages = [hs.CSVHistoryStorage(), hs.ParquetHistoryStorage()]
+        for storage in storages:
+            storage.write(records, s3client, REGION, SYSTEM, 2021)
+        print(f'records={len(records)} csv={get_size(root, ".csv") / 2 ** 20:.1f}MB '
+              f'parquet={get_size(root, ".parquet") / 2 ** 20:.1f}MB')
+
+        results = {}
+        for storage in storages:
+            start = time.perf_counter()
+            results[storage.name] = sph.read_from_s3(s3client, REGION, SYSTEM, 2021, days_back, storage=storage)
+            print(f'{storage.name}: {time.perf_counter() - start:.3f}s rows={len(results[storage.name])}')
+
+        expected, actual = (results[name].sort_values(hs.SORT_KEYS).reset_index(drop=True)
+                            for name in ('csv', 'parquet'))
+        pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
@@ -0,0 +1,104 @@
+"""bench_ingestion.py
+
+    Peak memory of fetching the spot price history of a busy region/system:
+    the former list of per-record lists turned into a DataFrame, against
+    spot_price_history.get_spot_price_frame's columnar chunks. Every mode
+    runs in its own process; records are built page by page like boto3 does.
+
+    python -m benchmarks.bench_ingestion [n_records] [chunk_size ...]
+"""
+import sys
+import json
+import time
+import logging
+import subprocess
+from datetime import datetime, timezone
+import pandas as pd
+from spot_market_scoring import metrics
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring import history_loader as hl
+from spot_market_scoring.utils import paginate
+from benchmarks.fakes import FakeEC2Client
+from benchmarks.run_pipeline import RSSSampler
+
+REGION, SYSTEM = 'us-east-1', 'Linux/UNIX (Amazon VPC)'
+COLUMNS = ['AvailabilityZone', 'InstanceType', 'ProductDescription', 'SpotPrice', 'Timestamp']
+
+logger = logging.getLogger(__name__)
+
+
+class PagedSpotPriceClient(FakeEC2Client):
+    def __init__(self, region: str, n_records: int, n_instances: int = 400, n_azs: int = 6):
+        """
+        describe_spot_price_history with n_records synthetic records, new objects for every page
+        """
+        super().__init__(region)
+        self.n_records = n_records
+        self.n_instances = n_instances
+        self.n_azs = n_azs
+        self.end = int(datetime.now(timezone.utc).timestamp())
+
+    def describe_spot_price_history(self, NextToken=None, **kwargs):
+        self._call('DescribeSpotPriceHistory', dict(kwargs, NextToken=NextToken))
+        start = int(NextToken or 0)
+        end = min(start + self.page_size, self.n_records)
+        records = [{'AvailabilityZone': f'{self.region}{chr(97 + i % self.n_azs)}',
+                    'InstanceType': f'c{(i // self.n_azs) % self.n_instances}.large',
+                    'ProductDescription': SYSTEM,
+                    'SpotPrice': f'{0.01 + (i % 997) / 1000:.6f}',
+                    'Timestamp': datetime.fromtimestamp(self.end - i * 3, tz=timezone.utc)}
+                   for i in range(start, end)]
+        response = {'SpotPriceHistory': records}
+        if end < self.n_records:
+            response['NextToken'] = str(end)
+        return self._after('DescribeSpotPriceHistory', response)
+
+    describe_spot_price_history.result_key = 'SpotPriceHistory'
+
+
+def get_spot_price_history(client, region, days_back: int = 30, productDescription: str = None) -> list:
+    """
+    the former fetch: every record as a list of its values, None if the fetch fails
+    """
+    filters = sph._get_filters(days_back, productDescription)
+    try:
+        return [list(item.values()) for item in paginate(client.describe_spot_price_history, **filters)]
+    except Exception as e:
+        metrics.add('errors')
+        logger.error(f'[ERR] {region}, {productDescription}: {e}')
+
+
+def legacy_fetch(client) -> pd.DataFrame:
+    response = get_spot_price_history(client, REGION, 90, SYSTEM)
+    return hl.load_history(pd.DataFrame(response, columns=COLUMNS))
+
+
+def run(mode: str, n_records: int, chunk_size: int) -> dict:
+    client = PagedSpotPriceClient(REGION, n_records)
+    sampler = RSSSampler()
+    sampler.start()
+    start = time.perf_counter()
+    if mode == 'legacy':
+        df = legacy_fetch(client)
+    else:
+        df = sph.get_spot_price_frame(client, REGION, 90, SYSTEM, chunk_size=chunk_size)
+    seconds = time.perf_counter() - start
+    sampler.stop()
+    return {'mode': mode, 'chunk_size': chunk_size if mode != 'legacy' else None, 'records': len(df),
+            'seconds': round(seconds, 2), 'rss_growth_mb': round((sampler.peak_rss - sampler.start_rss) / 2 ** 20, 1),
+            'frame_mb': round(df.memory_usage(deep=True).sum() / 2 ** 20, 1)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    if sys.argv[1:2] == ['--child']:
+        print(json.dumps(run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))))
+        sys.exit(0)
+
+    n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    chunk_sizes = [int(c) for c in sys.argv[2:]] or [10000, 50000, 200000]
+    for mode, chunk_size in [('legacy', 0)] + [('chunks', c) for c in chunk_sizes]:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_ingestion', '--child',
+                                 mode, str(n_records), str(chunk_size)],
+                                check=True, capture_output=True, text=True).stdout
+        print(output.strip())
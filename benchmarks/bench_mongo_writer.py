@@ -0,0 +1,59 @@
+"""bench_mongo_writer.py
+
+    Write throughput of pricing products: the former insert_one per product
+    against mongo_writer.BulkWriter batches, on the fake Mongo client with a
+    fixed latency per round trip.
+
+    python -m benchmarks.bench_mongo_writer [n_products] [latency_ms] [batch_size ...]
+"""
+import sys
+import json
+import time
+import logging
+from spot_market_scoring import metrics
+from spot_market_scoring.mongo_writer import BulkWriter
+from spot_market_scoring.mappings import REGION_CODE_MAP
+from benchmarks.fakes import FakeMongoClient
+from benchmarks.synthetic import get_pricing_products
+
+
+def legacy_write(collection, documents: list):
+    for document in documents:
+        collection.insert_one(document)
+
+
+def batched_write(collection, documents: list, batch_size: int):
+    with BulkWriter(collection, batch_size) as writer:
+        writer.insert_many(documents)
+
+
+def run(name: str, documents: list, latency: float, write) -> dict:
+    dbclient = FakeMongoClient(latency=latency)
+    collection = dbclient['aws_data']['pricing_product']
+    documents = [dict(document) for document in documents]
+    start = time.perf_counter()
+    write(collection, documents)
+    seconds = time.perf_counter() - start
+    assert collection.count_documents({}) == len(documents)
+    return {'mode': name, 'documents': len(documents), 'round_trips': dbclient.round_trips - 1,
+            'seconds': round(seconds, 3), 'documents_per_s': round(len(documents) / seconds)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_products = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 1.0) / 1000
+    batch_sizes = [int(b) for b in sys.argv[3:]] or [100, 1000, 5000]
+
+    documents = []
+    for region in REGION_CODE_MAP:
+        if len(documents) >= n_products:
+            break
+        documents.extend(json.loads(product)['product']['attributes']
+                         for product in get_pricing_products(region, n_instances=n_products // 4 + 1))
+    documents = documents[:n_products]
+    metrics.start_run()
+    print(json.dumps(run('insert_one', documents, latency, legacy_write)))
+    for batch_size in batch_sizes:
+        print(json.dumps(run(f'bulk {batch_size}', documents, latency,
+                             lambda c, d: batched_write(c, d, batch_size))))
@@ -0,0 +1,51 @@
+"""bench_pooled_forecast.py
+
+    Backtest of pooled_forecast.PooledForecaster against the per-series
+    random forests: the last day of every synthetic series is held out,
+    both forecasters predict it from the remaining history.
+
+    python -m benchmarks.bench_pooled_forecast [n_instances]
+"""
+import sys
+import time
+import logging
+import numpy as np
+from spot_market_scoring import random_forest as rdf
+from spot_market_scoring.pooled_forecast import PooledForecaster
+from benchmarks.synthetic import get_price_frames
+
+REGION = 'us-east-1'
+
+
+def backtest(ins_dict: dict, forecasters: dict) -> dict:
+    """
+    :param forecasters: name -> callable(ins_dict) -> ins_pred
+    :return: name -> (mae, seconds), over the series modelled by random_forest
+    """
+    history = {ins: df.iloc[:-1] for ins, df in ins_dict.items()}
+    _, tasks = rdf.split_series(history)
+    actual = np.array([ins_dict[ins][az].iloc[-1] for ins, az, _ in tasks])
+
+    results = {}
+    for name, forecaster in forecasters.items():
+        start = time.perf_counter()
+        ins_pred = forecaster(history)
+        elapsed = time.perf_counter() - start
+        predicted = np.array([ins_pred[ins][az] for ins, az, _ in tasks])
+        results[name] = (np.abs(predicted - actual).mean(), elapsed)
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    config = rdf.ModelConfig(random_state=0)
+    ins_dict = get_price_frames(REGION, n_instances=n_instances, n_days=32)
+
+    results = backtest(ins_dict, {
+        'last price': lambda h: {ins: df.iloc[-1].to_dict() for ins, df in h.items()},
+        'per-series': lambda h: rdf.get_predicted_price(h, 2021, config),
+        'pooled': lambda h: PooledForecaster(config).predict(h, REGION),
+    })
+    for name, (mae, elapsed) in results.items():
+        print(f'{name:>10}: mae={mae:.6f} time={elapsed:.2f}s')
@@ -0,0 +1,73 @@
+"""bench_price_list.py
+
+    On-demand price ingestion: pricing.update_ondemand_price paging
+    get_products of every region/operating system (fake pricing client, a
+    fixed latency per call) against price_list.update_ondemand_price
+    streaming the same products from an offer file (json and csv, with
+    Reserved terms and Dedicated products to skip). Checks that all modes
+    build the same ondemand table; peak is traced python allocations.
+
+    python -m benchmarks.bench_price_list [n_regions] [n_instances] [latency_ms]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import tracemalloc
+import pandas as pd
+from spot_market_scoring import metrics, pricing, price_list
+from spot_market_scoring.mappings import REGION_CODE_MAP
+from benchmarks import synthetic
+from benchmarks.fakes import FakeMongoClient, FakePricingClient
+
+
+def ingest(mode: str, products: list, path: str, latency: float) -> tuple:
+    dbclient, client = FakeMongoClient(), None
+    metrics.start_run()
+    if mode == 'api':
+        client = FakePricingClient(products, latency=latency)
+        pricing.update_ondemand_price(client, dbclient)
+    else:
+        price_list.update_ondemand_price(dbclient, [path])
+    return dbclient, client
+
+
+def run(mode: str, products: list, root: str, latency: float) -> tuple:
+    path = os.path.join(root, f'index.{mode}')
+    if mode != 'api':
+        synthetic.write_offer_file(path, products, mode)
+    start = time.perf_counter()
+    dbclient, client = ingest(mode, products, path, latency)
+    seconds = time.perf_counter() - start
+    # traced separately, tracing slows the decoding down several times
+    tracemalloc.start()
+    ingest(mode, products, path, 0)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    ondemand = pricing.get_ondemand_price_list(dbclient)
+    ondemand = ondemand.sort_values(list(ondemand.columns)).reset_index(drop=True)
+    return ondemand, {'mode': mode, 'rows': len(ondemand), 'aws_calls': client.calls if client else 0,
+                      'file_mb': round(os.path.getsize(path) / 2 ** 20, 1) if mode != 'api' else 0,
+                      'seconds': round(seconds, 3), 'peak_mb': round(peak / 2 ** 20, 1)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_regions = int(sys.argv[1]) if len(sys.argv) > 1 else 21
+    n_instances = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 200) / 1000
+
+    products = []
+    for i, region in enumerate(sorted(REGION_CODE_MAP)[:n_regions]):
+        products.extend(synthetic.get_pricing_products(region, n_instances, seed=i))
+    with tempfile.TemporaryDirectory() as root:
+        expected = None
+        for mode in ['api', 'json', 'csv']:
+            ondemand, result = run(mode, products, root, latency)
+            if expected is None:
+                expected = ondemand
+            pd.testing.assert_frame_equal(ondemand, expected)
+            print(json.dumps(result))
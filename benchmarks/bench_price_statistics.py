@@ -0,0 +1,155 @@
+"""bench_price_statistics.py
+
+    Mean/std of the spot prices of one region/system: the former
+    get_savings_statistics (reformat per instance type and get_mean_and_std
+    over the last 90 days of history) against price_statistics built from
+    the history, updated day by day from the fetched records and read back
+    from s3, and against reformat_all. History of dense series, sparse series
+    (azs starting late) and new instance types, with records at midnight.
+
+    Reports seconds and the largest difference to the former statistics
+    (relative, absolute below 1), exits with 1 if any of them is not equal.
+
+    python -m benchmarks.bench_price_statistics [n_instances] [n_azs]
+"""
+import sys
+import json
+import time
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from spot_market_scoring import price_statistics as ps
+from spot_market_scoring import spot_price_history as sph
+from benchmarks.fakes import FakeS3Client
+from benchmarks.synthetic import get_spot_price_records
+
+REGION, SYSTEM = 'us-east-1', 'Linux/UNIX (Amazon VPC)'
+DAYS_BACK = 90
+# difference of two statistics counted as equal, sums of the same prices in another order
+TOLERANCE = 1e-12
+
+
+def legacy_reformat(spot_prices: pd.DataFrame, now, resolution: str = '1D') -> pd.DataFrame:
+    az_df_dict = {az: pd.Series(df['SpotPrice'], name=az) for az, df in spot_prices.groupby("AvailabilityZone")}
+    spot_prices = pd.concat(list(az_df_dict.values()), axis=1)
+    spot_prices.loc[now] = spot_prices.tail(1).copy().iloc[0]
+    spot_prices = spot_prices.ffill().bfill()
+    spot_prices = spot_prices.resample(resolution).ffill()
+    return spot_prices.bfill()
+
+
+def legacy_statistics(history: pd.DataFrame, now) -> tuple:
+    df = history.copy()
+    df.sort_values(['InstanceType', 'AvailabilityZone', 'Timestamp'], inplace=True)
+    df.drop_duplicates(inplace=True)
+    df.set_index("Timestamp", inplace=True)
+    avg_entries, std_entries, ins_dict = {}, {}, {}
+    for ins, i_df in df.groupby(by='InstanceType', observed=True):
+        ins_dict[ins] = legacy_reformat(i_df, now)
+        avg_entries[ins], std_entries[ins] = sph.get_mean_and_std(ins_dict[ins], 'Month')
+    return avg_entries, std_entries, ins_dict
+
+
+def reformat_all_statistics(history: pd.DataFrame, now) -> tuple:
+    df = history.sort_values(['InstanceType', 'AvailabilityZone', 'Timestamp']).drop_duplicates()
+    ins_dict = sph.reformat_all(df.set_index('Timestamp'), now=now, dtype='float64')
+    avg_entries, std_entries = {}, {}
+    for ins, i_df in ins_dict.items():
+        avg_entries[ins], std_entries[ins] = sph.get_mean_and_std(i_df, 'Month')
+    return avg_entries, std_entries, ins_dict
+
+
+def incremental_statistics(records: pd.DataFrame, now, s3client) -> tuple:
+    """
+    statistics built from the history of 10 days ago, then updated every day with the records of the last
+    5 days (the days_back of the daily fetch) and stored in s3
+    """
+    first = now - pd.Timedelta(days=10)
+    stats = ps.SpotPriceStatistics.from_history(records.loc[records['Timestamp'] <= first], now=first)
+    for day in range(9, -1, -1):
+        fetch_end = now - pd.Timedelta(days=day)
+        ps.write_to_s3(stats, s3client, REGION, SYSTEM)
+        stats = ps.read_from_s3(s3client, REGION, SYSTEM)
+        stats.now = fetch_end
+        stats.update(records.loc[(records['Timestamp'] > fetch_end - pd.Timedelta(days=5))
+                                 & (records['Timestamp'] <= fetch_end)])
+    ps.write_to_s3(stats, s3client, REGION, SYSTEM)
+    stats = ps.read_from_s3(s3client, REGION, SYSTEM)
+    stats.now = now
+    avg, std = stats.get_mean_and_std('Month')
+    return avg, std, stats.get_ins_dict()
+
+
+def get_records(n_instances: int, n_azs: int, now) -> pd.DataFrame:
+    dense = get_spot_price_records(REGION, SYSTEM, n_instances=n_instances, n_azs=n_azs, days=120,
+                                   changes_per_day=2, end=now, seed=1)
+    sparse = get_spot_price_records(REGION, SYSTEM, n_instances=n_instances, n_azs=n_azs, days=120,
+                                    changes_per_day=0.02, end=now, seed=2)
+    sparse['InstanceType'] = sparse['InstanceType'] + '-sparse'
+    new = get_spot_price_records(REGION, SYSTEM, n_instances=n_instances // 4 + 1, n_azs=n_azs, days=3,
+                                 changes_per_day=1, end=now, seed=3)
+    new['InstanceType'] = new['InstanceType'] + '-new'
+    records = pd.concat([dense, sparse, new], ignore_index=True)
+    # some records right at midnight
+    midnight = np.random.default_rng(4).random(len(records)) < 0.05
+    records.loc[midnight, 'Timestamp'] = records.loc[midnight, 'Timestamp'].dt.floor('D')
+    return records.drop_duplicates(['InstanceType', 'AvailabilityZone', 'Timestamp']).reset_index(drop=True)
+
+
+def max_difference(expected: dict, actual: dict) -> float:
+    if expected.keys() != actual.keys() or any(expected[ins].keys() != actual[ins].keys() for ins in expected):
+        return float('inf')
+    a = np.array([expected[ins][az] for ins in expected for az in expected[ins]], dtype='float64')
+    b = np.array([actual[ins][az] for ins in expected for az in expected[ins]], dtype='float64')
+    if not np.array_equal(np.isnan(a), np.isnan(b)):
+        return float('inf')
+    known = ~np.isnan(a)
+    return float(np.max(np.abs(a[known] - b[known]) / np.maximum(np.abs(a[known]), 1), initial=0))
+
+
+def frames_equal(expected: dict, actual) -> bool:
+    return expected.keys() == set(actual.keys()) and all(
+        expected[ins].index.equals(actual[ins].index) and list(expected[ins].columns) == list(actual[ins].columns)
+        and np.allclose(expected[ins].to_numpy('float64'), actual[ins].to_numpy('float64'),
+                        rtol=1e-6, equal_nan=True)
+        for ins in expected)
+
+
+def timeit(func, *args) -> tuple:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n_azs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    now = pd.Timestamp.now(tz='UTC')
+    records = get_records(n_instances, n_azs, now)
+    history = records.loc[records['Timestamp'] >= now - pd.Timedelta(days=DAYS_BACK)]
+    seconds, expected = timeit(legacy_statistics, history, now)
+    print(json.dumps({'mode': 'legacy reformat', 'records': len(history), 'seconds': round(seconds, 2)}))
+
+    equal = True
+    with tempfile.TemporaryDirectory() as root:
+        modes = {
+            'reformat_all': lambda: reformat_all_statistics(history, now),
+            'statistics from history': lambda: (lambda stats: (*stats.get_mean_and_std('Month'),
+                                                               stats.get_ins_dict()))(
+                ps.SpotPriceStatistics.from_history(history, now=now)),
+            'statistics updated daily': lambda: incremental_statistics(records, now, FakeS3Client(root)),
+        }
+        for mode, func in modes.items():
+            seconds, (avg, std, ins_dict) = timeit(func)
+            result = {'mode': mode, 'seconds': round(seconds, 2),
+                      'max_diff_mean': max_difference(expected[0], avg),
+                      'max_diff_std': max_difference(expected[1], std),
+                      'ins_dict_equal': frames_equal(expected[2], ins_dict)}
+            result['equal'] = (result['max_diff_mean'] <= TOLERANCE and result['max_diff_std'] <= TOLERANCE
+                               and result['ins_dict_equal'])
+            equal &= result['equal']
+            print(json.dumps(result))
+    sys.exit(0 if equal else 1)
@@ -0,0 +1,55 @@
+"""bench_product_decoding.py
+
+    Per product cost of the get_products PriceList strings: the former full
+    json.loads, get_ondemand_price and all attributes stored, against the
+    product_decoder backends (json, projected, orjson if installed) and
+    their compact records. Reports microseconds per product and the bson
+    size of the aws_data.pricing_product documents.
+
+    python -m benchmarks.bench_product_decoding [n_products] [reserved_terms]
+"""
+import sys
+import json
+import time
+import logging
+import bson
+from spot_market_scoring import pricing
+from spot_market_scoring import product_decoder as pdec
+from spot_market_scoring.mappings import REGION_CODE_MAP
+from benchmarks import synthetic
+
+
+def legacy_decode(document: str) -> dict:
+    data = json.loads(document)
+    attributes = data['product']['attributes']
+    pricing.get_ondemand_price(data)
+    return attributes
+
+
+def run(name: str, products: list, decode) -> dict:
+    start = time.perf_counter()
+    documents = [decode(p) for p in products]
+    seconds = time.perf_counter() - start
+    size = sum(len(bson.encode(d)) for d in documents)
+    return {'mode': name, 'products': len(products), 'us_per_product': round(seconds / len(products) * 1e6, 1),
+            'stored_bytes_per_product': round(size / len(products)), 'stored_mb': round(size / 2 ** 20, 2)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_products = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    reserved = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+
+    products = []
+    for i, region in enumerate(sorted(REGION_CODE_MAP)):
+        if len(products) >= n_products:
+            break
+        products.extend(synthetic.get_pricing_products(region, n_products // 4 + 1, seed=i, reserved=reserved))
+    products = products[:n_products]
+    print(json.dumps({'document_bytes': round(sum(map(len, products)) / len(products))}))
+
+    print(json.dumps(run('legacy', products, legacy_decode)))
+    for backend in pdec.BACKENDS:
+        if backend == 'orjson' and pdec.orjson is None:
+            continue
+        print(json.dumps(run(backend, products, lambda p: pdec.decode_product(p, backend))))
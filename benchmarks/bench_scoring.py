@@ -0,0 +1,69 @@
+"""bench_scoring.py
+
+    Compare the columnar get_scores_frame against the former per-instance loop
+    of get_scores_helper on synthetic data.
+
+    python -m benchmarks.bench_scoring [n_instances] [n_azs]
+"""
+import sys
+import time
+import logging
+import numpy as np
+import pandas as pd
+from spot_market_scoring import spot_market_scoring as sms
+from spot_market_scoring.utils import normalize_by_columns
+from benchmarks.synthetic import get_scoring_inputs
+
+REGION = 'us-east-1'
+SYSTEM = 'Linux/UNIX (Amazon VPC)'
+
+
+def legacy_scores_frame(ins_price, sa_scores, res_avg, res_std, ins_pred, region, system):
+    columns = ['Region', 'System', 'InstanceType', 'InstanceScores', 'AZScores']
+    scores = []
+    for ins in ins_price['InstanceType'].unique():
+        od_price = float(ins_price[ins_price['InstanceType'] == ins]['OnDemand'].iloc[0])
+        try:
+            pred_savings = {az: 1 - (ins_pred[ins][az] / od_price) for az in ins_pred[ins]}
+            savings_rate = {az: 1 - (res_avg[ins][az] / od_price) for az in res_avg[ins]}
+            std = {az: res_std[ins][az] for az in res_std[ins]}
+            avg_savings = {az: (pred_savings[az] + savings_rate[az]) / 2 for az in res_avg[ins]}
+            ins_az_scores = {az: 1 * avg_savings[az] - std[az] for az in savings_rate}
+            scores.append(dict(zip(columns, [region, system, ins, sa_scores[ins], ins_az_scores])))
+        except KeyError:
+            continue
+
+    scores_df = pd.DataFrame(scores)
+    scores_df = pd.concat([scores_df, scores_df['InstanceScores'].apply(pd.Series)], axis=1).drop('InstanceScores', axis=1)
+    scores_df = pd.concat([scores_df, scores_df['AZScores'].apply(pd.Series)], axis=1).drop('AZScores', axis=1)
+    scores_df.fillna(0, inplace=True)
+    scores_df['r'] = scores_df['r'].apply(lambda x: np.exp(1 - x))
+    scores_df = normalize_by_columns(scores_df, scores_df.columns[3:])
+    scores_df = sms.calculate_scores(scores_df, 'r', scores_df.columns[5:])
+    scores_df = sms.scale_to_100(normalize_by_columns(scores_df, scores_df.columns[5:]), scores_df.columns[5:])
+    return scores_df
+
+
+def timeit(func, *args, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    n_azs = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+
+    inputs = get_scoring_inputs(REGION, SYSTEM, n_instances=n_instances, n_azs=n_azs)
+    legacy_time, expected = timeit(legacy_scores_frame, *inputs, REGION, SYSTEM)
+    columnar_time, actual = timeit(sms.get_scores_frame, *inputs, REGION, SYSTEM)
+
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    print(f'instances={n_instances} azs={n_azs}')
+    print(f'legacy loop: {legacy_time * 1000:.1f} ms')
+    print(f'columnar:    {columnar_time * 1000:.1f} ms')
+    print(f'speedup:     {legacy_time / columnar_time:.1f}x')
@@ -0,0 +1,92 @@
+"""bench_scoring_memory.py
+
+    Memory of the scoring inputs of one region/system (mean/std of the
+    statistics stored in s3, daily prices by instance type, series to model):
+    the former object string frames and dict of float64 DataFrames against
+    categorical statistics and the float32 price_matrix.PriceMatrix.
+    Every mode runs in its own process; peak and retained are traced python
+    allocations, all 84 scoring tasks running at once hold 84 times as much.
+
+    python -m benchmarks.bench_scoring_memory [n_instances] [n_azs] [days]
+"""
+import sys
+import json
+import time
+import logging
+import tempfile
+import subprocess
+import tracemalloc
+import pandas as pd
+from spot_market_scoring import price_statistics as ps
+from spot_market_scoring import random_forest as rdf
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from benchmarks.fakes import FakeS3Client
+from benchmarks.synthetic import get_spot_price_records
+
+REGION, SYSTEM = 'us-east-1', 'Linux/UNIX (Amazon VPC)'
+TASKS = len(REGION_CODE_MAP) * len(SYSTEM_LIST)
+
+
+def legacy_inputs(s3client) -> tuple:
+    response = s3client.get_object(Bucket='stompy-aws-dataset', Key=ps.get_key(REGION, SYSTEM))
+    days = pd.read_csv(response.get('Body'), dtype={key: 'object' for key in ps.KEYS})
+    days['Day'] = pd.to_datetime(days['Day'], utc=True)
+    days['Timestamp'] = pd.to_datetime(days['Timestamp'], utc=True)
+
+    calendar = pd.date_range(end=pd.Timestamp.now(tz='UTC').floor('D'), periods=90, freq='D')
+    prices = days.pivot(index='Day', columns=ps.KEYS, values='SpotPrice').sort_index(axis=1)
+    prices = prices.reindex(prices.index.union(calendar)).ffill().reindex(calendar)
+    prices = prices.loc[:, prices.notna().any()]
+    month = prices.iloc[-30:]
+    avg, std = month.mean(), month.std()
+
+    ins_dict = {}
+    for ins in prices.columns.get_level_values(0).unique():
+        i_df = prices[ins]
+        ins_dict[ins] = i_df.loc[i_df.notna().any(axis=1).idxmax():].bfill()
+    tasks = []
+    for ins, df in ins_dict.items():
+        for az in df.columns:
+            if not df[az].var() <= 0.001:
+                tasks.append((ins, az, df[az].dropna().values))
+    return avg, std, ins_dict, tasks
+
+
+def inputs(s3client) -> tuple:
+    avg, std, ins_dict = sph.get_savings_statistics(REGION, SYSTEM, s3client=s3client)
+    return avg, std, ins_dict, rdf.split_series(ins_dict)[1]
+
+
+def run(mode: str, root: str) -> dict:
+    s3client = FakeS3Client(root)
+    func = legacy_inputs if mode == 'legacy' else inputs
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(s3client)
+    seconds = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'mode': mode, 'series': len(result[-1]), 'seconds': round(seconds, 2),
+            'peak_mb': round(peak / 2 ** 20, 1), 'retained_mb': round(retained / 2 ** 20, 1),
+            f'peak_mb_x{TASKS}': round(TASKS * peak / 2 ** 20)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    if sys.argv[1:2] == ['--child']:
+        print(json.dumps(run(sys.argv[2], sys.argv[3])))
+        sys.exit(0)
+
+    n_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    n_azs = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 120
+
+    root = tempfile.mkdtemp()
+    records = get_spot_price_records(REGION, SYSTEM, n_instances=n_instances, n_azs=n_azs, days=days,
+                                     changes_per_day=2, end=pd.Timestamp.now(tz='UTC'), seed=1)
+    ps.write_to_s3(ps.SpotPriceStatistics.from_history(records), FakeS3Client(root), REGION, SYSTEM)
+    for mode in ['legacy', 'compact']:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_scoring_memory', '--child', mode, root],
+                                check=True, capture_output=True, text=True).stdout
+        print(output.strip())
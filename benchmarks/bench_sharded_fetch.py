@@ -0,0 +1,100 @@
+"""bench_sharded_fetch.py
+
+    Spot price history update of all regions/systems with one hot
+    region/system (us-east-1 Linux/UNIX: many more instance types and
+    availability zones), from fake ec2 clients with a latency per page,
+    with and without the time window shards of history_shards, through
+    the threaded path and async_fetch.
+
+    A first run stores the records per day of every region/system, as an
+    earlier daily run would, the shards of the next runs are sized from
+    them. Reports seconds, the slowest tasks, the shards of the hot
+    region/system and whether its fetched records equal the unsharded ones.
+
+    python -m benchmarks.bench_sharded_fetch [n_regions] [latency_ms] [shard_records]
+"""
+import sys
+import json
+import time
+import logging
+import tempfile
+import pandas as pd
+from spot_market_scoring import metrics, history_cache, async_fetch
+from spot_market_scoring import history_shards as hsh
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring.history_storage import get_history_storage
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from benchmarks import synthetic
+from benchmarks.fakes import FakeS3Client, FakeMongoClient, FakeEC2Client, unlimited_limiters
+
+YEAR = 2021
+DAYS = 30
+DAYS_BACK = 10
+HOT = ('us-east-1', SYSTEM_LIST[0])
+
+
+def build_environment(root: str, n_regions: int, latency: float) -> dict:
+    now = pd.Timestamp.now(tz='UTC')
+    s3client = FakeS3Client(root)
+    storage = get_history_storage('csv')
+    clients = {}
+    for i, region in enumerate(sorted(REGION_CODE_MAP)):
+        records = None
+        if region in sorted(REGION_CODE_MAP)[:n_regions] or region == HOT[0]:
+            records = pd.concat([
+                synthetic.get_spot_price_records(region, system, n_instances=150 if (region, system) == HOT else 10,
+                                                 n_azs=6 if (region, system) == HOT else 3,
+                                                 days=DAYS, end=now, seed=i * 10 + j)
+                for j, system in enumerate(SYSTEM_LIST)], ignore_index=True)
+            stored = records.loc[records['Timestamp'] < now - pd.Timedelta(days=DAYS_BACK)]
+            for system, df in stored.groupby('ProductDescription'):
+                sph.write_to_s3(df.reset_index(drop=True), s3client, region, system, YEAR, storage=storage)
+        clients[region] = FakeEC2Client(region, spot_prices=records, page_size=100, latency=latency)
+    return {'clients': clients, 's3client': s3client, 'dbclient': FakeMongoClient(), 'storage': storage}
+
+
+def run(name: str, env: dict, fetch: str, shard_records: int) -> tuple:
+    hsh.set_shard_size(shard_records)
+    run_metrics = metrics.start_run()
+    history_cache.start_run(0)
+    hot_shards = hsh.get_shard_count(env['dbclient'], *HOT, DAYS_BACK)
+    start = time.perf_counter()
+    with metrics.stage('update_spot_price_history'):
+        if fetch == 'async':
+            frames = async_fetch.update_spot_price_history_in_all_region(
+                env['clients'], YEAR, DAYS_BACK, env['s3client'], env['dbclient'], storage=env['storage'])
+        else:
+            frames = sph.update_spot_price_history_in_all_region(
+                env['clients'], YEAR, DAYS_BACK, env['s3client'], env['dbclient'], local=False,
+                storage=env['storage'])
+    seconds = time.perf_counter() - start
+    tasks = sorted(run_metrics.report()['tasks'], key=lambda t: -t['duration_s'])
+    hot = frames[[(region, system) for system in SYSTEM_LIST for region in sorted(REGION_CODE_MAP)].index(HOT)]
+    return {'mode': name, 'seconds': round(seconds, 2),
+            'hot_shards': hot_shards,
+            'rows': sum(len(df) for df in frames if df is not None),
+            'slowest_tasks': [f"{t['region']} {t['system']} {t['duration_s']:.2f}s" for t in tasks[:3]]}, hot
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_regions = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 30) / 1000
+    shard_records = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    unlimited_limiters(['ec2'])
+
+    with tempfile.TemporaryDirectory() as root:
+        env = build_environment(root, n_regions, latency)
+        result, _ = run('first run, records per day unknown', env, 'threads', shard_records)
+        print(json.dumps(result))
+        hot = {}
+        for fetch in ['threads', 'async']:
+            for sharded in [False, True]:
+                result, hot[fetch, sharded] = run(f'{fetch}{" sharded" if sharded else ""}', env, fetch,
+                                                  shard_records if sharded else 0)
+                print(json.dumps(result))
+        unsharded = hsh.merge_shards([hot['threads', False]])
+        print(json.dumps({'hot_records_equal': {f'{fetch} sharded': len(hot[fetch, True]) == len(unsharded)
+                                                and hot[fetch, True][['InstanceType', 'AvailabilityZone']].equals(
+                                                    unsharded[['InstanceType', 'AvailabilityZone']])
+                                                for fetch in ['threads', 'async']}}))
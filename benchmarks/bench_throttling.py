@@ -0,0 +1,80 @@
+"""bench_throttling.py
+
+    Simulated AWS throttling: the spot price history of every region/system
+    fetched at once (like update_spot_price_history_in_all_region) from
+    fake ec2 clients that throttle beyond a server side token bucket per
+    region (fakes.FakeThrottle, RequestLimitExceeded). Fetches go through
+    rate_limiter in four configurations:
+
+        none      no limit, no retry: the former behavior, throttled fetches fail
+        retry     no limit, throttled calls retried with backoff
+        static    token bucket at the server rate, no adaptation
+        adaptive  limits set above the server rate, found by AIMD
+
+    Reports failed region/systems, accepted and throttled calls, seconds.
+
+    python -m benchmarks.bench_throttling [n_regions] [server_rate] [latency_ms]
+"""
+import sys
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from spot_market_scoring import metrics, rate_limiter
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from benchmarks import synthetic
+from benchmarks.fakes import FakeEC2Client, FakeThrottle
+
+
+def get_modes(server_rate: float) -> dict:
+    attempts = rate_limiter.MAX_ATTEMPTS
+    return {
+        'none': {'rate': None, 'burst': None, 'max_concurrency': None, 'adaptive': False, 'max_attempts': 1},
+        'retry': {'rate': None, 'burst': None, 'max_concurrency': None, 'adaptive': False, 'max_attempts': attempts},
+        'static': {'rate': server_rate, 'burst': 2 * server_rate, 'max_concurrency': 16, 'adaptive': False,
+                   'max_attempts': attempts},
+        'adaptive': {'rate': 5 * server_rate, 'burst': 10 * server_rate, 'max_concurrency': 32, 'adaptive': True,
+                     'max_attempts': attempts},
+    }
+
+
+def run(mode: str, limits: dict, records: dict, server_rate: float, latency: float) -> dict:
+    clients = {}
+    for region, df in records.items():
+        clients[region] = FakeEC2Client(region, spot_prices=df, page_size=100, latency=latency)
+        clients[region].throttle = FakeThrottle(server_rate, 2 * server_rate)
+    rate_limiter.configure('ec2', **limits)
+    metrics.start_run()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor() as executor:
+        futures = {(region, system): executor.submit(sph.get_spot_price_frame, clients[region], region,
+                                                     days_back=90, productDescription=system)
+                   for system in SYSTEM_LIST for region in records}
+        results = {key: future.result() for key, future in futures.items()}
+    seconds = time.perf_counter() - start
+
+    expected = {(region, system): int((df['ProductDescription'] == system).sum()) for region, df in records.items()
+                for system in SYSTEM_LIST}
+    return {'mode': mode, 'tasks': len(results),
+            'failed': sum(1 for key, frame in results.items() if len(frame) != expected[key]),
+            'calls_accepted': sum(c.throttle.accepted for c in clients.values()),
+            'calls_throttled': sum(c.throttle.throttled for c in clients.values()),
+            'seconds': round(seconds, 2)}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    n_regions = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    server_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+
+    now = pd.Timestamp.now(tz='UTC')
+    records = {region: pd.concat([synthetic.get_spot_price_records(region, system, n_instances=20, n_azs=3,
+                                                                   days=30, end=now, seed=i * 10 + j)
+                                  for j, system in enumerate(SYSTEM_LIST)], ignore_index=True)
+               for i, region in enumerate(sorted(REGION_CODE_MAP)[:n_regions])}
+    for mode, limits in get_modes(server_rate).items():
+        print(json.dumps(run(mode, limits, records, server_rate, latency)))
@@ -0,0 +1,663 @@
+"""fakes.py
+
+    In-process stand-ins for the external services used by the pipeline,
+    implementing only what spot_market_scoring calls. The boto3 fakes emit the
+    botocore before-call/after-call events used by metrics.instrument_client.
+
+        FakeS3Client        filesystem-backed s3 client (put_object/get_object/list_objects_v2/delete_object)
+        FakeMongoClient     in-memory, mongomock-style pymongo client, optional latency per round trip
+        FakeEC2Client       describe_instance_types/describe_spot_price_history of one region
+        FakePricingClient   get_products with NextToken paging
+        FakeThrottle        server side token bucket of a boto3 fake, throttling errors beyond it
+
+    unlimited_limiters() lifts the rate_limiter limits, which are sized for the
+    AWS apis, for fakes that accept every call.
+
+"""
+import io
+import os
+import copy
+import json
+import time
+import operator
+import threading
+import itertools
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from spot_market_scoring import rate_limiter
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class _Operation:
+    def __init__(self, name):
+        self.name = name
+
+
+class _Events:
+    """
+    botocore event emitter subset, before-call/after-call handlers get model, params and parsed
+    """
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, event_name, handler, unique_id=None, **kwargs):
+        self._handlers[unique_id or id(handler)] = (event_name, handler)
+
+    def emit(self, event_name, **kwargs):
+        for prefix, handler in list(self._handlers.values()):
+            if event_name == prefix or event_name.startswith(prefix + '.'):
+                handler(event_name=event_name, **kwargs)
+
+
+class _ServiceModel:
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+
+class _Meta:
+    def __init__(self, service, region_name=None):
+        self.service = service
+        self.service_model = _ServiceModel(service)
+        self.region_name = region_name
+        self.events = _Events()
+
+
+class FakeThrottle:
+    def __init__(self, rate: float, burst: float = None, code: str = 'RequestLimitExceeded'):
+        """
+        token bucket of an AWS api, calls beyond it fail with a throttling ClientError
+        :param rate: calls per second refilled
+        :param burst: bucket size, defaults to rate
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.code = code
+        self.tokens = self.burst
+        self.accepted = 0
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def check(self, operation):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.accepted += 1
+                return
+            self.throttled += 1
+        raise ClientError({'Error': {'Code': self.code, 'Message': 'Request limit exceeded.'},
+                           'ResponseMetadata': {'HTTPStatusCode': 503}}, operation)
+
+
+def unlimited_limiters(services=None):
+    """
+    no token bucket or concurrency limit for the services (every one of rate_limiter.LIMITS by default)
+    """
+    for service in list(rate_limiter.LIMITS) if services is None else services:
+        rate_limiter.configure(service, rate=None, burst=None, max_concurrency=None)
+
+
+class _FakeBotoClient:
+    def __init__(self, service, region_name=None):
+        self.meta = _Meta(service, region_name)
+        self.throttle = None
+
+    def _before(self, operation, params):
+        self.meta.events.emit(f'before-call.{self.meta.service}.{operation}',
+                              model=_Operation(operation), params=params)
+        if self.throttle is not None:
+            self.throttle.check(operation)
+
+    def _after(self, operation, response):
+        self.meta.events.emit(f'after-call.{self.meta.service}.{operation}',
+                              model=_Operation(operation), parsed=response)
+        return response
+
+
+class FakeS3Client(_FakeBotoClient):
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, root: str):
+        """
+        :param root: objects are saved as root/bucket/key
+        """
+        super().__init__('s3')
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._before('PutObject', {'Bucket': Bucket, 'Key': Key, 'Body': Body})
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(Body, str):
+            Body = Body.encode()
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return self._after('PutObject', {'ETag': str(len(Body))})
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._before('GetObject', {'Bucket': Bucket, 'Key': Key})
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise NoSuchKey(f'An error occurred (NoSuchKey): {Key}')
+        with open(path, 'rb') as f:
+            body = f.read()
+        return self._after('GetObject', {'Body': io.BytesIO(body), 'ContentLength': len(body)})
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._before('DeleteObject', {'Bucket': Bucket, 'Key': Key})
+        path = self._path(Bucket, Key)
+        if os.path.isfile(path):
+            os.remove(path)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._before('ListObjectsV2', {'Bucket': Bucket, 'Prefix': Prefix})
+        base = os.path.join(self.root, Bucket)
+        contents = []
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, base).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    contents.append({'Key': key, 'Size': os.path.getsize(path)})
+        contents.sort(key=lambda c: c['Key'])
+        return self._after('ListObjectsV2', {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False})
+
+
+# ------------------------------------------------------------------ mongo
+
+def _get_field(doc, path):
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return None, False
+    return value, True
+
+
+_COMPARISONS = {'$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le}
+
+
+def _match_value(value, exists, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for op, arg in condition.items():
+            if op == '$in':
+                ok = exists and (any(v in arg for v in value) if isinstance(value, list) else value in arg)
+            elif op == '$nin':
+                ok = not (exists and (value in arg))
+            elif op == '$exists':
+                ok = exists == bool(arg)
+            elif op == '$ne':
+                ok = not exists or value != arg
+            elif op in _COMPARISONS:
+                ok = exists and value is not None and _COMPARISONS[op](value, arg)
+            else:
+                raise NotImplementedError(op)
+            if not ok:
+                return False
+        return True
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return exists and value == condition
+
+
+def match(doc, filter):
+    for key, condition in (filter or {}).items():
+        if key == '$and':
+            if not all(match(doc, f) for f in condition):
+                return False
+            continue
+        if key == '$or':
+            if not any(match(doc, f) for f in condition):
+                return False
+            continue
+        if key == '$nor':
+            if any(match(doc, f) for f in condition):
+                return False
+            continue
+        value, exists = _get_field(doc, key)
+        if not _match_value(value, exists, condition):
+            return False
+    return True
+
+
+def project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {k.split('.')[0] for k, v in projection.items() if v and k != '_id'}
+    if include:
+        result = {k: copy.deepcopy(v) for k, v in doc.items() if k in include}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return {k: copy.deepcopy(v) for k, v in doc.items() if projection.get(k, 1)}
+
+
+class FakeCursor:
+    def __init__(self, collection, filter, docs):
+        self.collection = collection
+        self.filter = filter or {}
+        self._docs = iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._docs)
+
+    def explain(self):
+        """
+        winning plan of the index with the longest key prefix in the filter, as the planner would pick
+        """
+        best, prefix = None, 0
+        for name, spec in self.collection.index_information().items():
+            n = 0
+            for field, _ in spec['key']:
+                if field not in self.filter:
+                    break
+                n += 1
+            if n > prefix:
+                best, prefix = (name, spec), n
+        if best is None:
+            plan = {'stage': 'COLLSCAN', 'filter': self.filter}
+        else:
+            plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': best[0],
+                                                     'keyPattern': dict(best[1]['key'])}}
+        return {'queryPlanner': {'namespace': f'{self.collection.database.name}.{self.collection.name}',
+                                 'winningPlan': plan, 'rejectedPlans': []}}
+
+
+class FakeCollection:
+    _ids = itertools.count(1)
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.docs = []
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+        self._lock = threading.RLock()
+
+    def _round_trip(self):
+        self.database.client._round_trip()
+
+    def find(self, filter=None, projection=None, **kwargs):
+        self._round_trip()
+        with self._lock:
+            return FakeCursor(self, filter, [project(d, projection) for d in self.docs if match(d, filter)])
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        return next(self.find(filter, projection), None)
+
+    def count_documents(self, filter=None, **kwargs):
+        self._round_trip()
+        with self._lock:
+            return sum(1 for d in self.docs if match(d, filter))
+
+    def distinct(self, key, filter=None):
+        values = []
+        for doc in self.find(filter):
+            value, exists = _get_field(doc, key)
+            for v in (value if isinstance(value, list) else [value]) if exists else []:
+                if v not in values:
+                    values.append(v)
+        return values
+
+    def _insert(self, document):
+        document.setdefault('_id', next(self._ids))
+        with self._lock:
+            self.docs.append(copy.deepcopy(document))
+
+    def insert_one(self, document):
+        self._round_trip()
+        self._insert(document)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        self._round_trip()
+        for document in documents:
+            self._insert(document)
+
+    def _delete(self, filter, multi=True):
+        with self._lock:
+            before = len(self.docs)
+            if multi:
+                self.docs = [d for d in self.docs if not match(d, filter)]
+            else:
+                for i, d in enumerate(self.docs):
+                    if match(d, filter):
+                        del self.docs[i]
+                        break
+            return before - len(self.docs)
+
+    def delete_many(self, filter):
+        self._round_trip()
+        return type('DeleteResult', (), {'deleted_count': self._delete(filter)})()
+
+    def delete_one(self, filter):
+        self._round_trip()
+        return type('DeleteResult', (), {'deleted_count': self._delete(filter, multi=False)})()
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        return self.delete_many(spec_or_id or {})
+
+    def _apply_update(self, doc, update, insert=False):
+        if not any(k.startswith('$') for k in update):
+            replaced = {'_id': doc.get('_id')}
+            replaced.update(copy.deepcopy(update))
+            doc.clear()
+            doc.update(replaced)
+            return
+        for op, fields in update.items():
+            if op == '$set':
+                for k, v in fields.items():
+                    doc[k] = copy.deepcopy(v)
+            elif op == '$setOnInsert':
+                if insert:
+                    for k, v in fields.items():
+                        doc[k] = copy.deepcopy(v)
+            elif op == '$unset':
+                for k in fields:
+                    doc.pop(k, None)
+            elif op == '$inc':
+                for k, v in fields.items():
+                    doc[k] = doc.get(k, 0) + v
+            else:
+                raise NotImplementedError(op)
+
+    def _update(self, filter, update, upsert=False, multi=False):
+        """
+        :return: matched, upserted
+        """
+        matched = 0
+        with self._lock:
+            for doc in self.docs:
+                if match(doc, filter):
+                    self._apply_update(doc, update)
+                    matched += 1
+                    if not multi:
+                        break
+            if upsert and not matched:
+                doc = {k: v for k, v in filter.items() if not isinstance(v, dict)}
+                doc['_id'] = next(self._ids)
+                self._apply_update(doc, update, insert=True)
+                self.docs.append(doc)
+                return 0, 1
+        return matched, 0
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        self._round_trip()
+        self._update(filter, update, upsert)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        self._round_trip()
+        self._update(filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        self.update_one(filter, {k: v for k, v in replacement.items() if k != '_id'}, upsert=upsert)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        pymongo InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne and DeleteMany in one round trip
+        """
+        self._round_trip()
+        counts = dict.fromkeys(['inserted_count', 'matched_count', 'modified_count',
+                                'deleted_count', 'upserted_count'], 0)
+        for request in requests:
+            name = type(request).__name__
+            if name == 'InsertOne':
+                self._insert(request._doc)
+                counts['inserted_count'] += 1
+            elif name in ('UpdateOne', 'UpdateMany', 'ReplaceOne'):
+                update = request._doc
+                if name == 'ReplaceOne':
+                    update = {k: v for k, v in update.items() if k != '_id'}
+                matched, upserted = self._update(request._filter, update, request._upsert,
+                                                 multi=name == 'UpdateMany')
+                counts['matched_count'] += matched
+                counts['modified_count'] += matched
+                counts['upserted_count'] += upserted
+            elif name in ('DeleteOne', 'DeleteMany'):
+                counts['deleted_count'] += self._delete(request._filter, multi=name == 'DeleteMany')
+            else:
+                raise NotImplementedError(name)
+        return type('BulkWriteResult', (), counts)()
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        if multi:
+            return self.update_many(spec, document, upsert=upsert)
+        return self.update_one(spec, document, upsert=upsert)
+
+    def create_index(self, keys, name=None, **kwargs):
+        keys = [(keys, 1)] if isinstance(keys, str) else list(keys)
+        name = name or '_'.join(f'{k}_{d}' for k, d in keys)
+        with self._lock:
+            self.indexes[name] = dict(kwargs, key=keys)
+        return name
+
+    def index_information(self):
+        with self._lock:
+            return copy.deepcopy(self.indexes)
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def rename(self, new_name, dropTarget=False, **kwargs):
+        self.database._rename(self.name, new_name, dropTarget)
+
+
+class FakeDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self):
+        with self._lock:
+            return [name for name, c in self._collections.items() if c.docs]
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._collections.pop(name, None)
+
+    def _rename(self, name, new_name, drop_target):
+        with self._lock:
+            if new_name in self._collections and self._collections[new_name].docs and not drop_target:
+                raise ValueError(f'target namespace exists: {new_name}')
+            collection = self._collections.pop(name)
+            collection.name = new_name
+            self._collections[new_name] = collection
+
+
+class FakeMongoClient:
+    def __init__(self, *args, latency=0.0, **kwargs):
+        """
+        :param latency: seconds slept per round trip (query, write or bulk write)
+        """
+        self.latency = latency
+        self.round_trips = 0
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = FakeDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+
+# ------------------------------------------------------------------ boto3
+
+class _ResultKey:
+    def __init__(self, expression):
+        self.expression = expression
+
+
+class _Paginator:
+    def __init__(self, method):
+        self._method = method
+
+    @property
+    def result_keys(self):
+        return [_ResultKey(self._method.result_key)]
+
+    def paginate(self, **kwargs):
+        method = self._method
+
+        class _PageIterator:
+            def __iter__(self):
+                token = None
+                while True:
+                    response = method(**kwargs, **({'NextToken': token} if token else {}))
+                    yield response
+                    token = response.get('NextToken')
+                    if not token:
+                        break
+
+            def result_key_iters(self):
+                key = getattr(method, 'result_key')
+                return [itertools.chain.from_iterable(page[key] for page in self)]
+
+        return _PageIterator()
+
+
+def _page(items, token, page_size):
+    start = int(token or 0)
+    end = start + page_size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakeEC2Client(_FakeBotoClient):
+    def __init__(self, region, instance_types=None, spot_prices=None, page_size=1000, latency=0.0):
+        """
+        :param instance_types: describe_instance_types InstanceTypes
+        :param spot_prices: DataFrame of spot price records, see synthetic.get_spot_price_records
+        :param latency: seconds slept per call, to mimic network round trips
+        """
+        super().__init__('ec2', region)
+        self.region = region
+        self.instance_types = instance_types or []
+        self.spot_prices = spot_prices
+        self.page_size = page_size
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self, operation, params):
+        self._before(operation, params)
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_paginator(self, operation_name):
+        return _Paginator(getattr(self, operation_name))
+
+    def describe_instance_types(self, NextToken=None, **kwargs):
+        self._call('DescribeInstanceTypes', dict(kwargs, NextToken=NextToken))
+        items, token = _page(self.instance_types, NextToken, 100)
+        response = {'InstanceTypes': copy.deepcopy(items)}
+        if token:
+            response['NextToken'] = token
+        return self._after('DescribeInstanceTypes', response)
+
+    def describe_spot_price_history(self, StartTime=None, ProductDescriptions=None, InstanceTypes=None,
+                                    AvailabilityZone=None, EndTime=None, NextToken=None, **kwargs):
+        self._call('DescribeSpotPriceHistory', dict(kwargs, StartTime=StartTime, NextToken=NextToken))
+        df = self.spot_prices
+        if df is None or df.empty:
+            return self._after('DescribeSpotPriceHistory', {'SpotPriceHistory': []})
+        mask = df['Timestamp'] >= (StartTime or datetime(1970, 1, 1, tzinfo=timezone.utc))
+        if EndTime:
+            mask &= df['Timestamp'] < EndTime
+        if ProductDescriptions:
+            mask &= df['ProductDescription'].isin(ProductDescriptions)
+        if InstanceTypes:
+            mask &= df['InstanceType'].isin(InstanceTypes)
+        if AvailabilityZone:
+            mask &= df['AvailabilityZone'] == AvailabilityZone
+        selected = df.loc[mask]
+        start = int(NextToken or 0)
+        page = selected.iloc[start:start + self.page_size]
+        # datetimes have microseconds, like the ones botocore parses
+        page = page.assign(Timestamp=page['Timestamp'].dt.floor('us'))
+        records = [{'AvailabilityZone': az, 'InstanceType': ins, 'ProductDescription': prod,
+                    'SpotPrice': f'{price:.6f}', 'Timestamp': ts.to_pydatetime()}
+                   for az, ins, prod, price, ts in page[['AvailabilityZone', 'InstanceType',
+                                                         'ProductDescription', 'SpotPrice',
+                                                         'Timestamp']].itertuples(index=False)]
+        response = {'SpotPriceHistory': records}
+        if start + self.page_size < len(selected):
+            response['NextToken'] = str(start + self.page_size)
+        return self._after('DescribeSpotPriceHistory', response)
+
+    describe_spot_price_history.result_key = 'SpotPriceHistory'
+    describe_instance_types.result_key = 'InstanceTypes'
+
+
+class FakePricingClient(_FakeBotoClient):
+    def __init__(self, products=None, page_size=100, latency=0.0):
+        """
+        :param products: PriceList json strings, see synthetic.get_pricing_products
+        """
+        super().__init__('pricing', 'us-east-1')
+        self.products = [(json.loads(p)['product']['attributes'], p) for p in (products or [])]
+        self.page_size = page_size
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_products(self, ServiceCode=None, Filters=None, NextToken=None, **kwargs):
+        self._before('GetProducts', dict(kwargs, ServiceCode=ServiceCode, Filters=Filters, NextToken=NextToken))
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        filters = {f['Field']: f['Value'] for f in Filters or []
+                   if f['Field'] in ('location', 'operatingSystem', 'instanceType', 'InstanceType')}
+        selected = [p for attributes, p in self.products
+                    if all(attributes.get(k[0].lower() + k[1:]) == v for k, v in filters.items())]
+        items, token = _page(selected, NextToken, self.page_size)
+        response = {'PriceList': list(items), 'FormatVersion': 'aws_v1'}
+        if token:
+            response['NextToken'] = token
+        return self._after('GetProducts', response)
+
+    get_products.result_key = 'PriceList'
+
+    def get_paginator(self, operation_name):
+        return _Paginator(getattr(self, operation_name))
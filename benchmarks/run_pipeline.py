@@ -0,0 +1,267 @@
+"""run_pipeline.py
+
+    Offline benchmark of the daily update stages against in-process fakes
+    (filesystem S3, in-memory MongoDB, stubbed EC2/pricing clients) with
+    synthetic spot price history, pricing products and spot advisor data.
+    Reports wall time, cpu time, peak memory and the run metrics (api calls,
+    rows, bytes, documents, model fits, errors) per stage as json.
+
+    python -m benchmarks.run_pipeline --regions 2 --instances 50 --azs 3 --output report.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import threading
+import tempfile
+import tracemalloc
+import pandas as pd
+from spot_market_scoring import ec2, pricing, price_list, metrics, pipeline, history_cache, mongo_writer, mongo_indexes
+from spot_market_scoring import async_fetch
+from spot_market_scoring import spot_advisor as sa
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring import spot_market_scoring as sms
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from spot_market_scoring.forecast_engine import ForecastEngine
+from spot_market_scoring.history_storage import get_history_storage
+from spot_market_scoring.score_publisher import PUBLISH_MODES
+from benchmarks import synthetic
+from benchmarks.fakes import FakeS3Client, FakeMongoClient, FakeEC2Client, FakePricingClient, unlimited_limiters
+
+YEAR = 2021
+STAGES = ['update_instance_types', 'update_ondemand_price', 'update_spot_price_history', 'get_scores']
+
+
+def build_environment(args, root: str) -> dict:
+    """
+    fakes seeded with synthetic data, regions outside the first args.regions return no data
+    """
+    # the fakes do not throttle, the limits sized for the AWS apis would only add waits
+    unlimited_limiters()
+    regions = sorted(REGION_CODE_MAP)[:args.regions]
+    now = pd.Timestamp.now(tz='UTC')
+    s3client = metrics.instrument_client(FakeS3Client(root))
+    storage = get_history_storage(args.history_format, deltas=args.history_deltas)
+    clients, products = {}, []
+
+    for i, region in enumerate(sorted(REGION_CODE_MAP)):
+        if region not in regions:
+            clients[region] = metrics.instrument_client(FakeEC2Client(region, latency=args.latency))
+            continue
+        records = pd.concat([
+            synthetic.get_spot_price_records(region, system, n_instances=args.instances, n_azs=args.azs,
+                                             days=args.days, changes_per_day=args.changes_per_day,
+                                             end=now, seed=i * 10 + j)
+            for j, system in enumerate(SYSTEM_LIST)], ignore_index=True)
+        clients[region] = metrics.instrument_client(
+            FakeEC2Client(region, synthetic.get_instance_type_descriptions(args.instances),
+                          records, latency=args.latency))
+        products.extend(synthetic.get_pricing_products(region, args.instances, seed=i))
+
+        # history stored by previous runs, the fetch stage adds the last days_back days
+        stored = records.loc[records['Timestamp'] < now - pd.Timedelta(days=args.days_back)]
+        for system, df in stored.groupby('ProductDescription'):
+            sph.write_to_s3(df.reset_index(drop=True), s3client, region, system, YEAR, storage=storage)
+
+    # the same products as a price list offer file
+    offer_files = []
+    if args.price_list != 'api':
+        offer_files.append(os.path.join(root, f'index.{args.price_list}'))
+        synthetic.write_offer_file(offer_files[0], products, args.price_list)
+
+    sa_response = synthetic.get_spot_advisor(regions, args.instances)
+    dbclient = FakeMongoClient(latency=args.mongo_latency)
+    sa.write_to_mongo(dbclient, json.dumps({'spot_advisor': sa_response}), datetime.date.today().strftime('%Y-%m-%d'))
+    return {
+        'regions': regions,
+        'clients': clients,
+        'pricing_client': metrics.instrument_client(FakePricingClient(products, latency=args.latency)),
+        's3client': s3client,
+        'dbclient': dbclient,
+        'storage': storage,
+        'offer_files': offer_files,
+        'sa_response': sa_response,
+    }
+
+
+def run_stage(name: str, env: dict, args):
+    if name == 'update_instance_types':
+        ec2.update_instance_types(env['clients'], env['dbclient'])
+    elif name == 'update_ondemand_price' and env['offer_files']:
+        price_list.update_ondemand_price(env['dbclient'], env['offer_files'])
+    elif name == 'update_ondemand_price':
+        pricing.update_ondemand_price(env['pricing_client'], env['dbclient'])
+    elif name == 'update_spot_price_history' and args.fetch == 'async':
+        async_fetch.update_spot_price_history_in_all_region(env['clients'], year=YEAR, days_back=args.days_back,
+                                                            s3client=env['s3client'], dbclient=env['dbclient'],
+                                                            storage=env['storage'])
+    elif name == 'update_spot_price_history':
+        sph.update_spot_price_history_in_all_region(env['clients'], year=YEAR, days_back=args.days_back,
+                                                    s3client=env['s3client'], dbclient=env['dbclient'],
+                                                    local=False, storage=env['storage'])
+    elif name == 'get_scores':
+        ondemand = pricing.get_ondemand_price_list(env['dbclient'])
+        ondemand.reset_index(drop=True, inplace=True)
+        with ForecastEngine(workers=args.forecast_workers) as forecaster:
+            sms.get_scores(ondemand, env['sa_response'], env['s3client'], env['dbclient'],
+                           forecaster=forecaster, storage=env['storage'], publish=args.scores_publish)
+    else:
+        raise ValueError(f'unknown stage {name}')
+
+
+def run_dag(env: dict, args) -> dict:
+    """
+    all stages through the dependency-aware scheduler instead of one after another
+    """
+    with ForecastEngine(workers=args.forecast_workers) as forecaster:
+        scheduler = pipeline.run_update_pipeline(env['clients'], env['pricing_client'], env['s3client'],
+                                                 env['dbclient'], forecaster=forecaster, year=YEAR,
+                                                 days_back=args.days_back, max_workers=args.stage_workers,
+                                                 storage=env['storage'], publish=args.scores_publish,
+                                                 offer_files=env['offer_files'], fetch=args.fetch)
+    return {'failed': sorted(scheduler.failed), 'skipped': len(scheduler.skipped)}
+
+
+def get_rss() -> int:
+    """
+    resident set size in bytes, 0 if /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, interval: float = 0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.start_rss = self.peak_rss = get_rss()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, get_rss())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, get_rss())
+
+
+def measure(func, memory: str = 'rss') -> dict:
+    """
+    :param memory: 'rss' samples the process rss (cheap), 'tracemalloc' traces python/numpy
+                   allocations (exact but several times slower), 'none'
+    """
+    sampler = RSSSampler() if memory == 'rss' else None
+    if sampler:
+        sampler.start()
+    elif memory == 'tracemalloc':
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    func()
+    result = {'wall_s': round(time.perf_counter() - wall, 4),
+              'cpu_s': round(time.process_time() - cpu, 4)}
+    if sampler:
+        sampler.stop()
+        result['peak_rss_mb'] = round(sampler.peak_rss / 2 ** 20, 2)
+        result['rss_growth_mb'] = round((sampler.peak_rss - sampler.start_rss) / 2 ** 20, 2)
+    elif memory == 'tracemalloc':
+        result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        tracemalloc.stop()
+    return result
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--regions', type=int, default=2, help='regions with data, at most 21')
+    parser.add_argument('--instances', type=int, default=50, help='instance types per region')
+    parser.add_argument('--azs', type=int, default=3, help='availability zones per region')
+    parser.add_argument('--days', type=int, default=90, help='days of spot price history')
+    parser.add_argument('--days-back', type=int, default=5, help='days fetched by the history stage')
+    parser.add_argument('--changes-per-day', type=float, default=2.0, help='price changes per series and day')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds slept per fake AWS call')
+    parser.add_argument('--mongo-latency', type=float, default=0.0, help='seconds slept per fake Mongo round trip')
+    parser.add_argument('--mongo-batch-size', type=int, default=mongo_writer.BATCH_SIZE,
+                        help='operations per Mongo bulk write')
+    parser.add_argument('--history-format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--history-deltas', action='store_true', help='write history updates as deltas')
+    parser.add_argument('--history-cache-mb', type=float, default=256,
+                        help='memory of the run scoped history cache, 0 disables it')
+    parser.add_argument('--no-mongo-indexes', action='store_true',
+                        help='run without the indexes of mongo_indexes.INDEXES')
+    parser.add_argument('--price-list', default='api', choices=['api', 'json', 'csv'],
+                        help='on-demand prices from the pricing api or a synthetic offer file')
+    parser.add_argument('--fetch', default='threads', choices=pipeline.FETCH_MODES,
+                        help='spot price history fetch, a thread per region/system or asyncio, see async_fetch')
+    parser.add_argument('--scores-publish', default='staged', choices=PUBLISH_MODES,
+                        help='swap all new scores in at once, or rewrite every region/system in place')
+    parser.add_argument('--forecast-workers', type=int, default=0, help='ForecastEngine workers of get_scores')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--dag', action='store_true',
+                        help='run all stages (plus prod info, instance list and spot advisor) with the stage scheduler')
+    parser.add_argument('--stage-workers', type=int, default=32, help='stages running at once with --dag')
+    parser.add_argument('--memory', default='rss', choices=['rss', 'tracemalloc', 'none'],
+                        help='peak memory measurement, tracemalloc slows the stages down')
+    parser.add_argument('--output', help='json report path, default stdout')
+    parser.add_argument('--prometheus', help='also write the run metrics as a prometheus textfile')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL,
+                        format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        env = build_environment(args, root)
+        report = {'config': {k: v for k, v in vars(args).items() if k not in ('output', 'prometheus', 'verbose')},
+                  'setup_s': round(time.perf_counter() - start, 4),
+                  'stages': {}}
+        run_metrics = metrics.start_run()
+        cache = history_cache.start_run(int(args.history_cache_mb * 2 ** 20))
+        mongo_writer.set_batch_size(args.mongo_batch_size)
+        if not args.no_mongo_indexes:
+            mongo_indexes.ensure_indexes(env['dbclient'])
+        env['dbclient'].round_trips = 0
+        if args.dag:
+            result = {}
+            report['pipeline'] = measure(lambda: result.update(run_dag(env, args)), args.memory)
+            report['pipeline'].update(result)
+        else:
+            for name in STAGES:
+                if name in args.stages:
+                    with metrics.stage(name):
+                        report['stages'][name] = measure(lambda: run_stage(name, env, args), args.memory)
+        run_metrics.finish()
+    report['history_cache'] = {'hits': cache.hits, 'misses': cache.misses, 'evictions': cache.evictions,
+                               'bytes_saved': cache.bytes_saved}
+    report['mongo'] = {'round_trips': env['dbclient'].round_trips,
+                       'collection_scans': [f'{database}.{name} {sorted(filter)}' for database, name, filter, _
+                                            in mongo_indexes.check_query_plans(env['dbclient'])]}
+
+    # stage counters next to the measurements, the slowest tasks of every stage
+    run_report = run_metrics.report()
+    for name, entry in run_report['stages'].items():
+        report['stages'].setdefault(name, {'wall_s': round(entry['duration_s'], 4)})
+        report['stages'][name].update((k, v) for k, v in entry.items() if k != 'duration_s')
+    report['slowest_tasks'] = {name: [t for t in run_report['tasks'] if t['stage'] == name][:5]
+                               for name in report['stages']}
+    if args.prometheus:
+        run_metrics.write_prometheus(args.prometheus)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,264 @@
+"""synthetic.py
+
+    Generate synthetic inputs shaped like the production data,
+    so the pipeline stages can be profiled without AWS/MongoDB access.
+
+"""
+import json
+import numpy as np
+import pandas as pd
+from spot_market_scoring.mappings import INSTANCE_TYPE_LST
+
+
+def get_instance_types(n_instances: int) -> list:
+    return INSTANCE_TYPE_LST[:n_instances]
+
+
+def get_availability_zones(region: str, n_azs: int) -> list:
+    return [f'{region}{chr(ord("a") + i)}' for i in range(n_azs)]
+
+
+def get_scoring_inputs(region='us-east-1', system='Linux/UNIX (Amazon VPC)',
+                       n_instances=400, n_azs=6, seed=0):
+    """
+    generate the inputs of spot_market_scoring.get_scores_frame
+    :return: ins_price, sa_scores, res_avg, res_std, ins_pred
+    """
+    rng = np.random.default_rng(seed)
+    instances = get_instance_types(n_instances)
+    azs = get_availability_zones(region, n_azs)
+
+    od_price = rng.uniform(0.005, 30, len(instances)).round(4)
+    ins_price = pd.DataFrame({'Region': region, 'OperatingSystem': system,
+                              'InstanceType': instances, 'OnDemand': od_price})
+    sa_scores = {ins: {'r': int(rng.integers(0, 5)), 's': int(rng.integers(30, 90))}
+                 for ins in instances}
+
+    res_avg, res_std, ins_pred = {}, {}, {}
+    for ins, price in zip(instances, od_price):
+        # not every instance type is offered in every az
+        ins_azs = [az for az in azs if rng.random() > 0.2] or azs[:1]
+        discount = rng.uniform(0.1, 0.9, len(ins_azs))
+        res_avg[ins] = dict(zip(ins_azs, price * discount))
+        res_std[ins] = dict(zip(ins_azs, price * discount * rng.uniform(0, 0.05, len(ins_azs))))
+        ins_pred[ins] = dict(zip(ins_azs, price * discount * rng.uniform(0.95, 1.05, len(ins_azs))))
+
+    return ins_price, sa_scores, res_avg, res_std, ins_pred
+
+
+def get_price_frames(region='us-east-1', n_instances=50, n_azs=3, n_days=31,
+                     flat_ratio=0.3, seed=0) -> dict:
+    """
+    generate daily spot price frames shaped like get_savings_statistics' ins_dict
+    :param flat_ratio: share of series without price changes
+    :return: InstanceType -> DataFrame(index=day, columns=az)
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(end=pd.Timestamp.now(tz='UTC').floor('D'), periods=n_days, freq='D')
+    ins_dict = {}
+    for ins in get_instance_types(n_instances):
+        base = rng.uniform(0.002, 10)
+        prices = {}
+        for az in get_availability_zones(region, n_azs):
+            if rng.random() < flat_ratio:
+                prices[az] = np.full(n_days, base)
+            else:
+                walk = np.cumsum(rng.normal(0, 0.03, n_days))
+                prices[az] = np.round(base * np.exp(walk), 6)
+        ins_dict[ins] = pd.DataFrame(prices, index=index)
+    return ins_dict
+
+
+def get_spot_price_records(region='us-east-1', system='Linux/UNIX (Amazon VPC)',
+                           n_instances=50, n_azs=3, days=90, changes_per_day=2.0,
+                           end=None, seed=0) -> pd.DataFrame:
+    """
+    generate raw spot price history records, one row per price change
+    like describe_spot_price_history
+    :param changes_per_day: average number of price changes per series and day
+    :param end: time of the last possible record, defaults to now
+    :return: DataFrame with AvailabilityZone, InstanceType, ProductDescription, SpotPrice, Timestamp
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp.now(tz='UTC') if end is None else pd.Timestamp(end)
+    start = end - pd.Timedelta(days=days)
+    span = (end - start).value
+
+    frames = []
+    for ins in get_instance_types(n_instances):
+        base = rng.uniform(0.002, 10)
+        for az in get_availability_zones(region, n_azs):
+            n = max(1, rng.poisson(changes_per_day * days))
+            offsets = np.sort(rng.integers(0, span, n))
+            prices = np.round(base * np.exp(np.cumsum(rng.normal(0, 0.02, n))), 6)
+            frames.append(pd.DataFrame({
+                'AvailabilityZone': az,
+                'InstanceType': ins,
+                'ProductDescription': system,
+                'SpotPrice': prices,
+                'Timestamp': start + pd.to_timedelta(offsets, unit='ns'),
+            }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_instance_type_descriptions(n_instances=50) -> list:
+    """
+    describe_instance_types InstanceTypes
+    """
+    return [{'InstanceType': ins,
+             'CurrentGeneration': True,
+             'ProcessorInfo': {'SupportedArchitectures': ['arm64' if 'g.' in ins else 'x86_64']},
+             'VCpuInfo': {'DefaultVCpus': 2 ** (i % 7)},
+             'MemoryInfo': {'SizeInMiB': 1024 * 2 ** (i % 8)}}
+            for i, ins in enumerate(get_instance_types(n_instances))]
+
+
+# attributes get_products returns besides the ones above
+EXTRA_ATTRIBUTES = {
+    'clockSpeed': '3.1 GHz', 'currentGeneration': 'Yes', 'dedicatedEbsThroughput': 'Up to 4750 Mbps',
+    'ecu': '10', 'enhancedNetworkingSupported': 'Yes', 'intelAvx2Available': 'Yes',
+    'intelAvxAvailable': 'Yes', 'intelTurboAvailable': 'Yes', 'marketoption': 'OnDemand',
+    'networkPerformance': 'Up to 10 Gigabit', 'normalizationSizeFactor': '4', 'operation': 'RunInstances',
+    'physicalProcessor': 'Intel Xeon Platinum 8175', 'processorArchitecture': '64-bit',
+    'processorFeatures': 'Intel AVX; Intel AVX2; Intel AVX512; Intel Turbo', 'regionCode': 'us-east-1',
+    'servicename': 'Amazon Elastic Compute Cloud', 'vpcnetworkingsupport': 'true',
+}
+
+
+def get_pricing_products(region='us-east-1', n_instances=50, seed=0, reserved=0, metal=True) -> list:
+    """
+    pricing get_products PriceList json strings for every operating system of OS_MAP
+    :param reserved: Reserved terms per product, get_products returns about 12 of them
+    :param metal: add a bare metal instance type (productFamily 'Compute Instance (bare metal)')
+                  if there is none in the first n_instances
+    """
+    from spot_market_scoring.mappings import REGION_CODE_MAP
+    from spot_market_scoring.pricing import OS_MAP
+
+    rng = np.random.default_rng(seed)
+    products = []
+    instances = get_instance_types(n_instances)
+    if metal and not any(ins.endswith('.metal') for ins in instances):
+        instances = instances + [next(ins for ins in INSTANCE_TYPE_LST if ins.endswith('.metal'))]
+    for ins in instances:
+        base = rng.uniform(0.005, 30)
+        for os_name in OS_MAP:
+            sku = f'{region}.{ins}.{os_name}'
+            price = base * {'Linux': 1, 'RHEL': 1.2, 'SUSE': 1.1, 'Windows': 1.5}[os_name]
+            products.append(json.dumps({
+                'product': {
+                    'productFamily': 'Compute Instance (bare metal)' if ins.endswith('.metal')
+                                     else 'Compute Instance',
+                    'sku': sku,
+                    'attributes': {
+                        'instanceType': ins,
+                        'instanceFamily': 'General purpose',
+                        'location': REGION_CODE_MAP[region],
+                        'locationType': 'AWS Region',
+                        'operatingSystem': os_name,
+                        'vcpu': str(int(rng.integers(1, 96))),
+                        'memory': f'{int(rng.integers(1, 768))} GiB',
+                        'storage': 'EBS only',
+                        'tenancy': 'Shared',
+                        'preInstalledSw': 'NA',
+                        'capacitystatus': 'Used',
+                        'licenseModel': 'No License required',
+                        'servicecode': 'AmazonEC2',
+                        'usagetype': f'BoxUsage:{ins}',
+                        **(EXTRA_ATTRIBUTES if reserved else {}),
+                    }},
+                'serviceCode': 'AmazonEC2',
+                'terms': {
+                    'OnDemand': {f'{sku}.JRTCKXETXF': {
+                        'offerTermCode': 'JRTCKXETXF',
+                        'sku': sku,
+                        'priceDimensions': {f'{sku}.JRTCKXETXF.6YS6EN2CT7': {
+                            'unit': 'Hrs',
+                            'description': f'${price:.4f} per On Demand {os_name} {ins} Instance Hour',
+                            'pricePerUnit': {'USD': f'{price:.10f}'},
+                        }},
+                    }},
+                    'Reserved': {f'{sku}.R{i:02d}': {
+                        'offerTermCode': f'R{i:02d}',
+                        'sku': sku,
+                        'effectiveDate': '2021-07-01T00:00:00Z',
+                        'priceDimensions': {f'{sku}.R{i:02d}.{unit}': {
+                            'unit': unit,
+                            'description': f'{unit} price of a reserved {os_name} {ins} instance',
+                            'pricePerUnit': {'USD': f'{price * 0.6 * (1 if unit == "Hrs" else 8760):.10f}'},
+                            'beginRange': '0', 'endRange': 'Inf', 'rateCode': f'{sku}.R{i:02d}.{unit}',
+                            'appliesTo': [],
+                        } for unit in ('Hrs', 'Quantity')},
+                        'termAttributes': {'LeaseContractLength': f'{1 + i % 2}yr',
+                                           'OfferingClass': 'standard' if i % 4 < 2 else 'convertible',
+                                           'PurchaseOption': ['No Upfront', 'Partial Upfront', 'All Upfront'][i % 3]},
+                    } for i in range(reserved)},
+                },
+                'version': '20210701000000',
+            }))
+    return products
+
+
+def get_spot_advisor(regions: list, n_instances=50, seed=0) -> dict:
+    """
+    spot advisor data, region -> Linux/Windows -> InstanceType -> r, s
+    """
+    rng = np.random.default_rng(seed)
+    return {region: {system: {ins: {'r': int(rng.integers(0, 5)), 's': int(rng.integers(30, 90))}
+                              for ins in get_instance_types(n_instances)}
+                     for system in ('Linux', 'Windows')}
+            for region in regions}
+
+
+def write_offer_file(path: str, products: list, fmt: str = 'json', reserved: int = 3):
+    """
+    EC2 Price List offer file (index.json or index.csv) of get_pricing_products products
+    :param reserved: Reserved terms per product, and one Dedicated tenancy product per product, both filtered
+                     out by price_list like the bulk of a real offer file
+    """
+    offer_products, on_demand, reserved_terms = {}, {}, {}
+    for product in map(json.loads, products):
+        sku = product['product']['sku']
+        dedicated = dict(product['product'], sku=f'{sku}.dedicated',
+                         attributes=dict(product['product']['attributes'], tenancy='Dedicated'))
+        offer_products[sku], offer_products[dedicated['sku']] = product['product'], dedicated
+        on_demand[sku] = product['terms']['OnDemand']
+        on_demand[dedicated['sku']] = product['terms']['OnDemand']
+        reserved_terms[sku] = {f'{sku}.R{i}': {
+            'offerTermCode': f'R{i}', 'sku': sku,
+            'priceDimensions': {f'{sku}.R{i}.{d}': {'unit': unit, 'description': 'Reserved',
+                                                   'pricePerUnit': {'USD': '0.0100000000'}}
+                                for d, unit in enumerate(['Hrs', 'Quantity'])},
+            'termAttributes': {'LeaseContractLength': f'{i + 1}yr', 'PurchaseOption': 'All Upfront'}}
+            for i in range(reserved)}
+
+    if fmt == 'json':
+        with open(path, 'w') as f:
+            json.dump({'formatVersion': 'v1.0', 'offerCode': 'AmazonEC2', 'version': '20210701000000',
+                       'products': offer_products, 'terms': {'OnDemand': on_demand, 'Reserved': reserved_terms}},
+                      f, indent=2)
+        return
+
+    columns = ['SKU', 'OfferTermCode', 'RateCode', 'TermType', 'PriceDescription', 'Unit', 'PricePerUnit',
+               'Currency', 'LeaseContractLength', 'Product Family', 'serviceCode', 'Location', 'Location Type',
+               'Instance Type', 'Instance Family', 'vCPU', 'Memory', 'Storage', 'Tenancy', 'Operating System',
+               'License Model', 'Pre Installed S/W', 'Capacity Status']
+    rows = []
+    for term_type, terms in [('OnDemand', on_demand), ('Reserved', reserved_terms)]:
+        for sku, offers in terms.items():
+            attributes = offer_products[sku]['attributes']
+            for code, offer in offers.items():
+                for rate_code, dimension in offer['priceDimensions'].items():
+                    rows.append([sku, offer['offerTermCode'], rate_code, term_type, dimension['description'],
+                                 dimension['unit'], dimension['pricePerUnit']['USD'], 'USD',
+                                 offer.get('termAttributes', {}).get('LeaseContractLength', ''),
+                                 offer_products[sku]['productFamily'], 'AmazonEC2', attributes['location'],
+                                 attributes['locationType'], attributes['instanceType'],
+                                 attributes['instanceFamily'], attributes['vcpu'], attributes['memory'],
+                                 attributes['storage'], attributes['tenancy'], attributes['operatingSystem'],
+                                 attributes['licenseModel'], attributes['preInstalledSw'],
+                                 attributes['capacitystatus']])
+    metadata = [['FormatVersion', 'v1.0'], ['Disclaimer', 'synthetic'], ['Publication Date', '2021-07-01T00:00:00Z'],
+                ['Version', '20210701000000'], ['OfferCode', 'AmazonEC2']]
+    pd.DataFrame(metadata).to_csv(path, header=False, index=False, quoting=1)
+    pd.DataFrame(rows, columns=columns).to_csv(path, mode='a', index=False, quoting=1)
@@ -0,0 +1,48 @@
+import os
+import sys
+import boto3
+import logging
+import argparse
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from spot_market_scoring.history_storage import get_history_storage
+
+AWS_CREDENTIALS = {'aws_access_key_id': os.getenv('ALGO_AWS_CREDENTIALS_ACCESS_KEY_ID'),
+                   'aws_secret_access_key': os.getenv('ALGO_AWS_CREDENTIALS_SECRET_ACCESS_KEY')}
+
+HISTORY_FORMAT = os.getenv('ALGO_HISTORY_FORMAT', 'csv')
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+
+
+def main(argv=None, s3client=None) -> dict:
+    """
+    merge the spot price history deltas into the history, e.g. weekly
+    """
+    parser = argparse.ArgumentParser(description='Compact spot price history deltas')
+    parser.add_argument('--year', type=int, default=2021)
+    parser.add_argument('--regions', nargs='+', default=sorted(REGION_CODE_MAP))
+    parser.add_argument('--systems', nargs='+', default=SYSTEM_LIST)
+    parser.add_argument('--format', default=HISTORY_FORMAT, choices=['csv', 'parquet'])
+    parser.add_argument('--min-deltas', type=int, default=1, help='skip region/systems with fewer deltas')
+    args = parser.parse_args(argv)
+
+    s3client = s3client or boto3.client('s3', **AWS_CREDENTIALS)
+    storage = get_history_storage(args.format, deltas=True)
+    compacted, failed = {}, []
+    for region in args.regions:
+        for system in args.systems:
+            try:
+                compacted[(region, system)] = storage.compact(s3client, region, system, args.year,
+                                                              min_deltas=args.min_deltas)
+            except Exception as e:
+                logging.error(f'[ERR] {region} {system}: {e}')
+                failed.append((region, system))
+
+    logging.info(f'{sum(compacted.values())} deltas compacted, {len(failed)} failed')
+    return {'compacted': compacted, 'failed': failed}
+
+
+if __name__ == '__main__':
+    result = main(sys.argv[1:])
+    sys.exit(1 if result['failed'] else 0)
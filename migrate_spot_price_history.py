@@ -0,0 +1,48 @@
+import os
+import sys
+import boto3
+import logging
+import argparse
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from spot_market_scoring.history_storage import ParquetHistoryStorage, migrate_csv_to_parquet
+
+AWS_CREDENTIALS = {'aws_access_key_id': os.getenv('ALGO_AWS_CREDENTIALS_ACCESS_KEY_ID'),
+                   'aws_secret_access_key': os.getenv('ALGO_AWS_CREDENTIALS_SECRET_ACCESS_KEY')}
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+
+
+def main(argv=None, s3client=None) -> dict:
+    """
+    copy the csv spot price history objects into parquet partitions,
+    then run the update with ALGO_HISTORY_FORMAT=parquet
+    """
+    parser = argparse.ArgumentParser(description='Migrate spot price history from csv to parquet')
+    parser.add_argument('--years', type=int, nargs='+', default=[2021])
+    parser.add_argument('--regions', nargs='+', default=sorted(REGION_CODE_MAP))
+    parser.add_argument('--systems', nargs='+', default=SYSTEM_LIST)
+    parser.add_argument('--granularity', default='month', choices=list(ParquetHistoryStorage.GRANULARITY))
+    parser.add_argument('--no-verify', action='store_true', help='skip reading the partitions back')
+    args = parser.parse_args(argv)
+
+    s3client = s3client or boto3.client('s3', **AWS_CREDENTIALS)
+    parquet = ParquetHistoryStorage(granularity=args.granularity)
+    migrated, failed = {}, []
+    for year in args.years:
+        for region in args.regions:
+            for system in args.systems:
+                try:
+                    migrated[(region, system, year)] = migrate_csv_to_parquet(
+                        s3client, region, system, year, parquet, verify=not args.no_verify)
+                except Exception as e:
+                    logging.error(f'[ERR] {region} {system} {year}: {e}')
+                    failed.append((region, system, year))
+
+    logging.info(f'{len(migrated)} objects, {sum(migrated.values())} records migrated, {len(failed)} failed')
+    return {'migrated': migrated, 'failed': failed}
+
+
+if __name__ == '__main__':
+    result = main(sys.argv[1:])
+    sys.exit(1 if result['failed'] else 0)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""async_fetch.py
+
+    asyncio fetch engine of the spot price history of all regions/systems.
+    The threaded path (spot_price_history.update_spot_price_history_in_all_region)
+    holds a thread per region/system for its whole chain of
+    describe_spot_price_history pages. Here every region/system is a coroutine
+    on one event loop: only the page calls themselves run in a bounded
+    executor of fetch_workers threads, so the pages of many regions are
+    interleaved and the number of fetches in flight (concurrency) is not
+    tied to the number of threads.
+
+    boto3 clients are blocking (and aiobotocore is not a dependency), so
+    apaginate runs each page call in the executor, through the rate limiter
+    of the client like utils.paginate: the limiter's token and slot waits
+    and its backoff are awaited on the loop (RateLimiter.call_async), only
+    the boto3 call takes an executor thread. The records of every page go into the
+    typed chunks of spot_price_history.ChunkBuilder as the page arrives, and
+    the fetched frame of a region/system is handed to the history writer
+    (spot_price_history.write_spot_price_history) in a second executor of
+    write_workers threads, while the other fetches go on. Large
+    regions/systems are fetched in shards, see history_shards.
+
+        engine = AsyncFetchEngine(concurrency=84, fetch_workers=32)
+        frames = engine.run(engine.update_all(clients, s3client, dbclient, year, days_back, storage=storage))
+
+    Classes:
+        AsyncFetchEngine
+
+    Functions:
+        apaginate
+        update_spot_price_history_in_all_region
+
+"""
+import asyncio
+import logging
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from spot_market_scoring import metrics, rate_limiter
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring import history_loader as hl
+from spot_market_scoring import history_shards as hsh
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+
+logger = logging.getLogger(__name__)
+
+# region/system fetches in flight
+CONCURRENCY = 84
+# threads of the blocking boto3 page calls
+FETCH_WORKERS = 32
+# threads of the history writes (storage, statistics, mongo)
+WRITE_WORKERS = 8
+
+
+def _run_in(executor, func, *args, **kwargs):
+    """
+    func(*args, **kwargs) in executor, in the current context (metrics stage and task)
+    """
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return asyncio.get_running_loop().run_in_executor(executor, call)
+
+
+async def apaginate(method, executor, limiter=None, **kwargs):
+    """
+    items of every page of a NextToken paged operation, async version of utils.paginate
+    :param executor: executor of the blocking page calls
+    :param limiter: rate_limiter.RateLimiter, defaults to the one of the client's service/region
+    :return: async generator of the items of a page, as lists
+    """
+    client = method.__self__
+    result_key = client.get_paginator(method.__name__).result_keys[0].expression
+    limiter = limiter or rate_limiter.get_client_limiter(client)
+    token = None
+    while True:
+        page = await limiter.call_async(_run_in, executor, method, **kwargs, **({'NextToken': token} if token else {}))
+        yield page.get(result_key, [])
+        token = page.get('NextToken')
+        if not token:
+            break
+
+
+class AsyncFetchEngine:
+    def __init__(self, concurrency: int = CONCURRENCY, fetch_workers: int = FETCH_WORKERS,
+                 write_workers: int = WRITE_WORKERS, chunk_size: int = sph.CHUNK_SIZE):
+        """
+        init
+        :param concurrency: region/system fetches in flight
+        :param fetch_workers: threads of the page calls
+        :param write_workers: threads of the history writes
+        :param chunk_size: records per typed chunk, see spot_price_history.ChunkBuilder
+        """
+        self.concurrency = concurrency
+        self.fetch_workers = fetch_workers
+        self.write_workers = write_workers
+        self.chunk_size = chunk_size
+        self._fetch_executor = None
+        self._write_executor = None
+
+    def __enter__(self):
+        self._fetch_executor = ThreadPoolExecutor(self.fetch_workers, thread_name_prefix='fetch')
+        self._write_executor = ThreadPoolExecutor(self.write_workers, thread_name_prefix='write')
+        return self
+
+    def __exit__(self, *exc):
+        self._fetch_executor.shutdown()
+        self._write_executor.shutdown()
+        self._fetch_executor = self._write_executor = None
+
+    def run(self, coroutine):
+        """
+        run a coroutine of the engine on a new event loop, with the executors started if they are not
+        """
+        if self._fetch_executor is not None:
+            return asyncio.run(coroutine)
+        with self:
+            return asyncio.run(coroutine)
+
+    async def get_spot_price_frame(self, client, region, days_back: int = 30, productDescription: str = None,
+                                   shards: int = 1):
+        """
+        async spot_price_history.get_spot_price_frame, empty if the fetch fails
+        :param shards: time windows fetched concurrently and merged, see history_shards
+        """
+        try:
+            if shards <= 1:
+                return await self._get_window_frame(client, region, days_back, productDescription)
+            windows = hsh.get_windows(days_back, shards)
+            frames = await asyncio.gather(*[self._get_window_frame(client, region, days_back, productDescription, w)
+                                            for w in windows])
+            return hsh.merge_shards(frames)
+        except Exception as e:
+            metrics.add('errors')
+            logger.error(f'[ERR] {region}, {productDescription}: {e}')
+            return hl.load_history(None)
+
+    async def _get_window_frame(self, client, region, days_back, productDescription, window=None):
+        filters = sph._get_filters(days_back, productDescription, window=window)
+        builder = sph.ChunkBuilder(region, self.chunk_size)
+        chunks = []
+        async for items in apaginate(client.describe_spot_price_history, self._fetch_executor, **filters):
+            for item in items:
+                chunk = builder.add(item)
+                if chunk is not None:
+                    chunks.append(chunk)
+        chunk = builder.flush()
+        if chunk is not None:
+            chunks.append(chunk)
+        return hl.concat_history(chunks)
+
+    async def update_spot_price_history(self, client, s3client, dbclient, region, system, days_back, year,
+                                        storage=None, semaphore=None):
+        """
+        async spot_price_history.update_spot_price_history
+        :param semaphore: asyncio.Semaphore of the fetches in flight
+        :return: the fetched records
+        """
+        with metrics.task(region, system):
+            shards = await _run_in(self._write_executor, hsh.get_shard_count, dbclient, region, system, days_back)
+            if semaphore is None:
+                new_df = await self.get_spot_price_frame(client, region, days_back, system, shards)
+            else:
+                async with semaphore:
+                    new_df = await self.get_spot_price_frame(client, region, days_back, system, shards)
+            return await _run_in(self._write_executor, sph.write_spot_price_history,
+                                 new_df, s3client, dbclient, region, system, year, storage, days_back)
+
+    async def update_all(self, clients: dict, s3client, dbclient, year: int, days_back: int = 30,
+                         storage=None, tasks: list = None) -> list:
+        """
+        update the spot price history of all regions/systems
+        :param clients: region -> ec2 client
+        :param tasks: [(region, system)], defaults to all
+        :return: the fetched records of every task, in the order of tasks; None for a failed write
+        """
+        tasks = tasks or [(region, system) for system in SYSTEM_LIST for region in sorted(REGION_CODE_MAP)]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[
+            self.update_spot_price_history(clients[region], s3client, dbclient, region, system, days_back, year,
+                                           storage=storage, semaphore=semaphore)
+            for region, system in tasks], return_exceptions=True)
+        for (region, system), result in zip(tasks, results):
+            if isinstance(result, Exception):
+                logger.error(f'[ERR] {region} {system}: {result}')
+        return [None if isinstance(result, Exception) else result for result in results]
+
+
+def update_spot_price_history_in_all_region(clients: dict, year: int, days_back: int = 30,
+                                            s3client=None, dbclient=None, storage=None, regions: list = None,
+                                            concurrency: int = CONCURRENCY, fetch_workers: int = FETCH_WORKERS,
+                                            write_workers: int = WRITE_WORKERS) -> list:
+    """
+    asyncio version of spot_price_history.update_spot_price_history_in_all_region
+    :param clients: region -> ec2 client
+    :param regions: defaults to all
+    :return: the fetched records of every region/system
+    """
+    logger.info('----Fetching data from AWS boto3 (asyncio)----')
+    tasks = [(region, system) for system in SYSTEM_LIST for region in sorted(regions or REGION_CODE_MAP)]
+    engine = AsyncFetchEngine(concurrency, fetch_workers, write_workers)
+    return engine.run(engine.update_all(clients, s3client, dbclient, year, days_back, storage=storage, tasks=tasks))
@@ -1,4 +1,5 @@
 from concurrent.futures.thread import ThreadPoolExecutor
+import contextvars
 import threading
 import warnings
 import time
@@ -35,13 +36,15 @@ class ConcurrentTask:
         self._c_kwargs = c_kwargs if c_kwargs else dict()
         self._future = None
         self._executor = executor if executor else _EXECUTOR
+        # 任务在创建时的上下文 (contextvars) 中运行, 例如 metrics 的 stage/task
+        self._context = contextvars.copy_context()
 
     def run(self):
         """
         开启新线程运行并发任务并在有结果返回时运行回调函数
         :return:
         """
-        self._future = self._executor.submit(self._task, *self._t_args, **self._t_kwargs)
+        self._future = self._executor.submit(self._context.run, self._task, *self._t_args, **self._t_kwargs)
         if self._callbackTask is not None:
             self._future.add_done_callback(self.__callback)
         return self
@@ -71,6 +74,10 @@ class ConcurrentTask:
     def task(self):
         return self._task
 
+    @property
+    def context(self):
+        return self._context
+
     @property
     def t_args(self):
         return self._t_args
@@ -100,7 +107,7 @@ class ConcurrentTaskPool:
             tasks = [tasks]
 
         for t in tasks:
-            t.future = self._executor.submit(t.task, *t.t_args, **t.t_kwargs)
+            t.future = self._executor.submit(t.context.run, t.task, *t.t_args, **t.t_kwargs)
             self._tasks.append(t)
         return self
 
@@ -1,5 +1,8 @@
 import boto3
 from spot_market_scoring.mappings import REGION_CODE_MAP
+from spot_market_scoring import metrics
+from spot_market_scoring.utils import paginate
+from spot_market_scoring.mongo_writer import BulkWriter
 from spot_market_scoring.concurrent_task import *
 
 
@@ -34,30 +37,28 @@ def write_to_mongodb(dbclient, response):
 
 def update_instance_types(clients, dbclient):
     aws_data = dbclient['aws_data']
+    writer = BulkWriter(aws_data.ec2_instance_type)
 
     for region in REGION_CODE_MAP.keys():
+        with metrics.task(region):
+            results = list(paginate(clients[region].describe_instance_types))
+            metrics.add('rows_fetched', len(results))
 
-        response = clients[region].describe_instance_types()
-        results = []
-        results.extend(response['InstanceTypes'])
-        while 'NextToken' in response:
-            response = clients[region].describe_instance_types(NextToken=response['NextToken'])
-            results.extend(response['InstanceTypes'])
-
-
-        filter = {'region': region}
-        data = {
-            '$set': {'data': results}
-        }
+            filter = {'region': region}
+            data = {
+                '$set': {'data': results}
+            }
 
-        aws_data.ec2_instance_type.update_one(filter, data, upsert=True)
+            writer.update_one(filter, data, upsert=True)
 
+    writer.flush()
     update_prod_info(dbclient)
 
 def update_prod_info(dbclient):
     aws_data = dbclient['aws_data']
 
     db_w = dbclient['product_info']
+    writer = BulkWriter(db_w.instance_types)
 
     for region in REGION_CODE_MAP.keys():
 
@@ -83,7 +84,9 @@ def update_prod_info(dbclient):
             '$set': {'InstanceList': results}
         }
 
-        db_w.instance_types.update({'Region':region},data,upsert=True)
+        writer.update_one({'Region': region}, data, upsert=True)
+
+    writer.flush()
     return
 
 if __name__ == '__main__':
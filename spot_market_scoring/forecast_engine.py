@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""forecast_engine.py
+
+    Train the spot price prediction models in a process pool.
+    Random forest fitting holds the GIL for most of its time, so threads
+    cannot use more than one core; (instance, az) series are sent to worker
+    processes in cost-balanced batches instead.
+
+    Classes:
+        ForecastEngine
+
+    Helper Functions:
+        make_batches
+
+"""
+import os
+import heapq
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from spot_market_scoring import random_forest as rdf
+from spot_market_scoring import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def make_batches(tasks: list, n_batches: int) -> list:
+    """
+    split tasks into batches of about the same cost (longest processing time first)
+    :param tasks: [(ins, az, values)], cost of a task is the length of its series
+    :param n_batches: maximal number of batches
+    :return: list of non-empty batches
+    """
+    n_batches = max(1, min(n_batches, len(tasks)))
+    heap = [(0, i) for i in range(n_batches)]
+    batches = [[] for _ in range(n_batches)]
+    for task in sorted(tasks, key=lambda t: len(t[2]), reverse=True):
+        cost, i = heapq.heappop(heap)
+        batches[i].append(task)
+        heapq.heappush(heap, (cost + len(task[2]), i))
+    return [batch for batch in batches if batch]
+
+
+class ForecastEngine:
+    def __init__(self, workers: int = None, config: rdf.ModelConfig = None,
+                 batches_per_worker: int = 4, store=None):
+        """
+        init
+        :param workers: number of worker processes, defaults to the cpu count,
+                        0 or 1 predicts serially in the calling thread
+        :param config: model settings
+        :param batches_per_worker: batches submitted per worker and predict call
+        :param store: model_store.ModelStore, series with a stored prediction are not trained
+        """
+        self.workers = os.cpu_count() if workers is None else workers
+        self.config = config or rdf.ModelConfig()
+        self.batches_per_worker = batches_per_worker
+        self.store = store
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self.workers <= 1:
+            return None
+        with self._lock:
+            if self._executor is None:
+                try:
+                    # spawn, the engine is shared by the scoring threads and forking them is unsafe
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                except (OSError, NotImplementedError) as e:
+                    logger.warning(f'Process pool unavailable, predicting serially: {e}')
+                    self.workers = 0
+            return self._executor
+
+    def predict(self, ins_dict: dict, region: str = None, system: str = None) -> dict:
+        """
+        same as random_forest.get_predicted_price
+        :param ins_dict: InstanceType -> DataFrame of daily prices by az
+        :return: InstanceType -> AvailabilityZone -> predicted price
+        """
+        ins_pred, tasks = rdf.split_series(ins_dict)
+        if self.store:
+            results = self.store.predict(tasks, self._run, self.config, region, system)
+        else:
+            results = self._run(tasks)
+        return rdf.fill_predictions(ins_pred, ins_dict, results)
+
+    def _run(self, tasks: list) -> list:
+        if not tasks:
+            return []
+        # one model per series, counted here as the workers do not share the run metrics
+        metrics.add('model_fits', len(tasks))
+        executor = self._get_executor()
+        if executor is None:
+            return rdf.predict_batch(tasks, self.config)
+
+        batches = make_batches(tasks, self.workers * self.batches_per_worker)
+        futures = [executor.submit(rdf.predict_batch, batch, self.config) for batch in batches]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""history_cache.py
+
+    Run scoped cache of parsed spot price history frames and price
+    statistics, so that scoring reuses what the update stage of the same
+    region/system has just read or written instead of downloading and
+    parsing the same objects again.
+
+        ('history', storage, region, system, year)  (start, frame), frame holds the records from start on
+        ('statistics', region, system)              price_statistics.SpotPriceStatistics
+
+    Entries are evicted least recently used first above max_bytes (memory
+    of the frames). Hits, misses and the bytes served from the cache are
+    logged, and added to the run metrics (history_cache_hits,
+    history_cache_misses, history_cache_bytes_saved).
+    Like the run metrics, the cache of the current run is module level,
+    see start_run; until a run is started the cache is disabled.
+
+    Classes:
+        HistoryCache
+
+    Functions:
+        get_cache
+        start_run
+
+"""
+import logging
+import threading
+import pandas as pd
+from collections import OrderedDict
+from spot_market_scoring import metrics
+from spot_market_scoring import history_storage as hs
+
+logger = logging.getLogger(__name__)
+
+
+def get_size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class HistoryCache:
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        """
+        init
+        :param max_bytes: memory of the cached frames, least recently used entries are evicted above it
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        """
+        :return: the cached value, None if missing
+        """
+        if not self.max_bytes:
+            return None
+        with self._lock:
+            return self._lookup(key, self._entries.get(key))
+
+    def _lookup(self, key: tuple, entry):
+        if entry is None:
+            self.misses += 1
+            metrics.add('history_cache_misses')
+            logger.debug(f'history cache miss: {key}')
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.bytes_saved += entry[1]
+        metrics.add('history_cache_hits')
+        metrics.add('history_cache_bytes_saved', entry[1])
+        logger.debug(f'history cache hit: {key}, {entry[1] / 2 ** 20:.1f}MB')
+        return entry[0]
+
+    def put(self, key: tuple, value, size: int):
+        """
+        :param size: bytes of the value, values larger than max_bytes are not cached
+        """
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def discard(self, key: tuple):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def get_history(self, storage: str, region: str, system: str, year: int, start=None) -> pd.DataFrame:
+        """
+        cached records of region/system/year from start on
+        :param storage: name of the history storage
+        :return: None if missing or if the cached frame starts after start
+        """
+        if not self.max_bytes:
+            return None
+        key = ('history', storage, region, system, year)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0][0] is not None:
+                # a frame read from a later start does not hold the requested records
+                if start is None or hs._utc(start) < entry[0][0]:
+                    entry = None
+            value = self._lookup(key, entry)
+        return None if value is None else hs._filter(value[1], start=start)
+
+    def put_history(self, storage: str, region: str, system: str, year: int, df: pd.DataFrame, start=None):
+        """
+        :param df: records of region/system/year from start on, the whole year if start is None,
+                   copied as the caller may modify it
+        """
+        size = get_size(df)
+        if size > self.max_bytes:
+            return
+        start = None if start is None else hs._utc(start)
+        self.put(('history', storage, region, system, year), (start, df.copy()), size)
+
+    def add_history(self, storage: str, region: str, system: str, year: int, records: pd.DataFrame):
+        """
+        merge new records into the cached frame of region/system/year, if any
+        """
+        key = ('history', storage, region, system, year)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            start, df = entry[0]
+            self.put_history(storage, region, system, year, hs.merge_history(df, records), start)
+
+    def get_statistics(self, region: str, system: str):
+        return self.get(('statistics', region, system))
+
+    def put_statistics(self, region: str, system: str, stats):
+        self.put(('statistics', region, system), stats, get_size(stats.days))
+
+    def log_stats(self, prefix: str = ''):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        logger.info(f'{prefix}history cache hits: {self.hits}, misses: {self.misses}, '
+                    f'hit ratio: {ratio:.2%}, saved: {self.bytes_saved / 2 ** 20:.1f}MB, '
+                    f'evictions: {self.evictions}, size: {self.size / 2 ** 20:.1f}MB')
+
+
+_current = HistoryCache(max_bytes=0)
+
+
+def get_cache() -> HistoryCache:
+    return _current
+
+
+def start_run(max_bytes: int = 256 * 2 ** 20) -> HistoryCache:
+    """
+    start a new run with an empty cache, the functions using get_cache share it
+    """
+    global _current
+    _current = HistoryCache(max_bytes)
+    return _current
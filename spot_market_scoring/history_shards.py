@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""history_shards.py
+
+    Sharded fetch of the spot price history of a large region/system.
+    With one task per region/system, us-east-1 Linux (most instance types
+    and availability zones) is the straggler of the fetch. Its days_back
+    window is split into time windows (utils.approx_bisect of the hours),
+    fetched in parallel and merged into the frame of an unsharded fetch.
+
+    Time windows rather than instance type groups or availability zones:
+    describe_spot_price_history has no filter for "the other instance
+    types", shards by the instance types of an earlier run would miss the
+    new ones, the windows cover every record.
+
+    The number of shards comes from the records per day of the earlier
+    runs, stored with the instance list in aws_data.ec2_spot_instances
+    (spot_price_history.write_spot_price_history): one shard per
+    SHARD_RECORDS expected records, at most MAX_SHARDS. The first run of a
+    region/system is not sharded.
+
+    Functions:
+        set_shard_size
+        get_records_per_day
+        get_shard_count
+        get_windows
+        merge_shards
+
+"""
+import math
+import logging
+import pandas as pd
+from datetime import datetime, timezone, timedelta
+from spot_market_scoring.utils import approx_bisect
+from spot_market_scoring import history_loader as hl
+
+logger = logging.getLogger(__name__)
+
+# expected records per shard, 0 disables sharding
+SHARD_RECORDS = 20000
+MAX_SHARDS = 8
+RECORDS_FIELD = 'RecordsPerDay'
+
+
+def set_shard_size(shard_records: int, max_shards: int = None):
+    """
+    records per shard (0 disables sharding) and the maximum shards of a region/system
+    """
+    global SHARD_RECORDS, MAX_SHARDS
+    SHARD_RECORDS = max(int(shard_records), 0)
+    if max_shards is not None:
+        MAX_SHARDS = max(int(max_shards), 1)
+
+
+def get_records_per_day(dbclient, region: str, system: str) -> float:
+    """
+    records per day fetched by the last run, None if unknown
+    """
+    try:
+        doc = dbclient['aws_data'].ec2_spot_instances.find_one({'region': region, 'system': system},
+                                                               {RECORDS_FIELD: 1})
+    except Exception as e:
+        logger.error(f'[ERR] {region} {system}: {e}')
+        return None
+    return (doc or {}).get(RECORDS_FIELD)
+
+
+def get_shard_count(dbclient, region: str, system: str, days_back: int) -> int:
+    """
+    shards of the fetch of days_back days, 1 without records per day of an earlier run
+    """
+    records_per_day = get_records_per_day(dbclient, region, system) if SHARD_RECORDS else None
+    if not records_per_day:
+        return 1
+    shards = max(1, min(MAX_SHARDS, math.ceil(records_per_day * days_back / SHARD_RECORDS)))
+    if shards > 1:
+        logger.info(f'{region} {system}: {shards} shards of about {records_per_day * days_back / shards:.0f} records')
+    return shards
+
+
+def get_windows(days_back: int, shards: int, now: datetime = None) -> list:
+    """
+    consecutive (StartTime, EndTime) windows of the last days_back days, the last one without EndTime
+    """
+    now = now or datetime.now(timezone.utc)
+    start = now - timedelta(hours=24 * days_back)
+    hours = approx_bisect(list(range(int(24 * days_back))), shards)
+    if len(hours) <= 1:
+        return [(start, None)]
+    return [(start + timedelta(hours=group[0]),
+             start + timedelta(hours=group[-1] + 1) if i < len(hours) - 1 else None)
+            for i, group in enumerate(hours)]
+
+
+def merge_shards(frames: list) -> pd.DataFrame:
+    """
+    records of the shards as one frame, whatever order the shards finished in: records repeated in
+    two windows (AWS returns the price in effect at StartTime) are kept once, and sorted newest first
+    """
+    df = hl.concat_history(frames).drop_duplicates()
+    return df.sort_values(['Timestamp', 'AvailabilityZone', 'InstanceType', 'ProductDescription'],
+                          ascending=[False, True, True, True], kind='mergesort').reset_index(drop=True)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""history_storage.py
+
+    Storage formats of the spot price history on s3.
+
+    csv:     one object per region/system/year, prices written as strings,
+             the whole year is downloaded and parsed by every read
+             ec2/spot_price_history/Region=../ProductDescription=../2021.csv
+    parquet: one object per region/system/month (or day), typed columns,
+             rows sorted by instance type/az/time in row groups, so that reads
+             only fetch the partitions of the requested period and skip row
+             groups with pyarrow filters on Timestamp/InstanceType
+             ec2/spot_price_history_parquet/Region=../ProductDescription=../Date=2021-07/part-0.parquet
+
+    Both have read(period, instance types) and update(new records); parquet
+    needs pyarrow. Frames are read and returned with the schema of
+    history_loader (categorical strings, float prices, utc timestamps).
+
+    DeltaHistoryStorage wraps either of them: daily updates only write the new
+    records as a small delta object, reads merge the base with the deltas,
+    and compact() merges the deltas into the base and deletes them.
+             ec2/spot_price_history_delta/Region=../ProductDescription=../Year=2021/20210701T000000000000-ab12cd34.csv
+
+    Classes:
+        CSVHistoryStorage
+        ParquetHistoryStorage
+        DeltaHistoryStorage
+
+    Functions:
+        is_missing
+        get_history_storage
+        migrate_csv_to_parquet
+
+"""
+import io
+import uuid
+import logging
+import pandas as pd
+from spot_market_scoring.utils import ParquetTranscoder
+from spot_market_scoring.history_loader import COLUMNS, load_history, read_csv, concat_history
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+BUCKET = 'stompy-aws-dataset'
+SORT_KEYS = ['InstanceType', 'AvailabilityZone', 'Timestamp']
+
+
+def merge_history(prev_df: pd.DataFrame, records: pd.DataFrame) -> pd.DataFrame:
+    """
+    stored history plus new records, sorted and without duplicates
+    :param prev_df: stored history, None if nothing is stored
+    """
+    df = concat_history([prev_df, load_history(records, name='records')])
+    df.sort_values(SORT_KEYS, inplace=True)
+    df.drop_duplicates(inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def _filter(df: pd.DataFrame, start=None, end=None, instance_types: list = None) -> pd.DataFrame:
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df['Timestamp'] >= pd.Timestamp(start)
+    if end is not None:
+        mask &= df['Timestamp'] < pd.Timestamp(end)
+    if instance_types is not None:
+        mask &= df['InstanceType'].isin(instance_types)
+    if mask.all():
+        return df.reset_index(drop=True)
+    return load_history(df.loc[mask].reset_index(drop=True), name='filter')
+
+
+def _utc(ts) -> pd.Timestamp:
+    ts = pd.Timestamp(ts)
+    return ts.tz_convert('UTC') if ts.tzinfo else ts.tz_localize('UTC')
+
+
+def is_missing(s3client, error: Exception) -> bool:
+    """
+    error of a get_object/head_object of a key that does not exist
+    """
+    missing = getattr(getattr(s3client, 'exceptions', None), 'NoSuchKey', None)
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return (missing is not None and isinstance(error, missing)) or code in ('NoSuchKey', '404')
+
+
+class CSVHistoryStorage:
+    name = 'csv'
+
+    @staticmethod
+    def get_key(region: str, system: str, year: int) -> str:
+        return (f'ec2/spot_price_history/Region={region}/'
+                f'ProductDescription={ParquetTranscoder.encode(system)}/'
+                f'{year}.csv')
+
+    def read_year(self, s3client, region: str, system: str, year: int = 2021) -> pd.DataFrame:
+        response = s3client.get_object(Bucket=BUCKET, Key=self.get_key(region, system, year))
+        return read_csv(response.get('Body'), name=f'{region} {system} {year}.csv')
+
+    def read(self, s3client, region: str, system: str, start=None, end=None,
+             instance_types: list = None, year: int = 2021) -> pd.DataFrame:
+        """
+        records of [start, end) of the instance types, the whole object is read
+        """
+        return _filter(self.read_year(s3client, region, system, year), start, end, instance_types)
+
+    def write(self, df: pd.DataFrame, s3client, region: str, system: str, year: int = 2021):
+        csv_buffer = io.StringIO()
+        df.astype({'SpotPrice': 'string'}).to_csv(csv_buffer, index=False)
+        s3client.put_object(Bucket=BUCKET, Key=self.get_key(region, system, year),
+                            Body=csv_buffer.getvalue())
+        return True
+
+    def update(self, records: pd.DataFrame, s3client, region: str, system: str,
+               year: int = 2021) -> pd.DataFrame:
+        """
+        merge new records into the stored year, raises if the year does not exist yet
+        :return: the stored history
+        """
+        df = merge_history(self.read_year(s3client, region, system, year), records)
+        self.write(df, s3client, region, system, year)
+        return df
+
+
+class ParquetHistoryStorage:
+    name = 'parquet'
+
+    GRANULARITY = {'month': ('MS', '%Y-%m'), 'day': ('D', '%Y-%m-%d')}
+
+    def __init__(self, granularity: str = 'month', prefix: str = 'ec2/spot_price_history_parquet',
+                 row_group_size: int = 20000, compression: str = 'snappy'):
+        """
+        init
+        :param granularity: 'month' or 'day', time span of a partition
+        :param row_group_size: rows per row group, the unit skipped by the filters
+        """
+        if pq is None:
+            raise ImportError('pyarrow is required for the parquet history storage')
+        if granularity not in self.GRANULARITY:
+            raise ValueError(f'granularity must be one of {list(self.GRANULARITY)}')
+        self.granularity = granularity
+        self.prefix = prefix
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    def get_key(self, region: str, system: str, partition: str) -> str:
+        return (f'{self.prefix}/Region={region}/'
+                f'ProductDescription={ParquetTranscoder.encode(system)}/'
+                f'Date={partition}/part-0.parquet')
+
+    def get_partition(self, timestamps: pd.Series) -> pd.Series:
+        return timestamps.dt.strftime(self.GRANULARITY[self.granularity][1])
+
+    def get_partitions(self, start, end) -> list:
+        """
+        partitions overlapping [start, end]
+        """
+        freq, fmt = self.GRANULARITY[self.granularity]
+        first = _utc(start).normalize()
+        if freq == 'MS':
+            first = first.replace(day=1)
+        return [p.strftime(fmt) for p in pd.date_range(first, _utc(end), freq=freq)]
+
+    def _read_partition(self, s3client, key: str, filters: list = None) -> pd.DataFrame:
+        try:
+            response = s3client.get_object(Bucket=BUCKET, Key=key)
+        except Exception as e:
+            if is_missing(s3client, e):
+                return None
+            raise
+        table = pq.read_table(pa.BufferReader(response['Body'].read()), filters=filters or None)
+        return load_history(table.to_pandas(), name=key)
+
+    def read(self, s3client, region: str, system: str, start=None, end=None,
+             instance_types: list = None, year: int = None) -> pd.DataFrame:
+        """
+        records of [start, end) of the instance types, only overlapping partitions are downloaded
+        :param year: period if start is not given
+        """
+        now = pd.Timestamp.now(tz='UTC')
+        if start is None:
+            start = pd.Timestamp(year=year or now.year, month=1, day=1, tz='UTC')
+        start = _utc(start)
+        end = now if end is None else _utc(end)
+
+        filters = [('Timestamp', '>=', start), ('Timestamp', '<', end)]
+        if instance_types is not None:
+            filters.append(('InstanceType', 'in', list(instance_types)))
+        frames = [self._read_partition(s3client, self.get_key(region, system, p), filters)
+                  for p in self.get_partitions(start, end)]
+        frames = [f for f in frames if f is not None]
+        if not frames:
+            return load_history(None)
+        return concat_history(frames)
+
+    def _write_partition(self, df: pd.DataFrame, s3client, key: str):
+        table = pa.Table.from_pandas(df[COLUMNS], preserve_index=False)
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, row_group_size=self.row_group_size, compression=self.compression)
+        s3client.put_object(Bucket=BUCKET, Key=key, Body=buffer.getvalue())
+
+    def write(self, df: pd.DataFrame, s3client, region: str, system: str, year: int = None):
+        """
+        replace the partitions of the records in df
+        """
+        df = load_history(df).sort_values(SORT_KEYS)
+        for partition, p_df in df.groupby(self.get_partition(df['Timestamp'])):
+            self._write_partition(p_df, s3client, self.get_key(region, system, partition))
+        return True
+
+    def update(self, records: pd.DataFrame, s3client, region: str, system: str,
+               year: int = None) -> pd.DataFrame:
+        """
+        merge new records into their partitions, other partitions are not touched
+        :return: the stored history of the updated partitions
+        """
+        records = load_history(records, name='records')
+        merged = []
+        for partition, p_records in records.groupby(self.get_partition(records['Timestamp'])):
+            key = self.get_key(region, system, partition)
+            df = merge_history(self._read_partition(s3client, key), p_records)
+            self._write_partition(df, s3client, key)
+            merged.append(df)
+        if not merged:
+            return records
+        return concat_history(merged)
+
+
+class DeltaHistoryStorage:
+    def __init__(self, base=None, prefix: str = 'ec2/spot_price_history_delta', max_deltas: int = 7):
+        """
+        init
+        :param base: CSVHistoryStorage (default) or ParquetHistoryStorage holding the compacted history
+        :param max_deltas: deltas kept before compact_if_needed merges them into the base
+        """
+        self.base = base or CSVHistoryStorage()
+        self.name = f'{self.base.name}+delta'
+        self.prefix = prefix
+        self.max_deltas = max_deltas
+
+    def get_prefix(self, region: str, system: str, year: int) -> str:
+        return (f'{self.prefix}/Region={region}/'
+                f'ProductDescription={ParquetTranscoder.encode(system)}/'
+                f'Year={year}/')
+
+    def list_deltas(self, s3client, region: str, system: str, year: int = 2021) -> list:
+        """
+        delta keys, oldest first
+        """
+        keys, kwargs = [], {'Bucket': BUCKET, 'Prefix': self.get_prefix(region, system, year)}
+        while True:
+            response = s3client.list_objects_v2(**kwargs)
+            keys.extend(c['Key'] for c in response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+        return sorted(keys)
+
+    def read_deltas(self, s3client, keys: list) -> pd.DataFrame:
+        frames = [read_csv(s3client.get_object(Bucket=BUCKET, Key=key)['Body'], name=key) for key in keys]
+        return concat_history(frames) if frames else None
+
+    def read(self, s3client, region: str, system: str, start=None, end=None,
+             instance_types: list = None, year: int = 2021) -> pd.DataFrame:
+        """
+        base records merged with the deltas not compacted yet
+        """
+        try:
+            df = self.base.read(s3client, region, system, start, end, instance_types, year)
+        except Exception as e:
+            if not is_missing(s3client, e):
+                raise
+            df = None
+        deltas = self.read_deltas(s3client, self.list_deltas(s3client, region, system, year))
+        if deltas is None:
+            if df is None:
+                raise KeyError(f'no spot price history stored for {region} {system} {year}')
+            return df
+        return merge_history(df, _filter(deltas, start, end, instance_types))
+
+    def write(self, df: pd.DataFrame, s3client, region: str, system: str, year: int = 2021):
+        """
+        write df to the base directly
+        """
+        return self.base.write(df, s3client, region, system, year)
+
+    def update(self, records: pd.DataFrame, s3client, region: str, system: str,
+               year: int = 2021) -> pd.DataFrame:
+        """
+        store new records as a delta, nothing stored is read or rewritten
+        :return: the new records
+        """
+        records = load_history(records, name='records')
+        if records.empty:
+            return records
+        key = (self.get_prefix(region, system, year) +
+               f'{pd.Timestamp.now(tz="UTC"):%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}.csv')
+        csv_buffer = io.StringIO()
+        records.to_csv(csv_buffer, index=False)
+        s3client.put_object(Bucket=BUCKET, Key=key, Body=csv_buffer.getvalue())
+        return records
+
+    def compact(self, s3client, region: str, system: str, year: int = 2021, min_deltas: int = 1) -> int:
+        """
+        merge the deltas into the base and delete them, deltas written meanwhile are kept
+        :param min_deltas: do nothing below this number of deltas
+        :return: number of deltas compacted
+        """
+        keys = self.list_deltas(s3client, region, system, year)
+        if not keys or len(keys) < min_deltas:
+            return 0
+        deltas = self.read_deltas(s3client, keys)
+        try:
+            self.base.update(deltas, s3client, region, system, year)
+        except Exception as e:
+            if not is_missing(s3client, e):
+                raise
+            self.base.write(merge_history(None, deltas), s3client, region, system, year)
+        # the merged view is the same before and after each delete, records are deduplicated
+        for key in keys:
+            s3client.delete_object(Bucket=BUCKET, Key=key)
+        logger.info(f'{region} {system} {year}: {len(keys)} deltas, {len(deltas)} records compacted')
+        return len(keys)
+
+    def compact_if_needed(self, s3client, region: str, system: str, year: int = 2021) -> int:
+        return self.compact(s3client, region, system, year, min_deltas=self.max_deltas)
+
+
+def get_history_storage(name: str = 'csv', deltas: bool = False, max_deltas: int = 7, **kwargs):
+    """
+    :param name: 'csv' or 'parquet'
+    :param deltas: wrap the storage in DeltaHistoryStorage
+    :param kwargs: ParquetHistoryStorage settings
+    """
+    if name == 'csv':
+        storage = CSVHistoryStorage()
+    elif name == 'parquet':
+        storage = ParquetHistoryStorage(**kwargs)
+    else:
+        raise ValueError(f'unknown history storage {name}')
+    return DeltaHistoryStorage(storage, max_deltas=max_deltas) if deltas else storage
+
+
+def migrate_csv_to_parquet(s3client, region: str, system: str, year: int,
+                           parquet: ParquetHistoryStorage = None, verify: bool = True) -> int:
+    """
+    copy a csv year object into parquet partitions, the csv object is kept
+    :return: number of records migrated
+    """
+    parquet = parquet or ParquetHistoryStorage()
+    df = CSVHistoryStorage().read_year(s3client, region, system, year)
+    df.sort_values(SORT_KEYS, inplace=True)
+    df.drop_duplicates(inplace=True)
+    parquet.write(df, s3client, region, system)
+
+    if verify and not df.empty:
+        start, end = df['Timestamp'].min(), df['Timestamp'].max() + pd.Timedelta(seconds=1)
+        migrated = parquet.read(s3client, region, system, start=start, end=end)
+        if len(migrated) < len(df):
+            raise ValueError(f'{region} {system} {year}: {len(df)} csv records, {len(migrated)} in parquet')
+    logger.info(f'{region} {system} {year}: {len(df)} records migrated to parquet')
+    return len(df)
@@ -51,6 +51,13 @@ AVAILABILITY_ZONE_MAP = {
 }
 
 
+# time windows to calculate mean/std of spot prices by, in days
+PERIOD_MAP = {'Day': 1,
+              'Week': 7,
+              '2 Weeks': 14,
+              'Month': 30,
+              '3 Months': 90}
+
 SYSTEM_LIST = ['Linux/UNIX (Amazon VPC)', 'SUSE Linux (Amazon VPC)',
                'Red Hat Enterprise Linux (Amazon VPC)', 'Windows (Amazon VPC)']
 SYSTEM_MAP = {
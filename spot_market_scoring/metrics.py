@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""metrics.py
+
+    Per stage and per (region, system) task metrics of the daily update job:
+    duration, rows fetched, AWS API calls (with the throttled ones and the
+    seconds waited for the rate limiter, see rate_limiter), S3 bytes
+    read/written, Mongo documents written with their bulk writes and
+    seconds (see mongo_writer), model fits, errors, the spot price history loaded
+    (rows, parse seconds, bytes in memory, see history_loader) and the
+    history cache hits, misses and bytes saved (see history_cache).
+
+    The current stage and task are context variables, ConcurrentTask copies
+    them into its thread, so counters added anywhere in a task are attributed
+    to its stage and (region, system). Stages may run concurrently, a stage's
+    duration is the span from its first start to its last finish.
+    Counters added outside of a task only count for the stage. AWS calls and
+    S3 bytes are counted with botocore event hooks, see instrument_client,
+    everything else is added where it happens.
+
+    The run is written as a json report and as a Prometheus textfile
+    (node_exporter textfile collector).
+
+    Classes:
+        RunMetrics
+
+    Functions:
+        get_metrics
+        start_run
+        stage
+        task
+        add
+        instrument_client
+
+"""
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ['rows_fetched', 'aws_calls', 'aws_throttles', 'aws_rate_limit_wait_seconds',
+            's3_bytes_read', 's3_bytes_written',
+            'mongo_documents_written', 'mongo_write_batches', 'mongo_write_seconds', 'model_fits', 'errors',
+            'history_rows_loaded', 'history_load_seconds', 'history_memory_bytes',
+            'history_cache_hits', 'history_cache_misses', 'history_cache_bytes_saved']
+
+PROMETHEUS_PREFIX = 'spot_market_scoring'
+
+_stage_name = contextvars.ContextVar('metrics_stage', default=None)
+_task_entry = contextvars.ContextVar('metrics_task', default=None)
+
+
+def _new_entry() -> dict:
+    entry = {'duration_s': 0.0}
+    entry.update((name, 0) for name in COUNTERS)
+    return entry
+
+
+class RunMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.stages = {}
+        self.tasks = {}
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        time a stage, exceptions are counted as errors and raised
+        """
+        start = time.perf_counter()
+        with self._lock:
+            entry = self.stages.setdefault(name, _new_entry())
+            span = self._spans.setdefault(name, [start, start])
+        token = _stage_name.set(name)
+        try:
+            yield entry
+        except Exception:
+            self.add('errors')
+            raise
+        finally:
+            _stage_name.reset(token)
+            end = time.perf_counter()
+            with self._lock:
+                span[1] = max(span[1], end)
+                entry['duration_s'] = span[1] - span[0]
+            logger.info(f'{name} time used: {end - start:.3f}')
+
+    @contextmanager
+    def task(self, region: str, system: str = None):
+        """
+        time a region/system task of the current stage
+        """
+        key = (_stage_name.get(), region, system)
+        with self._lock:
+            entry = self.tasks.setdefault(key, _new_entry())
+        token = _task_entry.set(entry)
+        start = time.perf_counter()
+        try:
+            yield entry
+        except Exception:
+            self.add('errors')
+            raise
+        finally:
+            end = time.perf_counter()
+            # the entry is shared by the task() calls of the same stage/region/system and read by report
+            with self._lock:
+                entry['duration_s'] += end - start
+            _task_entry.reset(token)
+
+    def add(self, name: str, value: int = 1):
+        """
+        add value to a counter of the current stage and task
+        """
+        if name not in COUNTERS:
+            raise ValueError(f'counter must be one of {COUNTERS}')
+        stage_name, task_entry = _stage_name.get(), _task_entry.get()
+        with self._lock:
+            if stage_name in self.stages:
+                self.stages[stage_name][name] += value
+            if task_entry is not None:
+                task_entry[name] += value
+
+    def finish(self):
+        self.finished = time.time()
+        return self
+
+    def report(self) -> dict:
+        with self._lock:
+            tasks = [{'stage': stage, 'region': region, 'system': system, **entry}
+                     for (stage, region, system), entry in self.tasks.items()]
+            stages = {name: dict(entry) for name, entry in self.stages.items()}
+        tasks.sort(key=lambda t: (t['stage'] or '', -t['duration_s']))
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'duration_s': (self.finished or time.time()) - self.started,
+            'stages': stages,
+            'tasks': tasks,
+        }
+
+    def write_json(self, path: str):
+        _atomic_write(path, json.dumps(self.report(), indent=2, default=str))
+
+    def write_prometheus(self, path: str):
+        """
+        gauges of the last run, the file is replaced atomically as the textfile collector requires
+        """
+        report = self.report()
+        lines = [f'# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge',
+                 f'{PROMETHEUS_PREFIX}_last_run_timestamp_seconds {report["finished"] or time.time():.3f}',
+                 f'# TYPE {PROMETHEUS_PREFIX}_run_duration_seconds gauge',
+                 f'{PROMETHEUS_PREFIX}_run_duration_seconds {report["duration_s"]:.3f}']
+        for level, entries in (('stage', [dict(entry, stage=name) for name, entry in report['stages'].items()]),
+                               ('task', report['tasks'])):
+            for field in ['duration_s'] + COUNTERS:
+                metric = f'{PROMETHEUS_PREFIX}_{level}_' + ('duration_seconds' if field == 'duration_s' else field)
+                lines.append(f'# TYPE {metric} gauge')
+                for entry in entries:
+                    labels = ','.join(f'{name}="{_escape(entry[name])}"'
+                                      for name in ('stage', 'region', 'system') if entry.get(name) is not None)
+                    lines.append(f'{metric}{{{labels}}} {entry[field]}')
+        _atomic_write(path, '\n'.join(lines) + '\n')
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _atomic_write(path: str, content: str):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+_current = RunMetrics()
+
+
+def get_metrics() -> RunMetrics:
+    return _current
+
+
+def start_run() -> RunMetrics:
+    """
+    start collecting a new run, the module functions below record into it
+    """
+    global _current
+    _current = RunMetrics()
+    return _current
+
+
+def stage(name: str):
+    return _current.stage(name)
+
+
+def task(region: str, system: str = None):
+    return _current.task(region, system)
+
+
+def add(name: str, value: int = 1):
+    _current.add(name, value)
+
+
+def _before_call(model=None, params=None, **kwargs):
+    add('aws_calls')
+    if model is not None and model.name == 'PutObject':
+        body = (params or {}).get('Body')
+        if isinstance(body, str):
+            add('s3_bytes_written', len(body.encode()))
+        elif hasattr(body, '__len__'):
+            add('s3_bytes_written', len(body))
+
+
+def _after_call(model=None, parsed=None, **kwargs):
+    if model is not None and model.name == 'GetObject':
+        add('s3_bytes_read', (parsed or {}).get('ContentLength') or 0)
+
+
+def instrument_client(client):
+    """
+    count the api calls of a boto3 client, and the object sizes of an s3 client
+    """
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        logger.warning(f'{type(client).__name__} has no event hooks, api calls are not counted')
+        return client
+    events.register('before-call', _before_call, unique_id='spot-market-scoring-metrics-before')
+    events.register('after-call', _after_call, unique_id='spot-market-scoring-metrics-after')
+    return client
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""model_store.py
+
+    On-disk store of predicted spot prices, keyed by the fingerprint of the
+    training window. Most spot prices do not change for days, a series whose
+    training window and model settings are unchanged since the last run
+    skips training entirely. The store is kept between the scheduled runs by
+    the workflow cache (.github/workflows/Scoring.yml).
+
+    With stable_keys (opt-in) the key is the set of distinct lagged rows
+    instead of the exact window: a stored prediction is reused while the
+    window slides over unchanged prices, although the forest fitted on the
+    new window (row counts and order) may predict a slightly different price.
+
+    Classes:
+        ModelStore
+
+"""
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStore:
+    def __init__(self, path: str, max_entries: int = 200000, stable_keys: bool = False):
+        """
+        init
+        :param path: sqlite file, created if it does not exist
+        :param max_entries: least recently used predictions are evicted above this size
+        :param stable_keys: key predictions on the distinct lagged rows instead of the exact window, see fingerprint
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.stable_keys = stable_keys
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                               'key TEXT PRIMARY KEY, region TEXT, system TEXT, '
+                               'instance_type TEXT, availability_zone TEXT, '
+                               'price REAL, last_used REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_used '
+                               'ON predictions (last_used)')
+
+    @staticmethod
+    def fingerprint(region: str, system: str, instance_type: str, availability_zone: str,
+                    values, config, stable: bool = False) -> str:
+        """
+        key of a prediction: the exact training window and the model settings
+        :param values: training window, prices of the series without missing values
+        :param config: random_forest.ModelConfig
+        :param stable: approximate key, the distinct lagged rows the model is fitted on and the input row
+                       of the prediction. The raw window slides by a day every run and never repeats, the
+                       distinct rows of a series whose price did not change on the added and the dropped
+                       day do. Counts and order of the rows are ignored, the prediction may be stale.
+        """
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        digest = hashlib.sha1()
+        digest.update(f'{region}|{system}|{instance_type}|{availability_zone}|'
+                      f'{config.fingerprint()}|'.encode())
+        n_in = config.n_in
+        if not stable or len(values) <= n_in:
+            digest.update(values.tobytes())
+            return digest.hexdigest()
+        # rows (t-n_in, ..., t-1, t) of random_forest.series_to_supervised, in a fixed order
+        rows = np.stack([values[i:len(values) - n_in + i] for i in range(n_in + 1)], axis=1)
+        digest.update(np.ascontiguousarray(np.unique(rows, axis=0)).tobytes())
+        digest.update(values[-n_in:].tobytes())
+        return digest.hexdigest()
+
+    def get_many(self, keys: list) -> dict:
+        """
+        :return: key -> price for the keys found in the store
+        """
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                cursor = self._conn.execute(
+                    f'SELECT key, price FROM predictions WHERE key IN ({",".join("?" * len(batch))})', batch)
+                found.update(cursor.fetchall())
+            if found:
+                now = time.time()
+                with self._conn:
+                    self._conn.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                           [(now, key) for key in found])
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries: list):
+        """
+        :param entries: [(key, region, system, instance_type, availability_zone, price)]
+        """
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                       [(*entry, now) for entry in entries])
+                self._evict()
+
+    def _evict(self):
+        size = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        excess = size - self.max_entries
+        if excess > 0:
+            self._conn.execute('DELETE FROM predictions WHERE key IN '
+                               '(SELECT key FROM predictions ORDER BY last_used LIMIT ?)', (excess,))
+            self.evictions += excess
+
+    def predict(self, tasks: list, run, config, region: str = None, system: str = None) -> list:
+        """
+        predict tasks, only series without a stored prediction are passed to run
+        :param tasks: [(ins, az, values)], see random_forest.split_series
+        :param run: callable(tasks) -> [(ins, az, price, error)], see random_forest.predict_batch
+        :param config: random_forest.ModelConfig used by run
+        :return: [(ins, az, price, error)]
+        """
+        keys = {(ins, az): self.fingerprint(region, system, ins, az, values, config, self.stable_keys)
+                for ins, az, values in tasks}
+        found = self.get_many(list(keys.values()))
+        results = [(ins, az, found[keys[(ins, az)]], None)
+                   for ins, az, _ in tasks if keys[(ins, az)] in found]
+        missed = [task for task in tasks if keys[(task[0], task[1])] not in found]
+
+        new_results = run(missed) if missed else []
+        self.put_many([(keys[(ins, az)], region, system, ins, az, price)
+                       for ins, az, price, error in new_results if error is None])
+        logger.info(f'{region} {system} model store hits: {len(results)}, misses: {len(missed)}')
+        return results + new_results
+
+    def log_stats(self, prefix: str = ''):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        logger.info(f'{prefix}model store hits: {self.hits}, misses: {self.misses}, '
+                    f'hit ratio: {ratio:.2%}, evictions: {self.evictions}')
+
+    def close(self):
+        self.log_stats()
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
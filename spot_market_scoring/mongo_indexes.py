@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""mongo_indexes.py
+
+    Compound indexes required by the Mongo read paths, and a query plan
+    check of those reads. INDEXES declares the index keys per collection,
+    ensure_indexes creates the missing ones and leaves existing indexes
+    alone, so it runs at every start. QUERIES holds one filter of every
+    read path (same fields and operators, sample values);
+    check_query_plans explains them and reports the ones whose winning
+    plan scans the whole collection.
+
+        spot_market_scores.scores              read_from_mongo, score_publisher
+        spot_market_scores.spot_instance_list  spot_price_history.get_spot_instance_list
+        spot_market_scores.spot_advisor        spot_advisor.read_from_mongo
+        spot-market-scores.spot_instance_list  mongo_utils.get_spot_instance_list
+        spot-market-scores.spot_price_history  spot_price_history.read_from_mongo
+        aws_data.ec2_spot_instances            pricing.update_instance_list_by_family
+        aws_data.pricing_product               pricing.update_instance_list_by_family,
+                                               update_ondemand_price_helper (delete)
+        aws_data.ec2_instance_type             ec2.update_prod_info, update_instance_types
+        product_info.instance_types            ec2.update_prod_info (upsert)
+        product_info.spot_types                pricing.update_instance_list_by_family (upsert)
+
+    Functions:
+        get_index_name
+        ensure_indexes
+        check_query_plans
+
+"""
+import logging
+from spot_market_scoring import metrics
+from spot_market_scoring.mappings import SYSTEM_LIST
+
+logger = logging.getLogger(__name__)
+
+# (database, collection, keys)
+INDEXES = [
+    ('spot_market_scores', 'scores', [('Region', 1), ('System', 1), ('InstanceType', 1), ('AvailabilityZone', 1)]),
+    ('spot_market_scores', 'spot_instance_list', [('region', 1), ('system', 1)]),
+    ('spot_market_scores', 'spot_advisor', [('date', 1)]),
+    ('spot-market-scores', 'spot_instance_list', [('region', 1), ('system', 1)]),
+    ('spot-market-scores', 'spot_price_history', [('region', 1), ('system', 1), ('year', 1)]),
+    ('aws_data', 'ec2_spot_instances', [('region', 1), ('system', 1)]),
+    ('aws_data', 'pricing_product', [('location', 1), ('operatingSystem', 1), ('instanceType', 1)]),
+    ('aws_data', 'ec2_instance_type', [('region', 1)]),
+    ('product_info', 'instance_types', [('Region', 1)]),
+    ('product_info', 'spot_types', [('Region', 1)]),
+]
+
+# (database, collection, filter) of every read path
+QUERIES = [
+    ('spot_market_scores', 'scores', {'Region': 'us-east-1', 'System': SYSTEM_LIST[0],
+                                      'AvailabilityZone': {'$in': ['us-east-1a']},
+                                      'InstanceType': {'$in': ['m5.large']}}),
+    ('spot_market_scores', 'scores', {'Region': 'us-east-1', 'System': SYSTEM_LIST[0]}),
+    ('spot_market_scores', 'scores', {'Region': 'us-east-1'}),
+    ('spot_market_scores', 'scores', {'System': SYSTEM_LIST[0], 'Region': {'$in': ['us-east-1']}}),
+    ('spot_market_scores', 'spot_instance_list', {'region': 'us-east-1', 'system': SYSTEM_LIST[0]}),
+    ('spot_market_scores', 'spot_advisor', {'date': '2021-07-01'}),
+    ('spot-market-scores', 'spot_instance_list', {'region': 'us-east-1', 'system': SYSTEM_LIST[0]}),
+    ('spot-market-scores', 'spot_price_history', {'region': 'us-east-1', 'system': SYSTEM_LIST[0], 'year': 2021}),
+    ('aws_data', 'ec2_spot_instances', {'region': 'us-east-1', 'system': SYSTEM_LIST[0]}),
+    ('aws_data', 'pricing_product', {'location': 'US East (N. Virginia)', 'operatingSystem': 'Linux',
+                                     'instanceType': {'$in': ['m5.large']}}),
+    ('aws_data', 'pricing_product', {'location': 'US East (N. Virginia)', 'operatingSystem': 'Linux'}),
+    ('aws_data', 'ec2_instance_type', {'region': 'us-east-1'}),
+    ('product_info', 'instance_types', {'Region': 'us-east-1'}),
+    ('product_info', 'spot_types', {'Region': 'us-east-1'}),
+]
+
+
+def get_index_name(keys: list) -> str:
+    """
+    name Mongo gives an index of keys by default, e.g. Region_1_System_1
+    """
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+def ensure_indexes(dbclient, indexes: list = None) -> list:
+    """
+    create the declared indexes that do not exist yet, an index with the same keys counts whatever its name
+    :param indexes: [(database, collection, keys)], defaults to INDEXES
+    :return: names of the created indexes
+    """
+    created = []
+    for database, name, keys in indexes or INDEXES:
+        collection = dbclient[database][name]
+        try:
+            existing = [[tuple(k) for k in spec['key']] for spec in collection.index_information().values()]
+            if [tuple(k) for k in keys] in existing:
+                continue
+            created.append(collection.create_index(keys, name=get_index_name(keys), background=True))
+            logger.info(f'{database}.{name}: index {created[-1]} created')
+        except Exception as e:
+            metrics.add('errors')
+            logger.error(f'[ERR] {database}.{name}: index {get_index_name(keys)} not created: {e}')
+    return created
+
+
+def _get_stages(plan: dict) -> list:
+    """
+    stage names of a plan tree, e.g. ['FETCH', 'IXSCAN']
+    """
+    stages = [plan['stage']] if 'stage' in plan else []
+    for child in [plan.get('inputStage')] + list(plan.get('inputStages', [])):
+        if child:
+            stages.extend(_get_stages(child))
+    return stages
+
+
+def check_query_plans(dbclient, queries: list = None) -> list:
+    """
+    explain the read paths, collection scans are logged as warnings
+    :param queries: [(database, collection, filter)], defaults to QUERIES
+    :return: [(database, collection, filter, stages)] of the queries whose winning plan scans the collection
+    """
+    scans = []
+    for database, name, filter in queries or QUERIES:
+        try:
+            plan = dbclient[database][name].find(filter).explain()
+        except Exception as e:
+            logger.error(f'[ERR] {database}.{name} {filter}: explain failed: {e}')
+            continue
+        stages = _get_stages(plan.get('queryPlanner', {}).get('winningPlan', {}))
+        if 'COLLSCAN' in stages:
+            scans.append((database, name, filter, stages))
+            logger.warning(f'{database}.{name} {filter}: collection scan, plan {stages}')
+    return scans
@@ -1,5 +1,6 @@
 from pymongo import MongoClient
 from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring.mongo_writer import BulkWriter
 from spot_market_scoring.mappings import *
 
 def get_spot_instance_list(dbclient, region=None, system=None):
@@ -22,15 +23,16 @@ def get_spot_instance_list(dbclient, region=None, system=None):
 def update_spot_instance_list(s3client, dbclient):
     si = sph.get_spot_instance_list(s3client)
     db = dbclient['spot-market-scores']
-    db.spot_instance_list.remove({})
 
-    for region, region_dict in si.items():
-        for sys, sys_dict in si[region].items():
+    with BulkWriter(db.spot_instance_list) as writer:
+        writer.delete_many({})
+        for region, region_dict in si.items():
+            for sys, sys_dict in si[region].items():
 
-            db.spot_instance_list.insert_one({
-                "region": region,
-                "system": sys,
-                "instanceList": sys_dict})
+                writer.insert_one({
+                    "region": region,
+                    "system": sys,
+                    "instanceList": sys_dict})
 
 
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""mongo_writer.py
+
+    Batched Mongo writes. BulkWriter queues the inserts, updates and
+    replacements of a collection and sends them with one
+    bulk_write(ordered=False) per batch_size operations, instead of a round
+    trip per document. In an unordered batch the server applies operations
+    in any order and goes on past failed ones, so operations queued together
+    must not depend on each other; delete_many flushes the queue and runs
+    right away, for the usual delete then insert rewrite of a region/system.
+
+    Documents, batches and seconds of every flush are added to the run
+    metrics (mongo_documents_written, mongo_write_batches,
+    mongo_write_seconds), documents per second are logged with log_stats.
+    Failed writes are counted as errors, logged and raised by flush.
+
+    Classes:
+        BulkWriter
+
+    Functions:
+        set_batch_size
+
+"""
+import time
+import logging
+import threading
+from pymongo import InsertOne, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from spot_market_scoring import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def set_batch_size(batch_size: int):
+    """
+    default batch size of the writers created from now on
+    """
+    global BATCH_SIZE
+    BATCH_SIZE = max(int(batch_size), 1)
+
+
+class BulkWriter:
+    def __init__(self, collection, batch_size: int = None):
+        """
+        init
+        :param collection: pymongo collection
+        :param batch_size: operations per bulk_write, defaults to BATCH_SIZE
+        """
+        self.collection = collection
+        self.batch_size = batch_size or BATCH_SIZE
+        self.documents = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # operations queued by a failed task are dropped
+        if exc_type is None:
+            self.flush()
+        else:
+            with self._lock:
+                self._pending = []
+
+    def insert_one(self, document: dict):
+        self._add(InsertOne(document))
+
+    def insert_many(self, documents: list):
+        for document in documents:
+            self._add(InsertOne(document))
+
+    def update_one(self, filter: dict, update: dict, upsert: bool = False):
+        self._add(UpdateOne(filter, update, upsert=upsert))
+
+    def replace_one(self, filter: dict, replacement: dict, upsert: bool = False):
+        self._add(ReplaceOne(filter, replacement, upsert=upsert))
+
+    def delete_many(self, filter: dict):
+        """
+        flush the queued operations, then delete
+        """
+        self.flush()
+        return self.collection.delete_many(filter)
+
+    def _add(self, operation):
+        with self._lock:
+            self._pending.append(operation)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        write the queued operations with one bulk_write per batch
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for i in range(0, len(pending), self.batch_size):
+            self._write(pending[i:i + self.batch_size])
+
+    def _write(self, batch: list):
+        start = time.perf_counter()
+        written = len(batch)
+        try:
+            self.collection.bulk_write(batch, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            written -= len(errors)
+            metrics.add('errors', len(errors))
+            message = errors[0].get('errmsg') if errors else e
+            logger.error(f'[ERR] {self.collection.name}: {len(errors)} of {len(batch)} writes failed: {message}')
+            raise
+        except Exception as e:
+            # e.g. a network error or timeout, no write of the batch is known to be done
+            written = 0
+            metrics.add('errors')
+            logger.error(f'[ERR] {self.collection.name}: batch of {len(batch)} writes failed: {e}')
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.documents += written
+            self.batches += 1
+            self.seconds += seconds
+            metrics.add('mongo_documents_written', written)
+            metrics.add('mongo_write_batches')
+            metrics.add('mongo_write_seconds', seconds)
+            logger.debug(f'{self.collection.name}: {written} documents written in {seconds:.3f} seconds')
+
+    def log_stats(self, prefix: str = ''):
+        rate = self.documents / self.seconds if self.seconds else 0
+        logger.info(f'{prefix}{self.collection.name}: {self.documents} documents in {self.batches} batches, '
+                    f'{self.seconds:.3f} seconds, {rate:.0f} documents/s')
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""pipeline.py
+
+    Stages of the daily update and the artifacts they exchange:
+
+        update_instance_types           -> instance_types
+        update_prod_info                instance_types -> prod_info
+        update_ondemand_price           -> pricing_products, ondemand
+        update_spot_price_history/r/s   -> history/r/s (one stage per region/system)
+        update_spot_price_history       -> history/*/* (fetch='async', one stage for all)
+        update_instance_list_by_family  pricing_products, history/*/* -> instance_list
+        get_spot_advisor_data           -> spot_advisor
+        get_scores/r/s                  ondemand, spot_advisor, history/r/s -> scores/r/s
+        publish_scores                  scores/*/* -> scores (staged publish only)
+        compact_spot_price_history/r/s  scores/r/s -> compacted/r/s (delta storage only)
+
+    The pricing fetch and the spot price history fetch share no inputs and
+    run side by side; scoring of a region/system starts as soon as its own
+    history is updated and the on-demand prices and spot advisor are loaded.
+    With history_storage.DeltaHistoryStorage, the deltas of a region/system
+    are compacted after its scoring, in a small pool off the critical path.
+    With the staged publish (default), scores are written to a staging
+    collection and swapped in once all regions/systems are scored, see
+    score_publisher. The scoring of a region/system does not fail its
+    stage: sms.get_scores_helper logs and counts the error, and the
+    region/system keeps its previous scores in the publish. Only a failed
+    input of the scoring (ondemand, spot_advisor, its history) skips the
+    publish, and all previous scores stay. The on-demand prices come from
+    the pricing api, or from the Price List offer files with offer_files,
+    see price_list.
+    With fetch='async', the spot price histories of all regions/systems
+    are fetched by one stage on an event loop (see async_fetch): fewer
+    threads, more fetches in flight, but the scoring stages wait for all
+    of them.
+
+    Functions:
+        build_update_pipeline
+        run_update_pipeline
+
+"""
+import os
+import logging
+from spot_market_scoring import ec2, pricing, price_list, async_fetch
+from spot_market_scoring import spot_price_history as sph
+from spot_market_scoring import spot_market_scoring as sms
+from spot_market_scoring import spot_advisor as sa
+from spot_market_scoring.mappings import REGION_CODE_MAP, SYSTEM_LIST
+from spot_market_scoring.scheduler import Stage, StageScheduler
+from spot_market_scoring.score_publisher import ScorePublisher
+
+logger = logging.getLogger(__name__)
+
+# seconds measured for the sequential stages, only the relative sizes matter
+STAGE_COSTS = {
+    'update_instance_types': 305,
+    'update_prod_info': 9,
+    'update_ondemand_price': 957,
+    'update_instance_list_by_family': 265,
+    'update_spot_price_history': 1375,
+    'get_spot_advisor_data': 5,
+    'get_scores': 600,
+    'publish_scores': 5,
+    'compact_spot_price_history': 0,
+}
+
+FETCH_MODES = ['threads', 'async']
+
+DEFAULT_LIMITS = {
+    # same number of threads as the ThreadPoolExecutor of the sequential stages
+    'ec2': min(32, (os.cpu_count() or 1) + 4),
+    'scores': min(32, (os.cpu_count() or 1) + 4),
+    'pricing': 1,
+    'mongo': 2,
+    'compaction': 2,
+}
+
+
+def _get_ondemand(pricing_client, dbclient, offer_files: list = None) -> dict:
+    if offer_files:
+        price_list.update_ondemand_price(dbclient, offer_files)
+    else:
+        pricing.update_ondemand_price(pricing_client, dbclient)
+    ondemand = pricing.get_ondemand_price_list(dbclient)
+    ondemand.reset_index(drop=True, inplace=True)
+    return {'pricing_products': True, 'ondemand': ondemand}
+
+
+def build_update_pipeline(clients: dict, pricing_client, s3client, dbclient, forecaster=None,
+                          year: int = 2021, days_back: int = 5, regions: list = None,
+                          storage=None, publish: str = 'staged', offer_files: list = None,
+                          fetch: str = 'threads') -> list:
+    """
+    stages of the daily update
+    :param clients: region -> ec2 client
+    :param forecaster: passed to spot_market_scoring.get_scores_helper
+    :param storage: spot price history storage, see history_storage
+    :param regions: regions of the per region/system stages, defaults to all
+    :param publish: 'staged' or 'in_place', see score_publisher
+    :param offer_files: price list offer files (paths or urls) read for the on-demand prices instead of the
+                        pricing api, see price_list
+    :param fetch: 'threads', a stage per region/system, or 'async', one stage for all, see async_fetch
+    :return: [Stage]
+    """
+    if fetch not in FETCH_MODES:
+        raise ValueError(f'fetch must be one of {FETCH_MODES}')
+    regions = sorted(regions or REGION_CODE_MAP.keys())
+    # the staging collection is emptied here, before any scoring stage runs
+    publisher = ScorePublisher(dbclient).start() if publish == 'staged' else None
+    tasks = [(region, system) for system in SYSTEM_LIST for region in regions]
+    # the per region/system stages run in waves of DEFAULT_LIMITS threads
+    waves = len(tasks) / DEFAULT_LIMITS['ec2']
+
+    stages = [
+        Stage('update_instance_types', lambda _: ec2.update_instance_types(clients, dbclient),
+              outputs=['instance_types'], pool='ec2', cost=STAGE_COSTS['update_instance_types']),
+        Stage('update_prod_info', lambda _: ec2.update_prod_info(dbclient),
+              inputs=['instance_types'], outputs=['prod_info'], pool='mongo',
+              cost=STAGE_COSTS['update_prod_info']),
+        Stage('update_ondemand_price', lambda _: _get_ondemand(pricing_client, dbclient, offer_files),
+              outputs=['pricing_products', 'ondemand'], pool='pricing',
+              cost=STAGE_COSTS['update_ondemand_price']),
+        Stage('update_instance_list_by_family', lambda _: pricing.update_instance_list_by_family(dbclient),
+              inputs=['pricing_products'] + [f'history/{region}/{system}' for region, system in tasks],
+              outputs=['instance_list'], pool='mongo', cost=STAGE_COSTS['update_instance_list_by_family']),
+        Stage('get_spot_advisor_data', lambda _: sa.get_spot_advisor_data(dbclient=dbclient, local=False),
+              outputs=['spot_advisor'], cost=STAGE_COSTS['get_spot_advisor_data']),
+    ]
+
+    for region, system in tasks:
+        def update_history(_, region=region, system=system):
+            sph.update_spot_price_history(clients[region], s3client, dbclient, region, system, days_back, year,
+                                          storage=storage)
+
+        def get_scores(inputs, region=region, system=system):
+            return sms.get_scores_helper(inputs['ondemand'], inputs['spot_advisor'], region, system,
+                                         s3client, dbclient, forecaster=forecaster, storage=storage,
+                                         publisher=publisher)
+
+        if fetch == 'threads':
+            stages.append(Stage(f'update_spot_price_history/{region}/{system}', update_history,
+                                outputs=[f'history/{region}/{system}'], pool='ec2',
+                                group='update_spot_price_history',
+                                cost=STAGE_COSTS['update_spot_price_history'] / waves))
+        stages.append(Stage(f'get_scores/{region}/{system}', get_scores,
+                            inputs=['ondemand', 'spot_advisor', f'history/{region}/{system}'],
+                            outputs=[f'scores/{region}/{system}'], pool='scores', group='get_scores',
+                            cost=STAGE_COSTS['get_scores'] / waves))
+
+        if hasattr(storage, 'compact_if_needed'):
+            def compact_history(_, region=region, system=system):
+                return storage.compact_if_needed(s3client, region, system, year)
+
+            stages.append(Stage(f'compact_spot_price_history/{region}/{system}', compact_history,
+                                inputs=[f'scores/{region}/{system}'], outputs=[f'compacted/{region}/{system}'],
+                                pool='compaction', group='compact_spot_price_history',
+                                cost=STAGE_COSTS['compact_spot_price_history']))
+
+    if fetch == 'async':
+        def update_all_history(_):
+            async_fetch.update_spot_price_history_in_all_region(clients, year, days_back, s3client, dbclient,
+                                                                storage=storage, regions=regions)
+            return {}
+
+        stages.append(Stage('update_spot_price_history', update_all_history,
+                            outputs=[f'history/{region}/{system}' for region, system in tasks], pool='ec2',
+                            cost=STAGE_COSTS['update_spot_price_history']))
+
+    if publisher is not None:
+        stages.append(Stage('publish_scores', lambda _: publisher.publish(),
+                            inputs=[f'scores/{region}/{system}' for region, system in tasks],
+                            outputs=['scores'], pool='mongo', cost=STAGE_COSTS['publish_scores']))
+    return stages
+
+
+def run_update_pipeline(clients: dict, pricing_client, s3client, dbclient, forecaster=None,
+                        year: int = 2021, days_back: int = 5, regions: list = None,
+                        max_workers: int = 32, limits: dict = None, storage=None,
+                        publish: str = 'staged', offer_files: list = None,
+                        fetch: str = 'threads') -> StageScheduler:
+    """
+    run the daily update, see build_update_pipeline
+    :param max_workers: stages running at once, 1 runs them one after another
+    :param limits: pool -> concurrent stages, updates DEFAULT_LIMITS
+    :return: the scheduler, with artifacts, durations, failed and skipped stages
+    """
+    stages = build_update_pipeline(clients, pricing_client, s3client, dbclient, forecaster,
+                                   year, days_back, regions, storage, publish, offer_files, fetch)
+    scheduler = StageScheduler(stages, max_workers=max_workers, limits={**DEFAULT_LIMITS, **(limits or {})})
+    scheduler.run()
+    return scheduler
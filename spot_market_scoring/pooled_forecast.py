@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""pooled_forecast.py
+
+    One model per region/system instead of one per instance type and az.
+    All series of a region/system are turned into a single lag-feature matrix,
+    prices are scaled by the mean of their series so that cheap and expensive
+    instance types share the model, and instance family/size/az are encoded
+    as extra features.
+
+    Classes:
+        PooledForecaster
+
+    Helper Functions:
+        get_series_features
+        lag_matrix
+
+"""
+import logging
+import numpy as np
+import pandas as pd
+from spot_market_scoring import random_forest as rdf
+from spot_market_scoring import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def lag_matrix(values: np.ndarray, n_in: int) -> np.ndarray:
+    """
+    rows of n_in lagged values followed by the target value
+    """
+    n_rows = len(values) - n_in
+    if n_rows <= 0:
+        return np.empty((0, n_in + 1))
+    return np.stack([values[i:i + n_rows] for i in range(n_in + 1)], axis=1)
+
+
+def get_series_features(ins_dict: dict, region: str = None) -> pd.DataFrame:
+    """
+    one row per (instance, az) series with its categorical encodings
+    :return: DataFrame with InstanceType, AvailabilityZone, Family, Size, Zone codes
+    """
+    records = []
+    for ins, df in ins_dict.items():
+        family, _, size = ins.partition('.')
+        for az in df.columns:
+            zone = az[len(region):] if region and az.startswith(region) else az[-1:]
+            records.append((ins, az, family, size, zone))
+    series = pd.DataFrame(records, columns=['InstanceType', 'AvailabilityZone', 'Family', 'Size', 'Zone'])
+    for col in ['Family', 'Size', 'Zone']:
+        series[col] = pd.factorize(series[col])[0]
+    return series
+
+
+class PooledForecaster:
+    def __init__(self, config: rdf.ModelConfig = None):
+        """
+        init
+        :param config: model settings, n_in lags are used, validate is ignored
+        """
+        self.config = config or rdf.ModelConfig()
+
+    def predict(self, ins_dict: dict, region: str = None, system: str = None) -> dict:
+        """
+        same as random_forest.get_predicted_price, with one model for all series
+        :param ins_dict: InstanceType -> DataFrame of daily prices by az
+        :return: InstanceType -> AvailabilityZone -> predicted price
+        """
+        n_in = self.config.n_in
+        ins_pred, tasks = rdf.split_series(ins_dict)
+        series = get_series_features(ins_dict, region)
+
+        train_X, train_y, pred_X, pred_keys, pred_scales = [], [], [], [], []
+        modelled = {(ins, az) for ins, az, _ in tasks}
+        for row in series.itertuples(index=False):
+            values = ins_dict[row.InstanceType][row.AvailabilityZone].dropna().to_numpy(dtype='float64')
+            scale = values.mean() if len(values) else 0
+            if not scale > 0:
+                continue
+            values = values / scale
+            codes = [row.Family, row.Size, row.Zone, np.log(scale)]
+
+            lagged = lag_matrix(values, n_in)
+            train_X.append(np.hstack([lagged[:, :-1], np.tile(codes, (len(lagged), 1))]))
+            train_y.append(lagged[:, -1])
+            if (row.InstanceType, row.AvailabilityZone) in modelled and len(values) >= n_in:
+                pred_X.append(np.concatenate([values[-n_in:], codes]))
+                pred_keys.append((row.InstanceType, row.AvailabilityZone))
+                pred_scales.append(scale)
+
+        results = []
+        if pred_X:
+            try:
+                model = self.config.build_model()
+                model.fit(np.vstack(train_X), np.concatenate(train_y))
+                metrics.add('model_fits')
+                prices = model.predict(np.vstack(pred_X)) * np.asarray(pred_scales)
+                results = [(ins, az, price, None) for (ins, az), price in zip(pred_keys, prices)]
+            except Exception as e:
+                logger.error(f'[ERR] {region} {system} pooled model: {e}')
+
+        # series the pooled model could not predict use their last price
+        predicted = {(ins, az) for ins, az, _, _ in results}
+        results.extend((ins, az, None, 'not enough history for the pooled model')
+                       for ins, az, _ in tasks if (ins, az) not in predicted)
+        return rdf.fill_predictions(ins_pred, ins_dict, results)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""price_list.py
+
+    On-demand prices from the AWS Price List bulk offer files instead of
+    the pricing get_products api (pricing.update_ondemand_price), which
+    pages through every region/operating system one NextToken at a time
+    and decodes every PriceList string in full.
+
+    An offer file (index.json or index.csv, gzip compressed or not, local
+    or downloaded once into a cache directory) is read in one streaming
+    pass. Products are kept if they match the get_products filters of
+    pricing.PRODUCT_FILTERS, a region of REGION_MAP and an operating system
+    of OS_MAP, as the records of product_decoder. Of the terms, only the
+    OnDemand hourly prices of kept products are decoded; the rest of the
+    file is skipped one product or term at a time, so memory stays at the
+    kept products whatever the size of the file.
+
+    The results are written like the api mode: the product records to
+    aws_data.pricing_product per region/operating system, and the ondemand
+    table to spot_market_scores.ondemand.
+
+    OFFER_URL: regional EC2 offer files, {region} is replaced by every
+    region of REGION_CODE_MAP.
+
+    Functions:
+        get_offer_file
+        read_offer_file
+        update_ondemand_price
+
+"""
+import os
+import re
+import csv
+import gzip
+import json
+import time
+import hashlib
+import logging
+import requests
+from spot_market_scoring import metrics
+from spot_market_scoring.mappings import REGION_MAP, REGION_CODE_MAP
+from spot_market_scoring.mongo_writer import BulkWriter
+from spot_market_scoring.pricing import OS_MAP, PRODUCT_FILTERS, write_ondemand_price
+from spot_market_scoring.product_decoder import ATTRIBUTES, PRICE_FIELD, get_hourly_usd, make_record
+
+logger = logging.getLogger(__name__)
+
+OFFER_URL = 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/{region}/index.json'
+CACHE_DIR = 'price_list'
+# a cached offer file is downloaded again once older than this
+MAX_AGE_HOURS = 24
+CHUNK_SIZE = 2 ** 20
+
+# csv column -> product attribute
+CSV_COLUMNS = {
+    'Instance Type': 'instanceType',
+    'Instance Family': 'instanceFamily',
+    'Location': 'location',
+    'Operating System': 'operatingSystem',
+    'vCPU': 'vcpu',
+    'Memory': 'memory',
+    'Storage': 'storage',
+    'Tenancy': 'tenancy',
+    'Pre Installed S/W': 'preInstalledSw',
+    'Capacity Status': 'capacitystatus',
+    'License Model': 'licenseModel',
+}
+# get_products of pricing.get_EC2_products has no productFamily filter, *.metal types are their own family
+PRODUCT_FAMILIES = {'Compute Instance', 'Compute Instance (bare metal)'}
+
+_WS = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+
+
+class _JsonReader:
+    def __init__(self, f, chunk_size: int = CHUNK_SIZE):
+        """
+        pull reader of a json text file, objects are walked key by key, values decoded one at a time
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size: int = None) -> bool:
+        data = '' if self.eof else self.f.read(size or self.chunk_size)
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        self.eof = not data
+        return bool(data)
+
+    def _peek(self) -> str:
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('unexpected end of json')
+
+    def _expect(self, chars: str) -> str:
+        c = self._peek()
+        if c not in chars:
+            raise ValueError(f'expected {chars!r}, found {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        decode the next value, the buffer grows until it holds all of it
+        """
+        self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may go on in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            size *= 2
+
+    def keys(self):
+        """
+        keys of the next object, the value of every key must be read (value or keys) before the next one
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+
+def _get_attributes(product: dict) -> dict:
+    """
+    attributes of a product get_products would return, None for the others
+    """
+    attributes = product.get('attributes', {})
+    if (product.get('productFamily') not in PRODUCT_FAMILIES
+            or attributes.get('location') not in REGION_MAP
+            or attributes.get('operatingSystem') not in OS_MAP
+            or any(attributes.get(k) != v for k, v in PRODUCT_FILTERS.items())):
+        return None
+    return {k: attributes.get(k) for k in ATTRIBUTES}
+
+
+def _read_json(f) -> tuple:
+    reader = _JsonReader(f)
+    products, prices = {}, {}
+    for key in reader.keys():
+        if key == 'products':
+            for sku in reader.keys():
+                attributes = _get_attributes(reader.value())
+                if attributes:
+                    products[sku] = attributes
+        elif key == 'terms':
+            for term_type in reader.keys():
+                for sku in reader.keys():
+                    terms = reader.value()
+                    if term_type == 'OnDemand' and sku in products:
+                        prices[sku] = get_hourly_usd(terms)
+        else:
+            reader.value()
+    return products, prices
+
+
+def _read_csv(f) -> tuple:
+    reader = csv.reader(f)
+    # the header follows a few lines of offer metadata
+    header = next((row for row in reader if row[:1] == ['SKU']), None)
+    if header is None:
+        raise ValueError('no SKU header')
+    index = {name: i for i, name in enumerate(header)}
+    sku, term_type, unit, price = (index[c] for c in ['SKU', 'TermType', 'Unit', 'PricePerUnit'])
+    family = index['Product Family']
+    columns = [(i, CSV_COLUMNS[name]) for name, i in index.items() if name in CSV_COLUMNS]
+
+    products, prices = {}, {}
+    for row in reader:
+        if row[term_type] != 'OnDemand' or row[unit] != 'Hrs':
+            continue
+        attributes = _get_attributes({'productFamily': row[family],
+                                      'attributes': {attr: row[i] for i, attr in columns}})
+        if attributes:
+            products[row[sku]] = attributes
+            prices[row[sku]] = row[price]
+    return products, prices
+
+
+def _open(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def get_offer_file(source: str, cache_dir: str = CACHE_DIR, max_age_hours: float = MAX_AGE_HOURS) -> str:
+    """
+    local path of an offer file, urls are downloaded into cache_dir unless a recent enough copy is there
+    :param source: path or http(s) url
+    """
+    if not source.startswith(('http://', 'https://')):
+        return source
+    name = os.path.basename(source.split('?')[0])
+    path = os.path.join(cache_dir, f'{hashlib.sha1(source.encode()).hexdigest()[:12]}_{name}')
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age_hours * 3600:
+        logger.info(f'{source}: cached copy {path}')
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    start = time.perf_counter()
+    with requests.get(source, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        with open(f'{path}.part', 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+    os.replace(f'{path}.part', path)
+    logger.info(f'{source}: {os.path.getsize(path)} bytes downloaded in {time.perf_counter() - start:.1f} seconds')
+    return path
+
+
+def read_offer_file(path: str) -> list:
+    """
+    products of an offer file with their on-demand price
+    :param path: index.json or index.csv, optionally .gz
+    :return: [record], see product_decoder
+    """
+    start = time.perf_counter()
+    with _open(path) as f:
+        products, prices = (_read_csv if '.csv' in os.path.basename(path) else _read_json)(f)
+    logger.info(f'{path}: {len(products)} products read in {time.perf_counter() - start:.1f} seconds')
+    return [make_record(attributes, price=prices.get(sku)) for sku, attributes in products.items()]
+
+
+def update_ondemand_price(dbclient, sources: list = None, cache_dir: str = CACHE_DIR,
+                          max_age_hours: float = MAX_AGE_HOURS):
+    """
+    pricing.update_ondemand_price from offer files
+    :param sources: offer file paths or urls, {region} in one is replaced by every region, defaults to OFFER_URL
+    :return: ondemand DataFrame, also written to spot_market_scores.ondemand
+    """
+    paths = []
+    for source in sources or [OFFER_URL]:
+        regions = sorted(REGION_CODE_MAP) if '{region}' in source else [None]
+        paths.extend(source.format(region=region) if region else source for region in regions)
+
+    total_prod = []
+    aws_data = dbclient['aws_data']
+    for path in paths:
+        try:
+            products = read_offer_file(get_offer_file(path, cache_dir, max_age_hours))
+        except Exception as e:
+            metrics.add('errors')
+            logger.error(f'[ERR] {path}: {e}')
+            continue
+        metrics.add('rows_fetched', len(products))
+
+        # rewrite the region/operating systems of the file, like the api mode does one by one
+        found = {}
+        for record in products:
+            found.setdefault(record['location'], set()).add(record['operatingSystem'])
+        with BulkWriter(aws_data.pricing_product) as writer:
+            for location, oses in found.items():
+                writer.delete_many({'location': location, 'operatingSystem': {'$in': sorted(oses)}})
+            for record in products:
+                writer.insert_one(record)
+                if record[PRICE_FIELD] is None:
+                    continue
+                total_prod.append({'Region': REGION_MAP[record['location']],
+                                   'OperatingSystem': OS_MAP[record['operatingSystem']],
+                                   'InstanceType': record['instanceType'],
+                                   'OnDemand': record[PRICE_FIELD]})
+
+    if not total_prod:
+        raise ValueError(f'no on-demand prices in {paths}')
+    return write_ondemand_price(dbclient, total_prod)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""price_matrix.py
+
+    Daily prices of all (instance type, az) series of a region/system in
+    one float32 array, in place of a dict of one DataFrame per instance type.
+    Instance types and azs are kept once as categories, every column of the
+    array refers to them by code, columns are grouped by instance type.
+
+    PriceMatrix reads like the former ins_dict (InstanceType -> DataFrame of
+    daily prices by az, starting at the instance type's first day), frames
+    are views of the array built on access, so random_forest, forecast_engine
+    and pooled_forecast take either.
+
+    Classes:
+        PriceMatrix
+
+"""
+import numpy as np
+import pandas as pd
+
+
+class PriceMatrix:
+    __slots__ = ('index', 'prices', 'instance_types', 'availability_zones',
+                 'ins_codes', 'az_codes', 'starts', '_bounds')
+
+    def __init__(self, index: pd.DatetimeIndex, prices: np.ndarray, ins_codes: np.ndarray, az_codes: np.ndarray,
+                 instance_types: pd.Index, availability_zones: pd.Index, starts: np.ndarray = None):
+        """
+        init
+        :param index: day of every row
+        :param prices: days x series, the series of an instance type are adjacent columns
+        :param ins_codes: instance type code of every column
+        :param az_codes: az code of every column
+        :param instance_types: instance type of every code
+        :param availability_zones: az of every code
+        :param starts: first row of every instance type code, 0 if None
+        """
+        self.index = index
+        self.prices = prices
+        self.ins_codes = ins_codes
+        self.az_codes = az_codes
+        self.instance_types = instance_types
+        self.availability_zones = availability_zones
+        self.starts = np.zeros(len(instance_types), dtype='int32') if starts is None else starts
+        # column range of every instance type code
+        first = np.searchsorted(ins_codes, np.arange(len(instance_types)), side='left')
+        last = np.searchsorted(ins_codes, np.arange(len(instance_types)), side='right')
+        self._bounds = np.stack([first, last], axis=1)
+
+    @classmethod
+    def from_frame(cls, daily: pd.DataFrame, starts: dict = None, dtype: str = 'float32'):
+        """
+        :param daily: days x (InstanceType, AvailabilityZone) columns
+        :param starts: InstanceType -> first row of its frame, 0 if missing
+        """
+        daily = daily.sort_index(axis=1)
+        columns = daily.columns.remove_unused_levels()
+        instance_types = pd.Index(columns.levels[0].astype(str).to_numpy())
+        availability_zones = pd.Index(columns.levels[1].astype(str).to_numpy())
+        ins_codes = np.asarray(columns.codes[0], dtype='int32')
+        az_codes = np.asarray(columns.codes[1], dtype='int16')
+        rows = np.zeros(len(instance_types), dtype='int32')
+        for code, ins in enumerate(instance_types):
+            rows[code] = (starts or {}).get(ins, 0)
+        return cls(daily.index, daily.to_numpy(dtype=dtype), ins_codes, az_codes,
+                   instance_types, availability_zones, rows)
+
+    def _code(self, ins: str) -> int:
+        code = self.instance_types.get_indexer([ins])[0]
+        if code < 0 or self._bounds[code, 0] == self._bounds[code, 1]:
+            raise KeyError(ins)
+        return code
+
+    def __getitem__(self, ins: str) -> pd.DataFrame:
+        """
+        daily prices of ins by az, from its first day
+        """
+        code = self._code(ins)
+        first, last = self._bounds[code]
+        start = self.starts[code]
+        return pd.DataFrame(self.prices[start:, first:last], index=self.index[start:],
+                            columns=self.availability_zones[self.az_codes[first:last]], copy=False)
+
+    def __contains__(self, ins) -> bool:
+        try:
+            self._code(ins)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return int((self._bounds[:, 1] > self._bounds[:, 0]).sum())
+
+    def keys(self) -> list:
+        return [ins for code, ins in enumerate(self.instance_types)
+                if self._bounds[code, 1] > self._bounds[code, 0]]
+
+    def items(self):
+        for ins in self.keys():
+            yield ins, self[ins]
+
+    def values(self):
+        for ins in self.keys():
+            yield self[ins]
+
+    def get(self, ins: str, default=None):
+        return self[ins] if ins in self else default
+
+    @property
+    def nbytes(self) -> int:
+        return (self.prices.nbytes + self.ins_codes.nbytes + self.az_codes.nbytes + self.starts.nbytes
+                + self.index.nbytes + self.instance_types.memory_usage(deep=True)
+                + self.availability_zones.memory_usage(deep=True))
+
+    def __repr__(self):
+        return (f'PriceMatrix({len(self)} instance types, {self.prices.shape[1]} series, '
+                f'{len(self.index)} days, {self.prices.dtype})')
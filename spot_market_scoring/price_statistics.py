@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""price_statistics.py
+
+    Maintained daily spot price statistics per (instance type, az), so that
+    scoring does not have to download and reparse the whole year of history.
+
+    The store keeps the first and the last record of every day with records,
+    for the days with records in the last max_days days. They are enough to
+    rebuild the daily prices of spot_price_history.reformat_all (the price in
+    effect at the start of every day, an az takes its first price before its
+    first record, an instance type starts at the day of its first record), so
+    mean/std are those of spot_price_history.get_mean_and_std over the same
+    history. New records from update_spot_price_history are merged
+    incrementally. Instance types and azs are categoricals, daily prices by
+    instance type are handed to scoring as one float32 price_matrix.PriceMatrix.
+
+    Classes:
+        SpotPriceStatistics
+
+    Functions:
+        get_daily_prices
+        update_statistics
+        read_from_s3
+        write_to_s3
+
+"""
+import logging
+import numpy as np
+import pandas as pd
+from io import StringIO
+from spot_market_scoring import history_loader as hl
+from spot_market_scoring import history_storage as hs
+from spot_market_scoring.mappings import PERIOD_MAP
+from spot_market_scoring.price_matrix import PriceMatrix
+from spot_market_scoring.utils import ParquetTranscoder
+
+logger = logging.getLogger(__name__)
+
+KEYS = ['InstanceType', 'AvailabilityZone']
+COLUMNS = KEYS + ['Day', 'FirstTimestamp', 'FirstPrice', 'Timestamp', 'SpotPrice']
+CHUNK_SIZE = 50000
+
+
+def get_daily_prices(records: pd.DataFrame) -> pd.DataFrame:
+    """
+    first and last record of every (instance type, az, day), the later of two records of a timestamp wins
+    :param records: spot price history with InstanceType, AvailabilityZone, SpotPrice, Timestamp
+    :return: DataFrame with InstanceType, AvailabilityZone, Day, FirstTimestamp, FirstPrice, Timestamp, SpotPrice
+    """
+    records = records[KEYS + ['SpotPrice', 'Timestamp']].copy()
+    records['Timestamp'] = pd.to_datetime(records['Timestamp'], utc=True)
+    records['SpotPrice'] = records['SpotPrice'].astype('float')
+    records.drop_duplicates(KEYS + ['Timestamp'], keep='last', inplace=True)
+    records.sort_values('Timestamp', inplace=True, kind='mergesort')
+    records['Day'] = records['Timestamp'].dt.floor('D')
+    first = records.drop_duplicates(KEYS + ['Day'], keep='first')
+    days = records.drop_duplicates(KEYS + ['Day'], keep='last').merge(
+        first.rename(columns={'Timestamp': 'FirstTimestamp', 'SpotPrice': 'FirstPrice'}),
+        on=KEYS + ['Day'], how='left', sort=False)
+    return days[COLUMNS]
+
+
+def _get_records(days: pd.DataFrame) -> pd.DataFrame:
+    """
+    the first and last records of the days as records, to merge them with new records
+    """
+    first = days[KEYS + ['FirstTimestamp', 'FirstPrice']].rename(
+        columns={'FirstTimestamp': 'Timestamp', 'FirstPrice': 'SpotPrice'})
+    return pd.concat([first, days[KEYS + ['Timestamp', 'SpotPrice']]], ignore_index=True)
+
+
+class SpotPriceStatistics:
+    def __init__(self, days: pd.DataFrame = None, max_days: int = 90, now=None):
+        """
+        init
+        :param days: first and last records of every day, see get_daily_prices
+        :param max_days: days of history, the days_back of spot_price_history.read_from_s3
+        :param now: end of the history, defaults to the current time
+        """
+        self.max_days = max_days
+        self.now = now
+        if days is None:
+            days = pd.DataFrame(columns=COLUMNS)
+        self._days = days
+        self._trim()
+
+    @classmethod
+    def from_history(cls, records: pd.DataFrame, max_days: int = 90, now=None):
+        return cls(get_daily_prices(records), max_days, now)
+
+    @property
+    def days(self) -> pd.DataFrame:
+        return self._days
+
+    def _now(self) -> pd.Timestamp:
+        return pd.Timestamp.now(tz='UTC') if self.now is None else pd.Timestamp(self.now)
+
+    def _start(self) -> pd.Timestamp:
+        return self._now() - pd.Timedelta(days=self.max_days)
+
+    def _trim(self):
+        """
+        drop the days whose records are all older than max_days
+        """
+        days = self._days.loc[(pd.to_datetime(self._days['Timestamp'], utc=True) >= self._start()).to_numpy()]
+        days.index = pd.RangeIndex(len(days))
+        self._days = days
+        self._matrix = None
+
+    def window(self, max_days: int):
+        """
+        statistics of the last max_days days, at most the days kept
+        """
+        if max_days > self.max_days:
+            raise ValueError(f'{max_days} days requested, {self.max_days} kept')
+        return SpotPriceStatistics(self._days, max_days, self.now)
+
+    def update(self, records: pd.DataFrame):
+        """
+        merge new spot price records, a new record of a stored timestamp wins
+        :param records: spot price history with InstanceType, AvailabilityZone, SpotPrice, Timestamp
+        """
+        if records is None or records.empty:
+            return self
+        days = get_daily_prices(pd.concat([_get_records(self._days), records[KEYS + ['SpotPrice', 'Timestamp']]],
+                                          ignore_index=True))
+        self._days = days.astype({key: 'category' for key in KEYS})
+        self._trim()
+        return self
+
+    def _get_matrix(self):
+        """
+        daily prices on the calendar (days x series), first row of every instance type
+        """
+        if self._matrix is not None:
+            return self._matrix
+
+        start = self._start()
+        calendar = pd.date_range(start.floor('D'), self._now().floor('D'), freq='D')
+        days = self._days.loc[(pd.to_datetime(self._days['Timestamp'], utc=True) >= start).to_numpy()]
+        days = days.astype({key: 'category' for key in KEYS})
+        ins, az = days['InstanceType'].cat, days['AvailabilityZone'].cat
+        series, col = np.unique(ins.codes.to_numpy('int64') * len(az.categories) + az.codes.to_numpy(),
+                                return_inverse=True)
+        col = col.reshape(-1)
+        row = calendar.get_indexer(pd.DatetimeIndex(pd.to_datetime(days['Day'], utc=True)))
+        first_ts = pd.DatetimeIndex(pd.to_datetime(days['FirstTimestamp'], utc=True))
+        # the first record of a day straddling start may be older, only its later records are in the history
+        first_known = np.asarray(first_ts >= start)
+        first_price = days['FirstPrice'].to_numpy('float64')
+
+        # price in effect at the start of a day: a record right at midnight, else the last record of the day before
+        values = np.full((len(calendar) + 1, len(series)), np.nan)
+        values[row + 1, col] = days['SpotPrice'].to_numpy('float64')
+        midnight = first_known & np.asarray(first_ts == calendar[row])
+        values[row[midnight], col[midnight]] = first_price[midnight]
+        values = values[:-1]
+        # forward fill: every cell takes the last known row of its column
+        last = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+        values = values[np.maximum.accumulate(last, axis=0), np.arange(len(series))]
+        # before its first record an az takes its first price
+        earliest = pd.Series(row).groupby(col).idxmin().to_numpy()
+        backfill = np.where(first_known[earliest], first_price[earliest], np.nan)
+        values = np.where(np.isnan(values), backfill, values)
+
+        # an instance type starts at the day of its first record,
+        # that day precedes the record unless it is exactly on it and takes the next day's prices
+        ins_codes = series // len(az.categories)
+        row_ins = ins_codes[col]
+        first_rows = pd.Series(row).groupby(row_ins).min()
+        on_day = pd.Series(midnight & (row == first_rows.reindex(row_ins).to_numpy())).groupby(row_ins).any()
+        rows = first_rows.reindex(ins_codes).to_numpy()
+        shift = ~on_day.reindex(ins_codes).to_numpy()
+        cols = np.flatnonzero(shift)
+        following = np.minimum(rows[cols] + 1, len(calendar) - 1)
+        values[rows[cols], cols] = np.where(rows[cols] + 1 < len(calendar), values[following, cols], np.nan)
+        starts = {ins.categories[code]: first_row for code, first_row in first_rows.items()}
+
+        columns = pd.MultiIndex.from_arrays([ins.categories[ins_codes], az.categories[series % len(az.categories)]],
+                                            names=KEYS)
+        self._matrix = (pd.DataFrame(values, index=calendar, columns=columns), rows, starts)
+        return self._matrix
+
+    def get_mean_and_std(self, period: str = 'Month') -> (dict, dict):
+        """
+        mean/std of the daily prices of every instance type's frame, as spot_price_history.get_mean_and_std
+        :param period: one of PERIOD_MAP, the window of get_mean_and_std covers the whole frame
+        :return: InstanceType -> AvailabilityZone -> mean, same for std
+        """
+        if period not in PERIOD_MAP:
+            raise ValueError(f'period must be one of {list(PERIOD_MAP)}')
+
+        prices, rows, _ = self._get_matrix()
+        values = prices.to_numpy('float64')
+        known = (np.arange(len(values))[:, None] >= rows) & ~np.isnan(values)
+        count = known.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(known, values, 0).sum(axis=0) / count
+            var = np.where(known, (values - mean) ** 2, 0).sum(axis=0) / (count - 1)
+        std = np.where(count > 1, np.sqrt(var), np.nan)
+
+        avg_entries, std_entries = {}, {}
+        for (ins, az), m, s in zip(prices.columns, mean, std):
+            avg_entries.setdefault(ins, {})[az] = m
+            std_entries.setdefault(ins, {})[az] = s
+        return avg_entries, std_entries
+
+    def get_ins_dict(self) -> PriceMatrix:
+        """
+        daily prices by instance type, as spot_price_history.reformat_all
+        :return: InstanceType -> DataFrame(index=day, columns=az), frames of one float32 matrix
+        """
+        prices, _, starts = self._get_matrix()
+        return PriceMatrix.from_frame(prices, starts)
+
+
+def update_statistics(s3client, region: str, system: str, records: pd.DataFrame,
+                      history: pd.DataFrame = None) -> SpotPriceStatistics:
+    """
+    merge new records into the stored statistics of region/system
+    :param records: newly fetched spot price records
+    :param history: spot price history or a callable returning it, used if no statistics are stored yet
+    """
+    try:
+        stats = read_from_s3(s3client, region, system)
+        stats.update(records)
+    except Exception as e:
+        # only missing statistics are built from history, other s3 and parse errors fail the update
+        if history is None or not hs.is_missing(s3client, e):
+            raise
+        logger.info(f'{region} {system} building statistics from history: {e}')
+        stats = SpotPriceStatistics.from_history(history() if callable(history) else history)
+    write_to_s3(stats, s3client, region, system)
+    return stats
+
+
+def get_key(region: str, system: str) -> str:
+    return (f'ec2/spot_price_statistics/Region={region}/'
+            f'ProductDescription={ParquetTranscoder.encode(system)}/'
+            f'daily_first_last.csv')
+
+
+def write_to_s3(stats: SpotPriceStatistics, s3client, region: str, system: str):
+    csv_buffer = StringIO()
+    # one format for all timestamps (midnight ones are written without fraction by default), formatted by numpy
+    days = stats.days.assign(**{column: np.datetime_as_string(
+        pd.to_datetime(stats.days[column], utc=True).dt.tz_localize(None).to_numpy('datetime64[ns]'), unit='ns') + 'Z'
+        for column in ['Day', 'FirstTimestamp', 'Timestamp']})
+    days.to_csv(csv_buffer, index=False)
+    s3client.put_object(
+        Bucket='stompy-aws-dataset',
+        Key=get_key(region, system),
+        Body=csv_buffer.getvalue()
+    )
+    return True
+
+
+def read_from_s3(s3client, region: str, system: str, max_days: int = 90) -> SpotPriceStatistics:
+    response = s3client.get_object(
+        Bucket='stompy-aws-dataset',
+        Key=get_key(region, system)
+    )
+    # parsed in chunks, the timestamp strings of a chunk are dropped once converted
+    chunks = pd.read_csv(response.get('Body'), chunksize=CHUNK_SIZE,
+                         dtype={'InstanceType': 'category', 'AvailabilityZone': 'category', 'Day': 'category'})
+    days = pd.concat((_parse_days(chunk) for chunk in chunks), ignore_index=True)
+    return SpotPriceStatistics(days.astype({key: 'category' for key in KEYS}), max_days)
+
+
+def _parse_days(days: pd.DataFrame) -> pd.DataFrame:
+    days['Day'] = hl._to_timestamps(days['Day'])
+    days['FirstTimestamp'] = pd.to_datetime(days['FirstTimestamp'], utc=True)
+    days['Timestamp'] = pd.to_datetime(days['Timestamp'], utc=True)
+    return days
@@ -1,6 +1,9 @@
-import json
 import pandas as pd
 from spot_market_scoring.mappings import REGION_CODE_MAP
+from spot_market_scoring import metrics
+from spot_market_scoring.utils import paginate
+from spot_market_scoring.mongo_writer import BulkWriter
+from spot_market_scoring.product_decoder import PRICE_FIELD, decode_product
 from spot_market_scoring.concurrent_task import *
 
 OS_MAP = {
@@ -12,6 +15,15 @@ OS_MAP = {
 
 OS_CODE_MAP = {v: k for k, v in OS_MAP.items()}
 
+# get_products filters of the products priced, also applied to the offer files (price_list)
+PRODUCT_FILTERS = {
+    'preInstalledSw': 'NA',
+    # 'currentGeneration': 'Yes',
+    'capacitystatus': 'Used',
+    'tenancy': 'Shared',
+    'licenseModel': 'No License required',
+}
+
 
 def get_ondemand_price(data):
     data = data['terms']['OnDemand']
@@ -50,12 +62,7 @@ def get_EC2_products(client,
     :return:
     """
 
-    filters = []
-    filters.append({'Field': 'preInstalledSw', 'Type': 'TERM_MATCH', 'Value': 'NA'})
-    # filters.append({'Field': 'currentGeneration','Type': 'TERM_MATCH','Value': 'Yes'})
-    filters.append({'Field': 'capacitystatus', 'Type': 'TERM_MATCH', 'Value': 'Used'})
-    filters.append({'Field': 'tenancy', 'Type': 'TERM_MATCH', 'Value': 'Shared'})
-    filters.append({'Field': 'licenseModel', 'Type': 'TERM_MATCH', 'Value': "No License required"})
+    filters = [{'Field': k, 'Type': 'TERM_MATCH', 'Value': v} for k, v in PRODUCT_FILTERS.items()]
 
     if instanceType:
         filters.append({'Field': 'InstanceType', 'Type': 'TERM_MATCH', 'Value': instanceType})
@@ -64,42 +71,37 @@ def get_EC2_products(client,
     if operatingSystem:
         filters.append({'Field': 'operatingSystem', 'Type': 'TERM_MATCH', 'Value': operatingSystem})
 
-    response = client.get_products(ServiceCode='AmazonEC2', Filters=filters)
-    results = response['PriceList']
+    return list(paginate(client.get_products, ServiceCode='AmazonEC2', Filters=filters))
 
-    while "NextToken" in response:
-        response = client.get_products(NextToken=response['NextToken'],
-                                       ServiceCode='AmazonEC2', Filters=filters)
-        results.extend(response["PriceList"])
 
-    return results
+def update_ondemand_price_helper(client, dbclient, region, os):
+    with metrics.task(region, os):
+        return _update_ondemand_price_helper(client, dbclient, region, os)
 
 
-def update_ondemand_price_helper(client, dbclient, region, os):
+def _update_ondemand_price_helper(client, dbclient, region, os):
     columns = ['Region', 'OperatingSystem', 'InstanceType', 'OnDemand']
 
     response = get_EC2_products(client, location=region, operatingSystem=os)
+    metrics.add('rows_fetched', len(response))
     aws_data = dbclient['aws_data']
     filter = {
         'location': REGION_CODE_MAP[region],
         'operatingSystem': os
     }
-    aws_data.pricing_product.delete_many(filter)
-
     total_prod = []
-    for res in response:
-        data = json.loads(res)
-        data_att = data['product']['attributes']
-        aws_data.pricing_product.insert_one(data_att)
-        instanceType = data_att['instanceType']
-
-        ondemand, description = get_ondemand_price(data)
+    with BulkWriter(aws_data.pricing_product) as writer:
+        writer.delete_many(filter)
+        for res in response:
+            # only the fields read later are decoded and stored, see product_decoder
+            record = decode_product(res)
+            writer.insert_one(record)
 
-        prod_info = [region, OS_MAP[os], instanceType, ondemand]
+            prod_info = [region, OS_MAP[os], record['instanceType'], record[PRICE_FIELD]]
 
-        entry = dict(zip(columns, prod_info))
+            entry = dict(zip(columns, prod_info))
 
-        total_prod.append(entry)
+            total_prod.append(entry)
 
     return total_prod
 
@@ -114,17 +116,27 @@ def update_ondemand_price(client, dbclient):
         for prod in os_list for region in REGION_CODE_MAP
     ]).get_results(merge=True)
 
-    df = pd.DataFrame(response)
+    write_ondemand_price(dbclient, response)
+    return
+
+
+def write_ondemand_price(dbclient, total_prod: list) -> pd.DataFrame:
+    """
+    replace the ondemand table of spot_market_scores
+    :param total_prod: [{'Region', 'OperatingSystem', 'InstanceType', 'OnDemand'}]
+    """
+    df = pd.DataFrame(total_prod)
     df['OnDemand'] = df.OnDemand.astype(float)
 
     db = dbclient['spot_market_scores']
-    db.ondemand.delete_many({})
     data = {
         'response': df.to_dict(orient='records')
     }
-    db.ondemand.insert_one(data)
+    with BulkWriter(db.ondemand) as writer:
+        writer.delete_many({})
+        writer.insert_one(data)
 
-    return
+    return df
 
 
 def update_instance_list_by_family(dbclient):
@@ -147,6 +159,7 @@ def update_instance_list_by_family(dbclient):
     }
     product_info = dbclient['product_info']
     spot_market_scores = dbclient['spot_market_scores']
+    writer = BulkWriter(product_info.spot_types)
     # TODO replace with s3 info
 
     for region in REGION_CODE_MAP.keys():
@@ -179,8 +192,9 @@ def update_instance_list_by_family(dbclient):
         data = {
             '$set': os_dict
         }
-        product_info.spot_types.update_one(query, data, upsert=True)
+        writer.update_one(query, data, upsert=True)
 
+    writer.flush()
     return
 
 
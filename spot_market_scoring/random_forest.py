@@ -3,6 +3,7 @@ import numpy as np
 import logging
 import sklearn.ensemble as skl_ens
 import sklearn.metrics as skl_met
+from spot_market_scoring import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -27,20 +28,58 @@ def series_to_supervised(data, n_in=1, n_out=1, drop_na=True):
     return agg.values
 
 
-# split a univariate dataset into train/test sets
-def train_test_split(data, n_test):
-    return data[:-n_test, :], data[-n_test:, :]
+class ModelConfig:
+    def __init__(self, n_in: int = 6, n_test: int = 12,
+                 n_estimators: int = 50, max_depth: int = None,
+                 n_jobs: int = None, random_state: int = None,
+                 validate: bool = False):
+        """
+        settings of the spot price prediction model
+        :param n_in: number of lagged prices used as input
+        :param n_test: walk-forward test steps, series with fewer supervised rows are not modelled
+        :param n_estimators: RandomForestRegressor n_estimators
+        :param max_depth: RandomForestRegressor max_depth
+        :param n_jobs: RandomForestRegressor n_jobs
+        :param random_state: RandomForestRegressor random_state
+        :param validate: run walk-forward validation (its mae is logged) and predict with its last model,
+                         instead of fitting that last model only, same prediction
+        """
+        self.n_in = n_in
+        self.n_test = n_test
+        self.n_estimators = n_estimators
+        self.max_depth = max_depth
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.validate = validate
+
+    def build_model(self):
+        return skl_ens.RandomForestRegressor(n_estimators=self.n_estimators,
+                                             max_depth=self.max_depth,
+                                             n_jobs=self.n_jobs,
+                                             random_state=self.random_state)
+
+    def fingerprint(self) -> str:
+        """
+        settings that change the predictions, n_jobs and validate do not
+        """
+        return f'{self.n_in}|{self.n_test}|{self.n_estimators}|{self.max_depth}|{self.random_state}'
+
+    def __repr__(self):
+        return (f'ModelConfig(n_in={self.n_in}, n_test={self.n_test}, '
+                f'n_estimators={self.n_estimators}, max_depth={self.max_depth}, '
+                f'n_jobs={self.n_jobs}, random_state={self.random_state}, validate={self.validate})')
 
 
 # fit an random forest model and make a one step prediction
-def random_forest_forecast(train, test_X):
+def random_forest_forecast(train, test_X, config: ModelConfig = None):
+    config = config or ModelConfig()
     # transform list into array
     train = np.asarray(train)
     # split into input and output columns
     train_X, train_y = train[:, :-1], train[:, -1]
 
     # fit model
-    model = skl_ens.RandomForestRegressor(n_estimators=50)
+    model = config.build_model()
     model.fit(train_X, train_y)
     # make a one-step prediction
     y_hat = model.predict([test_X])
@@ -48,76 +87,155 @@ def random_forest_forecast(train, test_X):
 
 
 # walk-forward validation for univariate data
-def walk_forward_validation(data, n_test):
+def walk_forward_validation(data, n_test, config: ModelConfig = None):
     predictions = list()
-    # split dataset
-    train, test = train_test_split(data, n_test)
-    # seed history with training dataset
-    history = [x for x in train]
+    n_train = len(data) - n_test
+    test = data[n_train:, :]
     models = []
     # step over each time-step in the test set
     for i in range(len(test)):
         # split test row into input and output columns
         test_X, test_y = test[i, :-1], test[i, -1]
-        # print('test_X ->', list(test_X))
-        # fit model on history and make a prediction
-        y_hat, model = random_forest_forecast(history, test_X)
+        # fit model on history (train set and the observed test rows) and make a prediction
+        y_hat, model = random_forest_forecast(data[:n_train + i], test_X, config)
         # store forecast in list of predictions
         predictions.append(y_hat)
-        # add actual observation to history for the next loop
-        history.append(test[i])
         models.append(model)
-        # summarize progress
-        # print('> exp = %.4f, pred = %.4f, acc = %.6f' %
-        #       (test_y, y_hat, 1 - abs((test_y - y_hat) / test_y)))
     # estimate prediction error
     error = skl_met.mean_absolute_error(test[:, -1], predictions)
 
     return error, test[:, -1], predictions, models
 
 
-def train_spot_price_prediction_model(df: pd.DataFrame, tag: str = None):
-    # load the dataset
-
+def train_spot_price_prediction_model(df: pd.DataFrame, tag: str = None, config: ModelConfig = None):
+    """
+    evaluate the model with walk-forward validation
+    :return: models fitted at every test step
+    """
+    config = config or ModelConfig()
     # transform the time series data into supervised learning
-    data = series_to_supervised(df.values, n_in=6)
+    data = series_to_supervised(np.asarray(df), n_in=config.n_in)
 
     # evaluate
-    mae, y, y_pred, rfs = walk_forward_validation(data, 12)
+    mae, y, y_pred, rfs = walk_forward_validation(data, config.n_test, config)
+    logger.debug(f'{tag} walk-forward mae: {mae}')
 
     return rfs
 
-def predict(index,model):
+
+def fit_spot_price_prediction_model(df: pd.DataFrame, config: ModelConfig = None):
+    """
+    fit the model of the last walk-forward step only: the same rows (all but the last one)
+    and random_state, so it equals train_spot_price_prediction_model(df, config=config)[-1]
+    :return: fitted model
+    """
+    config = config or ModelConfig()
+    data = series_to_supervised(np.asarray(df), n_in=config.n_in)
+    if len(data) <= config.n_test:
+        raise ValueError(f'{len(data)} rows are not enough to fit the model')
+
+    train = data[:-1]
+    model = config.build_model()
+    model.fit(train[:, :-1], train[:, -1])
+    return model
+
+
+def predict(index, model, n_in: int = 6):
     # construct an input for a new prediction
-    row = index[-6:]
+    row = index[-n_in:]
     # make a one-step prediction
     yhat = model.predict(np.asarray([row]))
     # print('Input: %s, Predicted: %.5f' % (row, yhat[0]))
     return yhat[0]
 
-def get_predicted_price(ins_dict=None,year:int=2021):
-    #output in one file
-    #read every file
 
-    ins_pred={}
-    for ins,df in ins_dict.items():
-
-        #for each availability zone
-        az_pred={}
-        for az in df.columns:
-            if df[az].var() <= 0.001:
-                az_pred[az] = df[az][-1]
-                continue
-            data = df[az].dropna()
-            try:
-                rfs = train_spot_price_prediction_model(data)
-                new_price = predict(data, rfs[-1])
-                az_pred[az] = new_price
-            except Exception as e:
-                logger.error(f'[ERR] {ins}: {e}')
-                az_pred[az] = df[az][-1]
+def is_flat(series) -> bool:
+    """
+    series with (almost) no variance are not modelled, the last price is used
+    :param series: Series or array of prices, missing values are ignored
+    """
+    values = np.asarray(series, dtype='float64')
+    values = values[~np.isnan(values)]
+    return len(values) > 1 and values.var(ddof=1) <= 0.001
+
+
+def predict_next_price(data, config: ModelConfig = None, tag: str = None):
+    """
+    predict the next price of a series without missing values
+    :param data: Series or array of prices
+    """
+    config = config or ModelConfig()
+    if config.validate:
+        model = train_spot_price_prediction_model(data, tag, config)[-1]
+    else:
+        model = fit_spot_price_prediction_model(data, config)
+    return predict(data, model, config.n_in)
+
+
+def split_series(ins_dict: dict) -> (dict, list):
+    """
+    split the series of ins_dict into flat series, predicted by their last price,
+    and series to be modelled
+    :return: ins_pred with None for modelled series, [(ins, az, values)] to be modelled
+    """
+    ins_pred, tasks = {}, []
+    for ins, df in ins_dict.items():
+        ins_pred[ins] = {}
+        # columns of float32 price matrices are modelled in float64
+        prices = df.to_numpy(dtype='float64')
+        for az, values in zip(df.columns, prices.T):
+            if is_flat(values):
+                ins_pred[ins][az] = values[-1]
                 continue
-
-        ins_pred[ins] = az_pred
-
-    return ins_pred
\ No newline at end of file
+            # placeholder keeps the az order of df
+            ins_pred[ins][az] = None
+            tasks.append((ins, az, values[~np.isnan(values)]))
+    return ins_pred, tasks
+
+
+def predict_batch(batch: list, config: ModelConfig = None) -> list:
+    """
+    predict the next price of every series in batch
+    :param batch: [(ins, az, values)]
+    :return: [(ins, az, price, error)], price is None if the model failed
+    """
+    results = []
+    for ins, az, values in batch:
+        try:
+            results.append((ins, az, predict_next_price(values, config, tag=f'{ins} {az}'), None))
+        except Exception as e:
+            results.append((ins, az, None, str(e)))
+    return results
+
+
+def fill_predictions(ins_pred: dict, ins_dict: dict, results: list) -> dict:
+    """
+    put the results of predict_batch into ins_pred, failed series use their last price
+    """
+    for ins, az, price, error in results:
+        if error is not None:
+            logger.error(f'[ERR] {ins}: {error}')
+            price = np.float64(ins_dict[ins][az].iloc[-1])
+        ins_pred[ins][az] = price
+    return ins_pred
+
+
+def get_predicted_price(ins_dict=None, year: int = 2021, config: ModelConfig = None,
+                        store=None, region: str = None, system: str = None):
+    """
+    predict the next price of every instance/az
+    :param ins_dict: InstanceType -> DataFrame of daily prices by az
+    :param store: model_store.ModelStore, series with a stored prediction are not trained
+    :param region: region of ins_dict, part of the store key
+    :param system: system of ins_dict, part of the store key
+    :return: InstanceType -> AvailabilityZone -> predicted price
+    """
+    config = config or ModelConfig()
+    ins_pred, tasks = split_series(ins_dict)
+
+    def run(batch):
+        metrics.add('model_fits', len(batch))
+        return predict_batch(batch, config)
+
+    results = store.predict(tasks, run, config, region, system) if store else run(tasks)
+    return fill_predictions(ins_pred, ins_dict, results)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""rate_limiter.py
+
+    Client side rate limiting of the AWS api calls. The 84 region/system
+    tasks start at once; without a limit their calls arrive in bursts,
+    AWS throttles them and the fetch of a region/system fails.
+
+    One RateLimiter per service/region (get_limiter, get_client_limiter),
+    shared by all the threads calling that api: a token bucket of rate
+    calls per second (burst calls at once after a pause) and a limit of
+    concurrent calls. Both adapt AIMD style to the throttling responses:
+    every successful call adds 1/rate to the rate and 1/limit to the
+    concurrency limit (about +1 per round of calls), a throttled call halves
+    both, once per round: calls started before the last decrease do not
+    decrease again. They never grow past the configured values (LIMITS).
+
+        with limiter.slot():                  one call, throttling counted
+            client.describe_instance_types()
+        limiter.call(func, *args, **kwargs)   retried on throttling and transient errors, with backoff
+        @limiter.limit                        decorator of call
+        await limiter.call_async(func, ...)   call on an event loop, func returns an awaitable
+
+    call_async waits for its token or slot with asyncio (no thread held), so
+    async_fetch only sends the boto3 call itself to its executor.
+
+    The limiter does the retries of the calls it wraps: user.ClientFactory
+    creates the clients of the services in LIMITS with a single botocore
+    attempt, botocore retries below call would multiply the attempts
+    (5 x 8), sleep outside the limiter and hide the throttling from it.
+    Transient errors (5xx, timeouts, dropped connections) are retried like
+    botocore's standard mode does, without decreasing the limits.
+
+    utils.paginate fetches every page through the limiter of its client.
+    Throttled calls and the seconds waited for the limiter are added to the
+    run metrics (aws_throttles, aws_rate_limit_wait_seconds).
+
+    Classes:
+        RateLimiter
+
+    Functions:
+        is_throttle
+        is_transient
+        configure
+        get_limiter
+        get_client_limiter
+        log_stats
+
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from botocore.exceptions import ConnectionError, HTTPClientError
+from spot_market_scoring import metrics
+
+logger = logging.getLogger(__name__)
+
+# per region: calls per second, bucket size, concurrent calls; None is unlimited.
+# ec2 describe actions share a bucket of 100 refilled at 20/s per account and region.
+# The pricing api has one endpoint (us-east-1): the pricing stages of every region share one limiter and one
+# account quota instead of a bucket per region, and AWS publishes no bucket size for it. 10/s (burst 20) is a
+# conservative start, so the stages starting at once do not open the run with a burst of throttles and
+# retries; each stage pages its get_products calls one after another at the api's latency, so the cap only
+# delays the overlapping stages. Runs against fakes (no latency) configure it unlimited.
+LIMITS = {
+    'ec2': {'rate': 20, 'burst': 100, 'max_concurrency': 16},
+    'pricing': {'rate': 10, 'burst': 20, 'max_concurrency': 16},
+}
+DEFAULT_LIMITS = {'rate': None, 'burst': None, 'max_concurrency': None}
+# attempts of a throttled call, and the first backoff in seconds (doubled every attempt, full jitter)
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.25
+DECREASE = 0.5
+# calls per second an adaptive limiter never goes below
+MIN_RATE = 0.5
+
+THROTTLE_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                  'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+                  'EC2ThrottledException', 'BandwidthLimitExceeded', 'PriorRequestNotComplete',
+                  'ProvisionedThroughputExceededException', 'TransactionInProgressException'}
+# retried by botocore's standard mode as well
+TRANSIENT_CODES = {'RequestTimeout', 'RequestTimeoutException', 'PriorRequestNotComplete'}
+TRANSIENT_STATUS_CODES = {500, 502, 503, 504}
+
+
+def is_throttle(e: Exception) -> bool:
+    """
+    botocore ClientError of a throttling response
+    """
+    response = getattr(e, 'response', None)
+    return isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+
+def is_transient(e: Exception) -> bool:
+    """
+    connection error, timeout or 5xx response, worth another attempt
+    """
+    if isinstance(e, (ConnectionError, HTTPClientError)):
+        return True
+    response = getattr(e, 'response', None)
+    return isinstance(response, dict) and (
+        response.get('Error', {}).get('Code') in TRANSIENT_CODES
+        or response.get('ResponseMetadata', {}).get('HTTPStatusCode') in TRANSIENT_STATUS_CODES)
+
+
+class RateLimiter:
+    def __init__(self, name: str, rate: float = None, burst: float = None, max_concurrency: int = None,
+                 adaptive: bool = True, max_attempts: int = MAX_ATTEMPTS, base_delay: float = BASE_DELAY):
+        """
+        init
+        :param rate: calls per second at most, None for no token bucket
+        :param burst: tokens of the bucket, defaults to rate
+        :param max_concurrency: concurrent calls at most, None for no limit
+        :param adaptive: AIMD on throttling, otherwise rate and concurrency stay fixed
+        :param max_attempts: attempts of call, 1 does not retry
+        """
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.adaptive = adaptive
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.in_flight = 0
+        self.calls = 0
+        self.throttles = 0
+        self.wait_seconds = 0.0
+        self._updated = time.monotonic()
+        self._decreased = 0.0
+        self._cond = threading.Condition()
+        # (loop, asyncio.Event) of the call_async calls waiting for a slot, woken by release
+        self._async_waiters = []
+
+    def _wait_time(self, now: float):
+        """
+        seconds until a call may start, 0 if now, None until a call ends
+        """
+        if self.concurrency is not None and self.in_flight >= int(self.concurrency):
+            return None
+        if self.rate is None:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def acquire(self) -> float:
+        """
+        wait for a token and a free slot
+        :return: start time of the call, for release
+        """
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait == 0:
+                    break
+                self._cond.wait(wait)
+            self._start(start, now)
+        if now > start:
+            metrics.add('aws_rate_limit_wait_seconds', now - start)
+        return now
+
+    async def acquire_async(self) -> float:
+        """
+        acquire on an event loop: asyncio.sleep until the next token, a wakeup from release for a slot
+        :return: start time of the call, for release
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait == 0:
+                    self._start(start, now)
+                    break
+                if wait is None:
+                    released = asyncio.Event()
+                    self._async_waiters.append((loop, released))
+            if wait is None:
+                await released.wait()
+            else:
+                await asyncio.sleep(wait)
+        if now > start:
+            metrics.add('aws_rate_limit_wait_seconds', now - start)
+        return now
+
+    def _start(self, start: float, now: float):
+        if self.rate is not None:
+            self.tokens -= 1
+        self.in_flight += 1
+        self.calls += 1
+        self.wait_seconds += now - start
+
+    def release(self, started: float, throttled: bool = False):
+        """
+        end of a call started by acquire
+        :param throttled: the call was throttled, decreases the rate and concurrency
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttles += 1
+                if self.adaptive and started >= self._decreased:
+                    self._decrease()
+            elif self.adaptive:
+                if self.rate is not None:
+                    self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                if self.concurrency is not None:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, released in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(released.set)
+        if throttled:
+            metrics.add('aws_throttles')
+
+    def _decrease(self):
+        if self.rate is not None:
+            self.rate = max(self.rate * DECREASE, MIN_RATE)
+            self.tokens = min(self.tokens, 0)
+        if self.concurrency is not None:
+            self.concurrency = max(self.concurrency * DECREASE, 1)
+        self._decreased = time.monotonic()
+        logger.debug(f'{self.name} throttled, rate {self.rate}, concurrency {self.concurrency}')
+
+    @contextmanager
+    def slot(self):
+        """
+        one call, a throttling ClientError raised inside decreases the limits
+        """
+        started = self.acquire()
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = is_throttle(e)
+            raise
+        finally:
+            self.release(started, throttled)
+
+    def call(self, func, *args, **kwargs):
+        """
+        func(*args, **kwargs) in a slot, retried with exponential backoff while throttled or failing transiently
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                with self.slot():
+                    return func(*args, **kwargs)
+            except Exception as e:
+                if not (is_throttle(e) or is_transient(e)) or attempt == self.max_attempts - 1:
+                    raise
+            time.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
+
+    async def call_async(self, func, *args, **kwargs):
+        """
+        await func(*args, **kwargs) in a slot, retried like call; the waits are asyncio sleeps
+        :param func: returns an awaitable, e.g. the blocking call sent to an executor
+        """
+        for attempt in range(self.max_attempts):
+            started = await self.acquire_async()
+            throttled = False
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttle(e)
+                if not (throttled or is_transient(e)) or attempt == self.max_attempts - 1:
+                    raise
+            finally:
+                self.release(started, throttled)
+            await asyncio.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
+
+    def limit(self, func):
+        """
+        decorator, calls of func go through call
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return wrapper
+
+    def log_stats(self):
+        logger.info(f'{self.name}: {self.calls} calls, {self.throttles} throttled, '
+                    f'{self.wait_seconds:.1f} seconds waited, rate {self.rate}, concurrency {self.concurrency}')
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def configure(service: str, **limits):
+    """
+    limits of a service (rate, burst, max_concurrency, adaptive, max_attempts), for the limiters created from now on
+    """
+    with _lock:
+        LIMITS[service] = {**LIMITS.get(service, DEFAULT_LIMITS), **limits}
+        for key in [key for key in _limiters if key[0] == service]:
+            del _limiters[key]
+
+
+def get_limiter(service: str, region: str = None) -> RateLimiter:
+    """
+    shared limiter of a service in a region
+    """
+    with _lock:
+        key = (service, region)
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(f'{service} {region}', **LIMITS.get(service, DEFAULT_LIMITS))
+        return _limiters[key]
+
+
+def get_client_limiter(client) -> RateLimiter:
+    """
+    shared limiter of the service and region of a boto3 client
+    """
+    return get_limiter(client.meta.service_model.service_name, client.meta.region_name)
+
+
+def log_stats():
+    with _lock:
+        limiters = list(_limiters.values())
+    for limiter in limiters:
+        if limiter.calls:
+            limiter.log_stats()
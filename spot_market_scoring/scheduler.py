@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""scheduler.py
+
+    Small DAG runner for the update pipeline. Every stage declares the
+    artifacts it needs and the artifacts it produces, a stage starts as soon
+    as all its inputs are produced, so independent stages run concurrently
+    and the wall time approaches the critical path instead of the sum of
+    the stages.
+
+    Concurrency is limited per pool (e.g. 'ec2', 'pricing', 'mongo') on top
+    of the total number of worker threads. Among the ready stages the one
+    with the longest remaining path (by estimated cost) starts first.
+    A failed stage skips the stages that depend on it, the others go on.
+
+    Classes:
+        Stage
+        StageScheduler
+
+"""
+import time
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from spot_market_scoring import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    def __init__(self, name: str, func, inputs: list = (), outputs: list = (),
+                 pool: str = 'default', group: str = None, cost: float = 1.0):
+        """
+        init
+        :param name: unique stage name
+        :param func: callable(inputs) with inputs the dict artifact -> value of the stage's inputs,
+                     returns the value of its single output, or a dict output -> value if it has several
+        :param inputs: names of the artifacts the stage needs
+        :param outputs: names of the artifacts the stage produces
+        :param pool: concurrency pool, see StageScheduler limits
+        :param group: metrics stage name, defaults to name, e.g. one name for the stages of all regions
+        :param cost: estimated duration, used to start the longest remaining paths first
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.pool = pool
+        self.group = group or name
+        self.cost = cost
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, inputs={self.inputs}, outputs={self.outputs}, pool={self.pool!r})'
+
+
+class StageScheduler:
+    def __init__(self, stages: list, max_workers: int = 32, limits: dict = None):
+        """
+        init
+        :param stages: [Stage], artifacts needed but produced by no stage raise ValueError
+        :param max_workers: threads running stages, 1 runs the stages one after another
+        :param limits: pool -> maximum number of its stages running at once, unlimited if missing
+        """
+        self.stages = {}
+        self.producers = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f'duplicate stage {stage.name}')
+            self.stages[stage.name] = stage
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f'{output} is produced by {self.producers[output]} and {stage.name}')
+                self.producers[output] = stage.name
+        for stage in stages:
+            missing = [i for i in stage.inputs if i not in self.producers]
+            if missing:
+                raise ValueError(f'{stage.name} needs {missing}, produced by no stage')
+
+        self.max_workers = max(1, max_workers)
+        self.limits = limits or {}
+        self.dependencies = {name: {self.producers[i] for i in stage.inputs}
+                             for name, stage in self.stages.items()}
+        self.dependents = {name: set() for name in self.stages}
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                self.dependents[dep].add(name)
+        self.priority = self._get_priority()
+
+        self.artifacts = {}
+        self.durations = {}
+        self.failed = {}
+        self.skipped = set()
+
+    def _get_priority(self) -> dict:
+        """
+        cost of the longest path from every stage to the end, raises ValueError on cycles
+        """
+        priority, visiting = {}, set()
+
+        def visit(name):
+            if name in priority:
+                return priority[name]
+            if name in visiting:
+                raise ValueError(f'dependency cycle through {name}')
+            visiting.add(name)
+            tail = max((visit(dep) for dep in self.dependents[name]), default=0)
+            visiting.discard(name)
+            priority[name] = self.stages[name].cost + tail
+            return priority[name]
+
+        for name in self.stages:
+            visit(name)
+        return priority
+
+    def _run_stage(self, stage: Stage, inputs: dict):
+        start = time.perf_counter()
+        with metrics.stage(stage.group):
+            result = stage.func(inputs)
+        self.durations[stage.name] = time.perf_counter() - start
+        if len(stage.outputs) == 1:
+            return {stage.outputs[0]: result}
+        result = result or {}
+        return {output: result.get(output) for output in stage.outputs}
+
+    def _skip(self, name: str, reason: str):
+        for dependent in self.dependents[name]:
+            if dependent not in self.skipped:
+                self.skipped.add(dependent)
+                logger.error(f'[ERR] {dependent} skipped: {reason}')
+                self._skip(dependent, reason)
+
+    def run(self) -> dict:
+        """
+        run all stages
+        :return: artifact -> value of the stages that succeeded, see failed and skipped for the others
+        """
+        waiting = {name: set(deps) for name, deps in self.dependencies.items()}
+        ready = [name for name, deps in waiting.items() if not deps]
+        running = {}
+        pool_usage = {}
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='stage') as executor:
+            while ready or running:
+                ready.sort(key=lambda n: -self.priority[n])
+                for name in list(ready):
+                    if len(running) >= self.max_workers:
+                        break
+                    stage = self.stages[name]
+                    if pool_usage.get(stage.pool, 0) >= self.limits.get(stage.pool, self.max_workers):
+                        continue
+                    ready.remove(name)
+                    pool_usage[stage.pool] = pool_usage.get(stage.pool, 0) + 1
+                    inputs = {i: self.artifacts[i] for i in stage.inputs}
+                    future = executor.submit(contextvars.copy_context().run, self._run_stage, stage, inputs)
+                    running[future] = name
+                    logger.debug(f'{name} started')
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    stage = self.stages[name]
+                    pool_usage[stage.pool] -= 1
+                    try:
+                        self.artifacts.update(future.result())
+                    except Exception as e:
+                        logger.exception(f'[ERR] {name} failed')
+                        self.failed[name] = e
+                        self._skip(name, f'{name} failed: {e}')
+                        continue
+                    for dependent in self.dependents[name]:
+                        waiting[dependent].discard(name)
+                        if not waiting[dependent] and dependent not in self.skipped:
+                            ready.append(dependent)
+
+        logger.info(f'{len(self.stages)} stages finished in {time.perf_counter() - start:.3f} seconds, '
+                    f'failed: {sorted(self.failed)}, skipped: {len(self.skipped)}')
+        return self.artifacts
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""score_publisher.py
+
+    Staged publish of spot_market_scores.scores. The scoring tasks of a run
+    insert their scores into a staging collection, publish then swaps it in
+    with one rename over the live collection, so readers of read_from_mongo
+    see either the previous or the new scores of every region/system, never
+    an empty or partial set, and no documents are deleted one by one.
+
+    Region/systems without scores in the run keep their current documents,
+    they are copied into the staging collection before the swap; a failed
+    write removes what it staged, so the region/system keeps its current
+    documents too. The
+    indexes of the live collection are built on the staging collection once
+    its documents are loaded.
+
+    PUBLISH_MODES: 'staged', or 'in_place' for the former delete and insert
+    per region/system (spot_market_scoring.write_to_mongo).
+
+    Classes:
+        ScorePublisher
+
+"""
+import logging
+import threading
+from spot_market_scoring import metrics
+from spot_market_scoring.mongo_writer import BulkWriter
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_MODES = ['staged', 'in_place']
+INDEX_OPTIONS = ['unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds', 'collation']
+
+
+class ScorePublisher:
+    def __init__(self, dbclient, database: str = 'spot_market_scores', collection: str = 'scores'):
+        """
+        init
+        :param collection: live collection, staged as <collection>_staging
+        """
+        self.db = dbclient[database]
+        self.name = collection
+        self.staging_name = f'{collection}_staging'
+        self.written = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        drop what a failed run left in the staging collection
+        """
+        self.db.drop_collection(self.staging_name)
+        with self._lock:
+            self.written = set()
+        return self
+
+    def write(self, df, region: str, system: str):
+        """
+        stage the scores of region/system
+        :param df: scores in long format, one document per row
+        """
+        staging = self.db[self.staging_name]
+        try:
+            with BulkWriter(staging) as writer:
+                writer.insert_many(df.to_dict(orient='records'))
+        except Exception:
+            # batches flushed before the failure are removed, the region/system keeps its live scores
+            staging.delete_many({'Region': region, 'System': system})
+            raise
+        with self._lock:
+            self.written.add((region, system))
+
+    def publish(self) -> bool:
+        """
+        swap the staged scores in, the region/systems not staged keep their current scores
+        :return: False if nothing was staged, the live collection is left as is
+        """
+        with self._lock:
+            written = set(self.written)
+        if not written:
+            metrics.add('errors')
+            logger.error(f'[ERR] no scores staged, {self.name} is not published')
+            return False
+
+        live, staging = self.db[self.name], self.db[self.staging_name]
+        # every live document but the scores of the staged region/systems, whatever its region/system
+        kept = {'$nor': [{'Region': region, 'System': system} for region, system in sorted(written)]}
+        with BulkWriter(staging) as writer:
+            writer.insert_many(live.find(kept, {'_id': 0}))
+
+        # indexes are built once on the loaded collection instead of maintained per insert
+        for name, spec in live.index_information().items():
+            if name != '_id_':
+                staging.create_index(spec['key'], name=name, **{k: v for k, v in spec.items() if k in INDEX_OPTIONS})
+        staging.rename(self.name, dropTarget=True)
+        logger.info(f'{self.name} published: {len(written)} region/systems scored, '
+                    f'{writer.documents} documents keep their current scores')
+        return True
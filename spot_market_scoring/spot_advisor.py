@@ -26,12 +26,15 @@ import pandas as pd
 import logging
 from datetime import date, datetime
 from spot_market_scoring.mappings import SYSTEM_MAP
-from spot_market_scoring.utils import normalize_by_columns
+from spot_market_scoring.utils import normalize_by_columns, to_categorical
+from spot_market_scoring.mongo_writer import BulkWriter
 
 balanced_optim = {'savings_weight': 1,
                   'interruptions_weight': 1}
 
 logger = logging.getLogger(__name__)
+
+IDENTIFIERS = ['Region', 'ProductDescription', 'InstanceType']
 def get_spot_advisor_data(path=None, file_date: [str, date] = None, dbclient = None, local=False) -> dict:
     """
     load spot_advisor data from path, if file does not exist,
@@ -182,7 +185,7 @@ def filter_spot_price(response: dict, region: [list, str] = None,
     if isinstance(region, str):
         region = [region]
 
-    df = pd.DataFrame(flatten(response))
+    df = to_categorical(pd.DataFrame(flatten(response)), IDENTIFIERS)
     no_filter_r = region == ['*']
     no_filter_p = product_description == ['*']
     no_filter_i = instance_type == ['*']
@@ -208,7 +211,7 @@ def model(response: dict, savings_weight=1, interruptions_weight=1,
                 ) + +s * i * (scores[op]['InstanceType']['Savings'][instance])
         x['Score'] = score
 
-    df = pd.DataFrame.from_dict(flatten_response)
+    df = to_categorical(pd.DataFrame.from_dict(flatten_response), IDENTIFIERS)
     df = normalize_by_columns(df, ['Score'])
     df.drop(['InterruptionRate'], axis=1, inplace=True)
     df.drop(['SavingsOverOnDemand'], axis=1, inplace=True)
@@ -225,7 +228,7 @@ def alt_model(response: dict, savings_weight=1, interruptions_weight=1) -> pd.Da
     for x in flatten_response:
         x['Score'] = s * 7 * (x['SavingsOverOnDemand']) + r * np.exp(2 - x['InterruptionRate'] / 2)
 
-    df = pd.DataFrame.from_dict(flatten_response)
+    df = to_categorical(pd.DataFrame.from_dict(flatten_response), IDENTIFIERS)
     df = normalize_by_columns(df, ['Score'])
     df.drop(['InterruptionRate'], axis=1, inplace=True)
     df.drop(['SavingsOverOnDemand'], axis=1, inplace=True)
@@ -264,7 +267,8 @@ def average_by_columns(df, columns: []) -> dict:
 
         scores = {}
 
-        for name, g in df.groupby(col):
+        # categories of other systems would show up as empty groups
+        for name, g in df.groupby(col, observed=True):
             # percentage of IR == 0 per group
             interruption_score = (g[g['InterruptionRate'] < 2].size / g.size)
 
@@ -281,10 +285,10 @@ def score_by_operating_system(response: dict) -> dict:
     Split by Operating Systems and then get average IR and Savings
     across Region and Instance Type
     """
-    df = pd.DataFrame(flatten(response))
+    df = to_categorical(pd.DataFrame(flatten(response)), IDENTIFIERS)
     op_score = {}
 
-    for op, op_df in df.groupby('ProductDescription'):
+    for op, op_df in df.groupby('ProductDescription', observed=True):
 
         cols = ['Region', 'InstanceType']
         score_list = average_by_columns(op_df,cols)
@@ -305,7 +309,8 @@ def write_to_mongo(dbclient, response, file_date):
         'date': file_date,
         'data': response
     }
-    db.spot_advisor.update({'date': file_date}, spot_advisor,upsert=True)
+    with BulkWriter(db.spot_advisor) as writer:
+        writer.replace_one({'date': file_date}, spot_advisor, upsert=True)
     return
 
 
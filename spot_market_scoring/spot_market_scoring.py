@@ -3,8 +3,11 @@ import pandas as pd
 import logging
 from spot_market_scoring import spot_price_history as sph
 from spot_market_scoring import random_forest as rdf
+from spot_market_scoring import metrics
+from spot_market_scoring.mongo_writer import BulkWriter
+from spot_market_scoring.score_publisher import ScorePublisher
 from spot_market_scoring.mappings import *
-from spot_market_scoring.utils import normalize_by_columns,ParquetTranscoder
+from spot_market_scoring.utils import normalize_by_columns, to_categorical, ParquetTranscoder
 from spot_market_scoring.concurrent_task import *
 
 logger = logging.getLogger(__name__)
@@ -23,86 +26,156 @@ def calculate_scores(df, r_col, az_cols):
     return df
 
 
-def get_scores(ondemand, sa_response, s3client, dbclient):
-
+def get_scores(ondemand, sa_response, s3client, dbclient, forecaster=None, storage=None, publish='staged'):
+    """
+    calculate and save scores of all regions/systems
+    :param forecaster: object with predict(ins_dict, region, system), e.g. forecast_engine.ForecastEngine,
+                       defaults to random_forest.get_predicted_price in the scoring threads
+    :param storage: spot price history storage, see history_storage
+    :param publish: 'staged' swaps all new scores in at once, 'in_place' rewrites every region/system
+                    as it is scored, see score_publisher
+    """
     regions = sorted(REGION_CODE_MAP.keys())
     executor = ThreadPoolExecutor()
+    publisher = ScorePublisher(dbclient).start() if publish == 'staged' else None
 
     ConcurrentTaskPool(executor).add([
         ConcurrentTask(executor, task=get_scores_helper,
-                       t_args=(ondemand,sa_response, region, system, s3client,dbclient))
+                       t_args=(ondemand,sa_response, region, system, s3client,dbclient),
+                       t_kwargs={'forecaster': forecaster, 'storage': storage, 'publisher': publisher})
         for system in SYSTEM_LIST for region in regions
-    ])
-
+    ]).get_results()
 
+    if publisher is not None:
+        publisher.publish()
     return True
 
 
-def get_scores_helper(ondemand,sa_response, region, system, s3client, dbclient):
-    ## region -> sys -> ins
-    columns = ['Region', 'System', 'InstanceType', 'InstanceScores', 'AZScores']
-    start = time.time()
-    # some instance are
-    # ignored if missing On Demand/Spot Advisor data
-    # iterate through price history's list
-
-    #print(f'----calculating for {region} {system}----')
-
-    scores = []
-    res_avg, res_std, ins_dict = sph.get_savings_statistics(region=region, days_back=30,
-                                                            system=system, s3client=s3client, year=2021,
-                                                            period="Month")
-    ins_pred = rdf.get_predicted_price(ins_dict, 2021)
-    ins_price = ondemand[(ondemand['Region'] == region)
-                         & (ondemand['OperatingSystem'] == system)]
-
-    for ins in ins_price['InstanceType'].unique():
-        ins_scores = {}
-        # on demand price
-        od_price = ins_price[ins_price['InstanceType'] == ins]['OnDemand']
-        od_price = float(od_price)
-        try:
+def to_long_frame(nested: dict, value_name: str) -> pd.DataFrame:
+    """
+    flatten {InstanceType: {AvailabilityZone: value}} into long format
+    :param nested: per instance dict of az values, as returned by get_savings_statistics
+    :param value_name: name of the value column
+    :return: DataFrame with InstanceType, AvailabilityZone, value_name
+    """
+    records = [(ins, az, value) for ins, az_dict in nested.items() for az, value in az_dict.items()]
+    return pd.DataFrame(records, columns=['InstanceType', 'AvailabilityZone', value_name])
+
+
+def get_scores_frame(ins_price, sa_scores, res_avg, res_std, ins_pred, region, system) -> pd.DataFrame:
+    """
+    columnar scoring for one region/system
+    :param ins_price: rows of the ondemand table for region/system
+    :param sa_scores: spot advisor data of the system -> InstanceType -> r, s
+    :param res_avg: InstanceType -> AvailabilityZone -> average spot price
+    :param res_std: InstanceType -> AvailabilityZone -> std of spot price
+    :param ins_pred: InstanceType -> AvailabilityZone -> predicted spot price
+    :return: scores by instance type, columns Region, System, InstanceType, r, s, AZs...
+    """
+    keys = ['InstanceType', 'AvailabilityZone']
+
+    # instances without exactly one on demand price cannot be scored
+    od = ins_price[['InstanceType', 'OnDemand']].astype({'OnDemand': float})
+    invalid = od['InstanceType'].duplicated(keep=False) | (od['OnDemand'] == 0)
+    for ins in od.loc[invalid, 'InstanceType'].unique():
+        logger.error(f'Calculate score failed: {region}, {system}, {ins}')
+    od = od.loc[~invalid].set_index('InstanceType')['OnDemand']
+
+    az_df = to_long_frame(res_avg, 'Avg')
+    az_df = az_df.merge(to_long_frame(res_std, 'Std'), how='left', on=keys)
+    az_df = az_df.merge(to_long_frame(ins_pred, 'Pred'), how='left', on=keys, indicator=True)
+
+    # every az with history needs a prediction, and spot advisor data is required
+    incomplete = set(az_df.loc[az_df['_merge'] == 'left_only', 'InstanceType'])
+    instances = []
+    for ins in od.index:
+        if ins in incomplete or ins not in res_avg or ins not in ins_pred or ins not in sa_scores:
+            logger.error(f'Missing data: {region}, {system}, {ins}')
+            continue
+        instances.append(ins)
 
-            # random forest ->get prediction price
-            pred_savings = {az: 1 - (ins_pred[ins][az] / od_price) for az in ins_pred[ins]}
+    if not instances:
+        return pd.DataFrame()
 
-            # spot_price_history
-            savings_rate = {az: 1 - (res_avg[ins][az] / od_price) for az in res_avg[ins]}
-            std = {az: res_std[ins][az] for az in res_std[ins]}
+    # keep the instance order of the ondemand table, az order of first appearance
+    rank = pd.Series(range(len(instances)), index=instances)
+    az_df = az_df.loc[az_df['InstanceType'].isin(rank.index)]
+    az_df = az_df.iloc[np.argsort(rank[az_df['InstanceType']].values, kind='mergesort')]
 
-            # combine predicted savings and previous savings to instance score
-            avg_savings = {az: (pred_savings[az]+savings_rate[az])/2 for az in res_avg[ins]}
-            ins_az_scores = {az: 1 * avg_savings[az] - std[az] for az in savings_rate}
+    od_price = od[az_df['InstanceType']].values
+    pred_savings = 1 - az_df['Pred'].values / od_price
+    savings_rate = 1 - az_df['Avg'].values / od_price
+    az_df = az_df.assign(Score=(pred_savings + savings_rate) / 2 - az_df['Std'].values)
 
+    az_scores = az_df.pivot(index='InstanceType', columns='AvailabilityZone', values='Score')
+    az_scores = az_scores.reindex(index=instances, columns=az_df['AvailabilityZone'].unique())
+    az_scores.columns.name = None
 
-            # spot advisor data -> get interruption/saving's data
-            ins_scores['InstanceScores'] = sa_response[region][SYSTEM_MAP[system]][ins]
-            ins_scores['AZScores'] = ins_az_scores
-            scores.append(dict(zip(columns,
-                                   [region, system, ins, ins_scores['InstanceScores'],
-                                    ins_scores['AZScores']])))
-        except KeyError:
-            logger.error(f'Missing data: {region}, {system}, {ins}')
-        except Exception:
-            logger.exception(f'Calculate score failed: {region}, {system}, {ins}')
-            continue
+    scores_df = pd.concat([
+        pd.DataFrame({'Region': region, 'System': system, 'InstanceType': instances}),
+        pd.DataFrame.from_dict({ins: sa_scores[ins] for ins in instances}, orient='index').reset_index(drop=True),
+        az_scores.reset_index(drop=True)
+    ], axis=1)
 
-    scores_df = pd.DataFrame(scores)
-    scores_df = pd.concat([scores_df, scores_df['InstanceScores'].apply(pd.Series)], axis=1).drop('InstanceScores',axis=1)
-    scores_df = pd.concat([scores_df, scores_df['AZScores'].apply(pd.Series)], axis=1).drop('AZScores', axis=1)
     scores_df.fillna(0, inplace=True)
-    scores_df['r'] = scores_df['r'].apply(lambda x: np.exp(1 - x))
+    scores_df['r'] = np.exp(1 - scores_df['r'])
     scores_df = normalize_by_columns(scores_df, scores_df.columns[3:])
     scores_df = calculate_scores(scores_df, 'r', scores_df.columns[5:])
 
     scores_df = scale_to_100(normalize_by_columns(scores_df, scores_df.columns[5:]), scores_df.columns[5:])
+    return scores_df
+
+
+def get_scores_helper(ondemand,sa_response, region, system, s3client, dbclient, forecaster=None, storage=None,
+                      publisher=None):
+    """
+    scores of one region/system; an error is logged and counted in the run metrics (metrics.task), not raised,
+    so the region/system keeps its previous scores and the others are still published
+    :param publisher: score_publisher.ScorePublisher staging the scores, written in place if None
+    """
+    try:
+        with metrics.task(region, system):
+            return _get_scores_helper(ondemand, sa_response, region, system, s3client, dbclient,
+                                      forecaster, storage, publisher)
+    except Exception:
+        logger.exception(f'[ERR] {region} {system}: calculate scores failed')
+        return []
+
+
+def _get_scores_helper(ondemand,sa_response, region, system, s3client, dbclient, forecaster=None, storage=None,
+                       publisher=None):
+    ## region -> sys -> ins
+    start = time.time()
+    # some instance are
+    # ignored if missing On Demand/Spot Advisor data
+
+    res_avg, res_std, ins_dict = sph.get_savings_statistics(region=region, days_back=90,
+                                                            system=system, s3client=s3client, year=2021,
+                                                            period="Month", storage=storage)
+    if forecaster is None:
+        ins_pred = rdf.get_predicted_price(ins_dict, 2021)
+    else:
+        ins_pred = forecaster.predict(ins_dict, region, system)
+    ins_price = ondemand[(ondemand['Region'] == region)
+                         & (ondemand['OperatingSystem'] == system)]
+
+    scores_df = get_scores_frame(ins_price, sa_response.get(region, {}).get(SYSTEM_MAP[system], {}),
+                                 res_avg, res_std, ins_pred, region, system)
+    if scores_df.empty:
+        logger.error(f'No scores calculated: {region}, {system}')
+        return []
+
     df = scores_df.melt(id_vars=["Region", "System", "InstanceType", 'r', 's'],
                    var_name="AvailabilityZone",
                    value_name="Score")
     df.drop(columns=['r', 's'], inplace=True)
+    df = to_categorical(df, ['Region', 'System', 'InstanceType', 'AvailabilityZone'])
 
     # write_to_s3(s3client,df,region,system)
-    write_to_mongo(dbclient,df,region,system)
+    if publisher is None:
+        write_to_mongo(dbclient,df,region,system)
+    else:
+        publisher.write(df, region, system)
     end = time.time()
     logger.info(f'{region} {system} Finished with: {end - start} seconds')
     return scores_df.to_dict(orient='records')
@@ -171,9 +244,9 @@ def read_from_mongo(dbclient, region=None, system=None, azs=None, instanceTypes=
 
 def write_to_mongo(dbclient, df, region, system):
     db = dbclient['spot_market_scores']
-    db.scores.delete_many({"Region": region, "System": system})
-
     data_dict = df.to_dict(orient='records')
 
-    db.scores.insert_many(data_dict)
+    with BulkWriter(db.scores) as writer:
+        writer.delete_many({"Region": region, "System": system})
+        writer.insert_many(data_dict)
     return
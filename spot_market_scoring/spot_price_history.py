@@ -10,64 +10,159 @@
     5. save scores
 
     Functions:
-        get_spot_price_history
+        iter_spot_price_history
+        get_spot_price_frame
+        write_spot_price_history
         get_spot_price_history_in_all_region
         upload_all_spot_price_history_to_s3
         get_savings_statistics_by_region
         generate_spot_instance_list
         read_spot_price_history
 
+    Classes:
+        ChunkBuilder
+
     Helper Functions:
 
 """
 import os
 import boto3
+import numpy as np
 import pandas as pd
 import logging
 from datetime import datetime, timezone,timedelta
 from spot_market_scoring.concurrent_task import *
 from spot_market_scoring.mappings import *
 from spot_market_scoring.utils import *
+from spot_market_scoring import price_statistics as ps
+from spot_market_scoring import history_storage as hs
+from spot_market_scoring import history_loader as hl
+from spot_market_scoring import history_cache
+from spot_market_scoring import history_shards as hsh
+from spot_market_scoring import metrics
+from spot_market_scoring.price_matrix import PriceMatrix
+from spot_market_scoring.mongo_writer import BulkWriter
 
 logger = logging.getLogger(__name__)
 
-def get_spot_price_history(client, region, days_back: int = 30,
-                           productDescription: str = None,
-                           availabilityZone: str = None,
-                           instanceType: str = None) -> list:
-    """
-    Get spot price history for up to 90 days back in client's region
-    :param client: ec2 client
-    :param days_back: [0,90]
-    :param availabilityZone: azs in clients's region
-    :param productDescription: operation systems,
-    """
-    # set filters
+# records converted at once by iter_spot_price_history
+CHUNK_SIZE = 50000
+
 
+def _get_filters(days_back, productDescription=None, availabilityZone=None, instanceType=None,
+                 window: tuple = None) -> dict:
     filters = {}
-    start_time = datetime.now(timezone.utc) - timedelta(hours=24*days_back)
-    filters['StartTime'] = start_time
+    if window:
+        filters['StartTime'] = window[0]
+        if window[1] is not None:
+            filters['EndTime'] = window[1]
+    else:
+        filters['StartTime'] = datetime.now(timezone.utc) - timedelta(hours=24*days_back)
     if availabilityZone:
         filters['AvailabilityZone'] = availabilityZone
     if instanceType:
         filters['InstanceTypes'] = [instanceType]
     if productDescription:
         filters['ProductDescriptions'] = [productDescription]
+    return filters
 
-    try:
-        indices = None
-        values = []
-        for resp in paginate(client.describe_spot_price_history, **filters):
-            if indices is None:
-                indices = list(resp.keys())
-            values.append(list(resp.values()))
-        return values
 
+def iter_spot_price_history(client, region, days_back: int = 30,
+                            productDescription: str = None,
+                            availabilityZone: str = None,
+                            instanceType: str = None,
+                            chunk_size: int = CHUNK_SIZE,
+                            window: tuple = None):
+    """
+    spot price history as typed frames of at most chunk_size records (see history_loader),
+    the records of the pages are written into arrays per field as they arrive,
+    so that only one chunk of boto3 records is alive at a time
+    :param client: ec2 client
+    :param days_back: [0,90]
+    :param window: (StartTime, EndTime or None) instead of the last days_back days, see history_shards
+    """
+    filters = _get_filters(days_back, productDescription, availabilityZone, instanceType, window)
+    builder = ChunkBuilder(region, chunk_size)
+    for item in paginate(client.describe_spot_price_history, **filters):
+        chunk = builder.add(item)
+        if chunk is not None:
+            yield chunk
+    chunk = builder.flush()
+    if chunk is not None:
+        yield chunk
+
+
+class ChunkBuilder:
+    def __init__(self, region: str, chunk_size: int = CHUNK_SIZE):
+        """
+        spot price history records written into arrays per field, converted to a typed frame every chunk_size
+        records (see history_loader), so that only one chunk of boto3 records is alive at a time
+        """
+        self.region = region
+        self.chunk_size = chunk_size
+        self._n = 0
+        self._chunk = None
+
+    def add(self, item: dict) -> pd.DataFrame:
+        """
+        :return: the frame of the chunk the item completed, None if it is not complete
+        """
+        if self._chunk is None:
+            self._chunk = {col: np.empty(self.chunk_size, dtype=object) for col in hl.STRING_COLUMNS + ['Timestamp']}
+            self._chunk['SpotPrice'] = np.empty(self.chunk_size, dtype='float64')
+        chunk, n = self._chunk, self._n
+        for col in hl.STRING_COLUMNS:
+            chunk[col][n] = item[col]
+        chunk['SpotPrice'][n] = float(item['SpotPrice'])
+        chunk['Timestamp'][n] = item['Timestamp']
+        self._n += 1
+        return self.flush() if self._n == self.chunk_size else None
+
+    def flush(self) -> pd.DataFrame:
+        """
+        :return: the frame of the records added since the last chunk, None if there are none
+        """
+        chunk, n = self._chunk, self._n
+        self._chunk, self._n = None, 0
+        return _to_chunk(chunk, n, self.region) if n else None
+
+
+def _to_chunk(chunk: dict, n: int, region: str) -> pd.DataFrame:
+    metrics.add('rows_fetched', n)
+    return hl.load_history(pd.DataFrame({col: chunk[col][:n] for col in hl.COLUMNS}),
+                           name=f'{region} fetched chunk')
+
+
+def get_spot_price_frame(client, region, days_back: int = 30,
+                         productDescription: str = None,
+                         chunk_size: int = CHUNK_SIZE,
+                         shards: int = 1) -> pd.DataFrame:
+    """
+    spot price history of the last days_back days as one typed frame,
+    empty if the fetch fails (logged and counted as an error)
+    :param shards: time windows fetched in parallel and merged, see history_shards
+    """
+    try:
+        if shards <= 1:
+            return hl.concat_history(list(iter_spot_price_history(client, region, days_back, productDescription,
+                                                                  chunk_size=chunk_size)))
+        windows = hsh.get_windows(days_back, shards)
+        with ThreadPoolExecutor(len(windows)) as executor:
+            frames = ConcurrentTaskPool(executor).add([
+                ConcurrentTask(executor, task=_get_window_frame,
+                               t_args=(client, region, days_back, productDescription, chunk_size, window))
+                for window in windows
+            ]).get_results()
+        return hsh.merge_shards(frames)
     except Exception as e:
-        logging.error(f'[ERR] {region}, {productDescription}: {e}')
-
+        metrics.add('errors')
+        logger.error(f'[ERR] {region}, {productDescription}: {e}')
+        return hl.load_history(None)
 
 
+def _get_window_frame(client, region, days_back, productDescription, chunk_size, window) -> pd.DataFrame:
+    return hl.concat_history(list(iter_spot_price_history(client, region, days_back, productDescription,
+                                                          chunk_size=chunk_size, window=window)))
 
 
 def read_from_local(path, region,
@@ -78,18 +173,20 @@ def read_from_local(path, region,
                           'ProductDescription=' + ParquetTranscoder.encode(system),
                           'InstanceType=' + instanceType,
                           f'{year}.csv')
-    return pd.read_csv(i_path)
+    return hl.read_csv(i_path, name=i_path)
 
 
 def update_spot_price_history_in_all_region(clients: [boto3.client],
                                              year: int, days_back=30,
-                                            s3client: boto3.client = None,dbclient=None,path: str="", local: bool = True):
+                                            s3client: boto3.client = None,dbclient=None,path: str="", local: bool = True,
+                                            storage=None):
     """
     Get spot price history for all regions and save to local path
     :param clients: list of ec2 clients in all region
     :param days_back: [0,90]
     :param path: files will be saved in path/spot_price_history/..
     :param year: current year, corresponding to different file
+    :param storage: history_storage.CSVHistoryStorage (default) or ParquetHistoryStorage
     """
     # if not os.path.exists(path):
     #     print(f"{path} does not exists")
@@ -100,67 +197,113 @@ def update_spot_price_history_in_all_region(clients: [boto3.client],
     response = ConcurrentTaskPool(executor).add([
         ConcurrentTask(executor, task=update_spot_price_history,
                        t_args=(clients[region], s3client,dbclient,region,
-                               prod,days_back,year))
+                               prod,days_back,year), t_kwargs={'storage': storage})
         for prod in SYSTEM_LIST for region in regions
     ]).get_results()
     return response
 
 
-def update_spot_price_history(client, s3client, dbclient, region, system,days_back,year):
+def update_spot_price_history(client, s3client, dbclient, region, system, days_back, year, storage=None):
+    with metrics.task(region, system):
+        return _update_spot_price_history(client, s3client, dbclient, region, system, days_back, year, storage)
+
+
+def _update_spot_price_history(client, s3client, dbclient, region, system,days_back,year, storage=None):
     """
     upload local data to s3 bucket
     with key: regions/productdescription/instancttype/year.csv
     :param client: s3 clients
-    :param
+    :param storage: history_storage.CSVHistoryStorage (default) or ParquetHistoryStorage
+    :return: the fetched records
     """
-    indices = ['AvailabilityZone', 'InstanceType', 'ProductDescription', 'SpotPrice', 'Timestamp']
-    response = get_spot_price_history(client,region,days_back,system)
-    df = pd.DataFrame(response, columns=indices)
-
-    try:
-        prev_df = read_from_s3(s3client, region, system, year)
+    # large region/systems are fetched in shards, sized by the records of the last run
+    shards = hsh.get_shard_count(dbclient, region, system, days_back)
+    new_df = get_spot_price_frame(client, region, days_back, system, shards=shards)
+    return write_spot_price_history(new_df, s3client, dbclient, region, system, year, storage, days_back)
 
-        df = pd.concat((prev_df,df))
-        df['SpotPrice'] = df['SpotPrice'].astype('float')
-        df.sort_values(['InstanceType', 'AvailabilityZone', 'Timestamp'],inplace=True)
-        df.drop_duplicates(inplace=True)
-        df.reset_index(drop=True,inplace=True)
 
-        write_to_s3(df, s3client, region, system, year)
+def write_spot_price_history(new_df, s3client, dbclient, region, system, year, storage=None, days_back=None):
+    """
+    write fetched records: history storage, statistics, history cache and the instance list in mongo
+    :param new_df: fetched records, see get_spot_price_frame
+    :param storage: history_storage.CSVHistoryStorage (default) or ParquetHistoryStorage
+    :param days_back: days fetched, the records per day are stored for the shards of the next run
+    :return: new_df
+    """
+    storage = storage or hs.CSVHistoryStorage()
+    df = new_df
+    cache = history_cache.get_cache()
+    try:
+        # csv: the whole year, parquet: the partitions of the new records, deltas: the new records
+        df = storage.update(new_df, s3client, region, system, year)
+        if isinstance(storage, hs.CSVHistoryStorage):
+            cache.put_history(storage.name, region, system, year, df)
+        else:
+            cache.add_history(storage.name, region, system, year, new_df)
         # logger.error(f"{region} {system} updated")
+        stats = ps.update_statistics(s3client, region, system, new_df,
+                                     history=lambda: read_from_s3(s3client, region, system, year, storage=storage))
+        # scoring of region/system reuses them, see get_savings_statistics
+        cache.put_statistics(region, system, stats)
     except Exception as e:
+        metrics.add('errors')
         logger.error(f'[ERR] {region} {system}: {e}')
 
     db = dbclient['aws_data']
-    ins_list = df['InstanceType'].unique().tolist()
     filter = {
         "region": region,
         "system": system
     }
     update = {
-        "$set": {"InstanceList": ins_list}
+        "$set": {}
     }
-    db.ec2_spot_instances.update(filter, update, upsert=True)
+    # parquet and delta storages return only the fetched records: a failed or empty fetch
+    # keeps the stored instance list instead of emptying it, an empty one is only inserted
+    if len(df):
+        update["$set"]["InstanceList"] = df['InstanceType'].unique().tolist()
+    else:
+        update["$setOnInsert"] = {"InstanceList": []}
+    if days_back and len(new_df):
+        update["$set"][hsh.RECORDS_FIELD] = len(new_df) / days_back
+    if not update["$set"]:
+        del update["$set"]
+    with BulkWriter(db.ec2_spot_instances) as writer:
+        writer.update_one(filter, update, upsert=True)
 
-    return response
+    return new_df
 
 
 def get_savings_statistics(region: str, system:str,
                            year: int=2021, period="Month",
-                           s3client=None, days_back=90):
+                           s3client=None, days_back=90, statistics: bool = True, storage=None):
+    """
+    mean/std of spot prices over period and daily prices by instance type
+    :param days_back: days of history the statistics are computed on
+    :param statistics: use the stored daily statistics of price_statistics if available,
+                       instead of reading and reformatting the history
+    :param storage: history_storage.CSVHistoryStorage (default) or ParquetHistoryStorage
+    :return: InstanceType -> AvailabilityZone -> mean, same for std, InstanceType -> daily prices
+    """
+    if statistics:
+        try:
+            stats = history_cache.get_cache().get_statistics(region, system)
+            if stats is None:
+                stats = ps.read_from_s3(s3client, region, system)
+            stats = stats.window(days_back)
+            avg_entries, std_entries = stats.get_mean_and_std(period)
+            return avg_entries, std_entries, stats.get_ins_dict()
+        except Exception as e:
+            logger.info(f'{region} {system} statistics not available, reading history: {e}')
 
     avg_entries, std_entries = {}, {}
-    df = read_from_s3(s3client=s3client, region=region, system=system, year=year)
+    df = read_from_s3(s3client=s3client, region=region, system=system, year=year, days_back=days_back,
+                      storage=storage)
     df.sort_values(['InstanceType', 'AvailabilityZone', 'Timestamp'], inplace=True)
     df.drop_duplicates(inplace=True)
     df.set_index("Timestamp", inplace=True)
-    ins_dict = {}
-    for ins, i_df in df.groupby(by='InstanceType'):
+    ins_dict = reformat_all(df, dtype='float64')
+    for ins, i_df in ins_dict.items():
         try:
-
-            i_df = reformat(i_df)
-            # i_df['Timestamp'] = i_df.index.date
-            ins_dict[ins] = i_df
             response_avg, response_std = get_mean_and_std(i_df, period)
             avg_entries[ins] = response_avg
             std_entries[ins] = response_std
@@ -192,20 +335,46 @@ def to_dataframe(response: dict) :
     return spot_prices
 
 
-def reformat(spot_prices: pd.DataFrame, resolution: str = '1D') -> pd.DataFrame:
-    try:
-        az_df_dict = {az: pd.Series(df['SpotPrice'], name=az) for az, df in spot_prices.groupby("AvailabilityZone")}
-        spot_prices = pd.concat(list(az_df_dict.values()), axis=1)
-        spot_prices.loc[pd.Timestamp.now(tz='UTC')] = spot_prices.tail(1).copy().iloc[0]
-        spot_prices.fillna(method='ffill', inplace=True)
-        spot_prices.fillna(method='bfill', inplace=True)
-
-        spot_prices = spot_prices.resample(resolution).ffill()
-        spot_prices.fillna(method='bfill', inplace=True)
-        # spot_prices.columns = [f'{instanceType}-{c}' for c in spot_prices]
-    except Exception as e:
-        raise
-    return spot_prices
+def reformat_all(spot_prices: pd.DataFrame, resolution: str = '1D', now=None, dtype: str = 'float32') -> PriceMatrix:
+    """
+    reformat every instance type of a region/system in one pass, same frames as the former
+    reformat per instance type (benchmarks.bench_price_statistics.legacy_reformat)
+    :param spot_prices: records indexed by Timestamp, with InstanceType, AvailabilityZone, SpotPrice
+    :param now: last row of the frames, defaults to the current time
+    :param dtype: dtype of the prices
+    :return: InstanceType -> DataFrame(index=resolution labels, columns=az), frames of one matrix
+    """
+    if spot_prices.empty:
+        return {}
+    now = pd.Timestamp.now(tz='UTC') if now is None else now
+    keys = ['InstanceType', 'AvailabilityZone']
+    records = spot_prices.reset_index().sort_values('Timestamp', kind='mergesort')
+    labels = pd.date_range(records['Timestamp'].iloc[0].floor(resolution), pd.Timestamp(now).floor(resolution),
+                           freq=resolution, name='Timestamp')
+
+    # price in effect at a label is the last record at or before it,
+    # i.e. the last record of the records whose ceiling is the label, forward filled
+    records['Label'] = records['Timestamp'].dt.ceil(resolution)
+    last = records.drop_duplicates(keys + ['Label'], keep='last')
+    daily = last.pivot(index='Label', columns=keys, values='SpotPrice').sort_index(axis=1)
+    daily = daily.reindex(labels).ffill()
+    # before its first record an az takes its first price
+    first_price = records.drop_duplicates(keys, keep='first').set_index(keys)['SpotPrice']
+    daily = daily.fillna(first_price)
+
+    # a frame starts at the label of the instance's first record,
+    # that label precedes the record unless it is exactly on it and takes the next label's prices
+    values = daily.to_numpy(dtype='float64', copy=True)
+    first = records.groupby('InstanceType')['Timestamp'].min()
+    columns = daily.columns.get_level_values(0)
+    rows = {}
+    for ins in columns.unique():
+        col = columns.get_loc(ins)
+        rows[ins] = row = labels.searchsorted(first[ins].floor(resolution))
+        if labels[row] < first[ins]:
+            values[row, col] = values[row + 1, col] if row + 1 < len(labels) else np.nan
+    daily = pd.DataFrame(values, index=labels, columns=daily.columns)
+    return PriceMatrix.from_frame(daily, rows, dtype)
 
 
 def get_mean_and_std(df, period: str) -> (dict, dict):
@@ -214,11 +383,7 @@ def get_mean_and_std(df, period: str) -> (dict, dict):
     :param period: time window to calculate mean/std of price by
     return two statistics as dict
     """
-    period_candidates = {'Day': 1,
-                         'Week': 7,
-                         '2 Weeks': 14,
-                         'Month': 30,
-                         '3 Months': 90}
+    period_candidates = PERIOD_MAP
 
     if period not in period_candidates.keys():
         logger.error("Value must be from one of the following: /n", period_candidates.keys())
@@ -229,31 +394,17 @@ def get_mean_and_std(df, period: str) -> (dict, dict):
     else:
         idx = period_candidates[period]
 
-    scores = df.iloc[-idx:]
+    scores = df.iloc[-idx:].astype('float64')
     # logger.info(scores.mean(axis=0),scores.std(axis=0))
     return scores.mean(axis=0).to_dict(), scores.std(axis=0).to_dict()
 
 
-def write_to_s3(df,s3client,region:str,system:str,year:int):
-
-    try:
-        key = (f'ec2/spot_price_history/Region={region}/'
-               f'ProductDescription={ParquetTranscoder.encode(system)}/'
-               f'{year}.csv')
-        df['SpotPrice'] = df['SpotPrice'].astype('string')
-        from io import StringIO
-        # df['Timestamp'] = df.index
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer,index=False)
-        s3client.put_object(
-            Bucket='stompy-aws-dataset',
-            Key=key,
-            Body=csv_buffer.getvalue()
-        )
-
-        return True
-    except Exception as e:
-        raise
+def write_to_s3(df,s3client,region:str,system:str,year:int, storage=None):
+    """
+    :param storage: history_storage.CSVHistoryStorage (default) or ParquetHistoryStorage
+    """
+    storage = storage or hs.CSVHistoryStorage()
+    return storage.write(df, s3client, region, system, year)
 
 
 def write_to_mongo(df,dbclient,region:str,system:str,year:int):
@@ -269,7 +420,8 @@ def write_to_mongo(df,dbclient,region:str,system:str,year:int):
             'year': year,
             'data': data_dict
         }
-        collections.insert_one(data)
+        with BulkWriter(collections) as writer:
+            writer.insert_one(data)
 
         return True
     except Exception as e:
@@ -278,23 +430,19 @@ def write_to_mongo(df,dbclient,region:str,system:str,year:int):
 
 def read_from_s3(s3client, region: str = 'us-east-1',
                  system: str = SYSTEM_LIST[0],
-                 year: int = 2021, days_back=90):
+                 year: int = 2021, days_back=90, storage=None):
+    """
+    spot price history of the last days_back days
+    :param storage: history_storage.CSVHistoryStorage (default) or ParquetHistoryStorage
+    """
+    storage = storage or hs.CSVHistoryStorage()
+    cache = history_cache.get_cache()
     try:
-        key = (f'ec2/spot_price_history/Region={region}/'
-               f'ProductDescription={ParquetTranscoder.encode(system)}/'
-               f'{year}.csv')
-
-        response = s3client.get_object(
-            Bucket='stompy-aws-dataset',
-            Key=key
-        )
-
-        df = pd.read_csv(response.get('Body'))
-        df['Timestamp'] = df['Timestamp'].apply(pd.Timestamp)
         start_day = datetime.now(timezone.utc)-timedelta(days=days_back)
-        df = df.loc[df.Timestamp >= start_day].copy()
-        df['SpotPrice'] = df['SpotPrice'].astype('float')
-
+        df = cache.get_history(storage.name, region, system, year, start_day)
+        if df is None:
+            df = storage.read(s3client, region, system, start=start_day, year=year)
+            cache.put_history(storage.name, region, system, year, df, start_day)
         return df
     except Exception as e:
         logger.error(e)
@@ -317,13 +465,9 @@ def read_from_mongo(dbclient, region: str = 'us-east-1',
 
         response = collections.find_one(filter)
 
-        df = pd.Dataframe(response['data'])
-        df['Timestamp'] = df['Timestamp'].apply(pd.Timestamp)
-        start_day = datetime.today()-timedelta(days=days_back)
-        df = df.loc[df.Timestamp >= start_day].copy()
-        df['SpotPrice'] = df['SpotPrice'].astype('float')
-
-        return df
+        df = hl.load_history(pd.DataFrame(response['data']), name=f'{region} {system} {year} mongo')
+        start_day = datetime.now(timezone.utc)-timedelta(days=days_back)
+        return df.loc[df.Timestamp >= start_day].reset_index(drop=True)
     except Exception as e:
         raise
 
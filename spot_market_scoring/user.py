@@ -1,5 +1,19 @@
+import logging
+import threading
+from collections.abc import Mapping
 import boto3
+from botocore.config import Config
 from spot_market_scoring.mappings import REGION_CODE_MAP
+from spot_market_scoring import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# concurrent calls a client is sized for, the stages running at once (ALGO_STAGE_WORKERS)
+MAX_POOL_CONNECTIONS = 32
+RETRY_MODE = 'standard'
+MAX_ATTEMPTS = 5
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
 
 
 def get_subnet_AZ(ec2_client):
@@ -36,19 +50,88 @@ def get_az_list(clients=None, **credentials):
     AZ = {}
 
     if not clients:
-        clients = get_client_list(regions, **credentials)
+        clients = get_client_list(**credentials)
 
     for region in regions:
         AZ[region] = get_availability_zones(clients[region])
     return AZ
 
 
-def get_client_list(**credentials):
-    regions = REGION_CODE_MAP.keys()
-    clients = {}
-    for region in regions:
-        clients[region] = boto3.client('ec2', region_name=region, **credentials)
-    return clients
+class ClientFactory:
+    def __init__(self, max_pool_connections: int = MAX_POOL_CONNECTIONS, retry_mode: str = RETRY_MODE,
+                 max_attempts: int = MAX_ATTEMPTS, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, wrap=None, limited_services=None, **credentials):
+        """
+        boto3 clients created on first use and shared, one per service/region, from one session
+        :param max_pool_connections: http connections per client, the threads calling a client at once
+        :param retry_mode: botocore retry mode, 'legacy', 'standard' or 'adaptive'
+        :param max_attempts: attempts of a call, the first one included
+        :param wrap: applied to every new client, e.g. metrics.instrument_client
+        :param limited_services: services whose calls go through rate_limiter (the services of its LIMITS by
+                                 default), their clients make one botocore attempt: the limiter retries them
+        :param credentials: aws_access_key_id, aws_secret_access_key
+        """
+        self.config = Config(max_pool_connections=max_pool_connections, connect_timeout=connect_timeout,
+                             read_timeout=read_timeout, retries={'mode': retry_mode, 'total_max_attempts': max_attempts})
+        # botocore retries under the limiter's would multiply the attempts of a throttled call and keep
+        # the throttling from adapting its limits
+        self.limited_config = self.config.merge(Config(retries={'mode': retry_mode, 'total_max_attempts': 1}))
+        self.limited_services = set(rate_limiter.LIMITS if limited_services is None else limited_services)
+        self.session = boto3.session.Session(**credentials)
+        self.wrap = wrap
+        self._clients = {}
+        # creating clients from one session is not thread safe
+        self._lock = threading.Lock()
+
+    def client(self, service: str, region_name: str = None):
+        """
+        shared client of service in region_name, created on the first call
+        """
+        key = (service, region_name)
+        with self._lock:
+            if key not in self._clients:
+                config = self.limited_config if service in self.limited_services else self.config
+                client = self.session.client(service, region_name=region_name, config=config)
+                self._clients[key] = self.wrap(client) if self.wrap else client
+                logger.debug(f'{service} client created for {region_name}')
+            return self._clients[key]
+
+    def get_client_list(self, service: str = 'ec2', regions: list = None) -> 'LazyClients':
+        """
+        region -> client of service, created when a region is first looked up
+        """
+        return LazyClients(self, service, regions or REGION_CODE_MAP.keys())
+
+    @property
+    def created(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+
+class LazyClients(Mapping):
+    def __init__(self, factory: ClientFactory, service: str, regions):
+        self.factory = factory
+        self.service = service
+        self.regions = list(regions)
+
+    def __getitem__(self, region):
+        if region not in self.regions:
+            raise KeyError(region)
+        return self.factory.client(self.service, region)
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+
+def get_client_list(factory: ClientFactory = None, **credentials) -> LazyClients:
+    """
+    region -> ec2 client, created on first use
+    :param factory: shares the clients and their connection pools, a new one from credentials by default
+    """
+    return (factory or ClientFactory(**credentials)).get_client_list('ec2')
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import os
 import pandas as pd
 import math
+from spot_market_scoring import rate_limiter
 
 
 def approx_bisect(lst, approx_num=5):
@@ -27,12 +28,23 @@ def listdir_nohidden(path):
             yield f
 
 
-def paginate(method, **kwargs):
-    ec2_client = method.__self__
-    paginator = ec2_client.get_paginator(method.__name__)
-    for page in paginator.paginate(**kwargs).result_key_iters():
-        for item in page:
+def paginate(method, limiter=None, **kwargs):
+    """
+    items of every page of a NextToken paged operation, e.g. paginate(client.describe_spot_price_history)
+    :param limiter: rate_limiter.RateLimiter, defaults to the one of the client's service/region;
+                    a throttled page is fetched again
+    """
+    client = method.__self__
+    result_key = client.get_paginator(method.__name__).result_keys[0].expression
+    limiter = limiter or rate_limiter.get_client_limiter(client)
+    token = None
+    while True:
+        page = limiter.call(method, **kwargs, **({'NextToken': token} if token else {}))
+        for item in page.get(result_key, []):
             yield item
+        token = page.get('NextToken')
+        if not token:
+            break
 
 
 def normalize_by_columns(df, columns: []) -> pd.DataFrame:
@@ -42,6 +54,15 @@ def normalize_by_columns(df, columns: []) -> pd.DataFrame:
     return df
 
 
+
+def to_categorical(df, columns: []) -> pd.DataFrame:
+    """
+    repeated identifiers (region, az, instance type, system) as categories,
+    every distinct string is kept once and rows hold small integer codes
+    """
+    return df.astype({col: 'category' for col in columns if col in df.columns})
+
+
 class ParquetTranscoder:
     __PARQUET_COLUMN_ENCODE_MAP = {
         '/': '[SLASH]',
@@ -1,18 +1,62 @@
 import os
-import time
-import boto3
 import logging
 import datetime
 from pymongo import MongoClient
-from spot_market_scoring import spot_market_scoring as sms
-from spot_market_scoring import spot_price_history as sph
-from spot_market_scoring import user, ec2, pricing
-from spot_market_scoring import spot_advisor as sa
+from spot_market_scoring import user
+from spot_market_scoring import metrics, pipeline, history_cache, mongo_writer, mongo_indexes, rate_limiter
+from spot_market_scoring import history_shards
+from spot_market_scoring.history_storage import get_history_storage
+from spot_market_scoring.price_list import OFFER_URL
+from spot_market_scoring.forecast_engine import ForecastEngine
+from spot_market_scoring.model_store import ModelStore
+from spot_market_scoring.pooled_forecast import PooledForecaster
 
 AWS_CREDENTIALS = {'aws_access_key_id': os.getenv('ALGO_AWS_CREDENTIALS_ACCESS_KEY_ID'),
                    'aws_secret_access_key': os.getenv('ALGO_AWS_CREDENTIALS_SECRET_ACCESS_KEY')}
 
 MONGODB_CONNECTION = os.getenv('ALGO_MONGODB_CONNECTION')
+# number of processes training the price models, 0 to train in the scoring threads
+FORECAST_WORKERS = int(os.getenv('ALGO_FORECAST_WORKERS', os.cpu_count()))
+# predictions of unchanged training windows are reused from this file
+MODEL_STORE_PATH = os.getenv('ALGO_MODEL_STORE_PATH', 'model_store.sqlite')
+# reuse predictions while the window slides over unchanged prices, approximate (see model_store.ModelStore)
+MODEL_STORE_STABLE_KEYS = os.getenv('ALGO_MODEL_STORE_STABLE_KEYS', '0') == '1'
+# one model per region/system instead of one per instance type and az
+POOLED_FORECAST = os.getenv('ALGO_POOLED_FORECAST', '0') == '1'
+# run report (json) and node_exporter textfile (prometheus) of the stage/task metrics
+METRICS_REPORT_PATH = os.getenv('ALGO_METRICS_REPORT_PATH', 'daily_metrics.json')
+METRICS_TEXTFILE_PATH = os.getenv('ALGO_METRICS_TEXTFILE_PATH')
+# spot price history format on s3, csv or parquet (see migrate_spot_price_history.py)
+HISTORY_FORMAT = os.getenv('ALGO_HISTORY_FORMAT', 'csv')
+# with 1, daily updates only write the new records as deltas, merged into the history
+# once ALGO_HISTORY_MAX_DELTAS deltas exist (or by compact_spot_price_history.py)
+HISTORY_DELTAS = os.getenv('ALGO_HISTORY_DELTAS', '0') == '1'
+HISTORY_MAX_DELTAS = int(os.getenv('ALGO_HISTORY_MAX_DELTAS', 7))
+# memory of the parsed history and statistics kept for the scoring stage, 0 disables the cache
+HISTORY_CACHE_MB = float(os.getenv('ALGO_HISTORY_CACHE_MB', 256))
+# 'staged' swaps all new scores in at once, 'in_place' rewrites every region/system as it is scored
+SCORES_PUBLISH = os.getenv('ALGO_SCORES_PUBLISH', 'staged')
+# on-demand prices from these Price List offer files (comma separated paths or urls, {region} is replaced by
+# every region, 'offer' for price_list.OFFER_URL) instead of the pricing api
+OFFER_FILES = [f.strip() for f in os.getenv('ALGO_PRICE_LIST_FILES', '').split(',') if f.strip()]
+OFFER_FILES = [OFFER_URL if f == 'offer' else f for f in OFFER_FILES]
+# spot price history fetch, 'threads' (a stage per region/system) or 'async' (one event loop, see async_fetch)
+HISTORY_FETCH = os.getenv('ALGO_HISTORY_FETCH', 'threads')
+# large region/systems are fetched in time window shards of about this many records (by the records per day
+# of the last run), 0 disables the shards
+HISTORY_SHARD_RECORDS = int(os.getenv('ALGO_HISTORY_SHARD_RECORDS', history_shards.SHARD_RECORDS))
+HISTORY_MAX_SHARDS = int(os.getenv('ALGO_HISTORY_MAX_SHARDS', history_shards.MAX_SHARDS))
+# operations per Mongo bulk write
+MONGO_BATCH_SIZE = int(os.getenv('ALGO_MONGO_BATCH_SIZE', 1000))
+# stages running at once, 1 runs them one after another
+STAGE_WORKERS = int(os.getenv('ALGO_STAGE_WORKERS', 32))
+# botocore retries of the aws clients, 'standard' or 'adaptive' (client side rate limiting); the ec2 and
+# pricing clients make one attempt per call, their calls are retried by the rate limiter
+AWS_RETRY_MODE = os.getenv('ALGO_AWS_RETRY_MODE', 'standard')
+AWS_MAX_ATTEMPTS = int(os.getenv('ALGO_AWS_MAX_ATTEMPTS', 5))
+# ec2 calls per second and concurrent calls per region of the rate limiter, adapted down on throttling
+EC2_RATE_LIMIT = float(os.getenv('ALGO_EC2_RATE_LIMIT', rate_limiter.LIMITS['ec2']['rate']))
+EC2_MAX_CONCURRENCY = int(os.getenv('ALGO_EC2_MAX_CONCURRENCY', rate_limiter.LIMITS['ec2']['max_concurrency']))
 
 logging.basicConfig(filename='daily.log',level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
@@ -20,37 +64,43 @@ logging.basicConfig(filename='daily.log',level=logging.INFO,
 
 if __name__ == '__main__':
     logging.info(f'Start to update mongodb. Time: {datetime.datetime.today()}')
-    pricing_client = boto3.client('pricing', region_name='us-east-1', **AWS_CREDENTIALS)
-    clients = user.get_client_list(**AWS_CREDENTIALS)
+    run_metrics = metrics.start_run()
+    cache = history_cache.start_run(int(HISTORY_CACHE_MB * 2 ** 20))
+    mongo_writer.set_batch_size(MONGO_BATCH_SIZE)
+    history_shards.set_shard_size(HISTORY_SHARD_RECORDS, HISTORY_MAX_SHARDS)
+    rate_limiter.configure('ec2', rate=EC2_RATE_LIMIT, max_concurrency=EC2_MAX_CONCURRENCY)
+    # clients are created on first use, with a connection per stage that may call them at once
+    client_factory = user.ClientFactory(max_pool_connections=STAGE_WORKERS, retry_mode=AWS_RETRY_MODE,
+                                        max_attempts=AWS_MAX_ATTEMPTS, wrap=metrics.instrument_client,
+                                        **AWS_CREDENTIALS)
+    pricing_client = client_factory.client('pricing', region_name='us-east-1')
+    clients = user.get_client_list(client_factory)
     dbclient = MongoClient(MONGODB_CONNECTION)
-    s3client = boto3.client('s3', **AWS_CREDENTIALS)
+    # missing indexes are created, reads still scanning a collection are logged
+    mongo_indexes.ensure_indexes(dbclient)
+    mongo_indexes.check_query_plans(dbclient)
+    s3client = client_factory.client('s3')
 
-
-    start = time.time()
-    ec2.update_instance_types(clients,dbclient)
-    logging.info(f'update instance types time used: {time.time()-start}') #305.0582730770111
-    start = time.time()
-    ec2.update_prod_info(dbclient)
-    logging.info(f'update prod info time used: {time.time()-start}') #9.181091070175171
-    start = time.time()
-    pricing.update_ondemand_price(pricing_client,dbclient)
-    logging.info(f'update ondemand price time used: {time.time()-start}') #957.0628590583801
-    start = time.time()
-    pricing.update_instance_list_by_family(dbclient)
-    logging.info(f'update instance list time used: {time.time()-start}') #264.9353218078613
-    start = time.time()
-    # days_back set for 2 days for now, should be set 1 after schedule to run daily
-    sph.update_spot_price_history_in_all_region(clients, year=2021, days_back=5,
-                                                s3client=s3client, dbclient=dbclient, local=False)
-    logging.info(f'update spot price history used: {time.time() - start}') # 1375.139800786972
-
-    # can take some time to run, can be schedule to update weekly?
-    ondemand = pricing.get_ondemand_price_list(dbclient)
-    ondemand.reset_index(drop=True, inplace=True)
-
-    sa_response = sa.get_spot_advisor_data(dbclient=dbclient, local=False)
-    start = time.time()
-    response = sms.get_scores(ondemand, sa_response, s3client, dbclient)
-    logging.info(f'update score time used: {time.time() - start}')
-    logging.info(f'Success to update mongodb. Time: {datetime.datetime.today()}')
-    
+    try:
+        # stages run as soon as their inputs are ready, see spot_market_scoring.pipeline
+        with ModelStore(MODEL_STORE_PATH, stable_keys=MODEL_STORE_STABLE_KEYS) as store, \
+                ForecastEngine(workers=FORECAST_WORKERS, store=store) as engine:
+            forecaster = PooledForecaster() if POOLED_FORECAST else engine
+            # days_back set for 2 days for now, should be set 1 after schedule to run daily
+            scheduler = pipeline.run_update_pipeline(clients, pricing_client, s3client, dbclient,
+                                                     forecaster=forecaster, year=2021, days_back=5,
+                                                     max_workers=STAGE_WORKERS, publish=SCORES_PUBLISH,
+                                                     offer_files=OFFER_FILES, fetch=HISTORY_FETCH,
+                                                     storage=get_history_storage(HISTORY_FORMAT, HISTORY_DELTAS,
+                                                                                 HISTORY_MAX_DELTAS))
+        if scheduler.failed:
+            raise RuntimeError(f'stages failed: {sorted(scheduler.failed)}, skipped: {sorted(scheduler.skipped)}')
+        logging.info(f'Success to update mongodb. Time: {datetime.datetime.today()}')
+    finally:
+        cache.log_stats()
+        rate_limiter.log_stats()
+        run_metrics.finish()
+        if METRICS_REPORT_PATH:
+            run_metrics.write_json(METRICS_REPORT_PATH)
+        if METRICS_TEXTFILE_PATH:
+            run_metrics.write_prometheus(METRICS_TEXTFILE_PATH)